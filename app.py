@@ -1,14 +1,19 @@
 import os
-from datetime import datetime, date, timezone
-from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, flash, jsonify, send_file
+from datetime import datetime, date, timezone, timedelta
+from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, flash, jsonify, send_file, Response, g
+import click
 import pandas as pd
+import numpy as np
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
 from reportlab.pdfbase.pdfmetrics import stringWidth
+import io
 from io import BytesIO
 import json
 import smtplib
+import threading
+import time
 from email.message import EmailMessage
 try:
     import sqlalchemy as sa
@@ -17,6 +22,29 @@ except ImportError:  # allow running locally without DB deps
     sa = None
     _sql_text = None
 import urllib.parse as _up
+import urllib.request
+import urllib.error
+import hashlib
+import re
+import bisect
+import unicodedata
+import sys
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import pickle
+import tempfile
+import sqlite3
+import secrets
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, each worker refreshes on its own
+    fcntl = None
 
 APP_SECRET = os.environ.get("APP_SECRET", "dev-secret-change-me")
 DATA_CSV_PATH = os.environ.get("PRODUCTS_CSV", os.path.join(os.path.dirname(__file__), "data", "products.csv"))
@@ -36,6 +64,78 @@ os.makedirs(ORDERS_DIR, exist_ok=True)
 # Cache is per sheet: {"generales": {...}, "ansioliticos": {...}}
 _PRODUCTS_CACHE = {}
 _PRODUCTS_CACHE_TTL = int(os.environ.get("PRODUCTS_CACHE_TTL", "300"))  # seconds
+# Serve the stale catalog while a background thread refreshes it (stale-while-revalidate)
+_PRODUCTS_CACHE_SWR = os.environ.get("PRODUCTS_CACHE_SWR", "1").strip().lower() not in ("0", "false", "no")
+# After a failed refresh, wait this long before trying again (seconds)
+_PRODUCTS_REFRESH_RETRY = int(os.environ.get("PRODUCTS_REFRESH_RETRY", "30"))
+# Single-flight lock per sheet so concurrent threads never download the same gid twice
+_PRODUCTS_REFRESH_LOCKS = {}
+_PRODUCTS_REFRESH_LOCKS_GUARD = threading.Lock()
+# Refresh metrics per sheet, exposed on /metrics
+_PRODUCTS_METRICS = {}
+# Shared on-disk catalog snapshots (one per sheet) so every gunicorn worker serves the same
+# version and only one process downloads the sheet per refresh interval. Empty disables it.
+PRODUCTS_SHARED_DIR = os.environ.get("PRODUCTS_SHARED_DIR", os.path.join(BASE_DIR, "data", "catalog_cache"))
+
+# Serialized /api/products payloads keyed on (sheet, catalog version, q, mode, page, per_page, margin).
+# LRU with entry and byte limits; per-user fields live in /api/session so these stay shareable.
+class _BytesLRU:
+    """Thread-safe LRU of key -> (body bytes, etag, *extra), bounded by entry count and total bytes."""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+    def get(self, key):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                self._stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self._stats["hits"] += 1
+            return hit
+
+    def put(self, key, body: bytes, etag: str, *extra) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._stats["bytes"] -= len(previous[0])
+            self._items[key] = (body, etag, *extra)
+            self._stats["bytes"] += len(body)
+            while self._items and (len(self._items) > self.max_entries or self._stats["bytes"] > self.max_bytes):
+                _, (old_body, *_) = self._items.popitem(last=False)
+                self._stats["bytes"] -= len(old_body)
+                self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._items), **self._stats}
+
+
+_API_PRODUCTS_CACHE = _BytesLRU(
+    int(os.environ.get("API_PRODUCTS_CACHE_MAX_ENTRIES", "512")),
+    int(os.environ.get("API_PRODUCTS_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+# Finished catalog PDFs keyed on (sheet, catalog version, q, margin), with the time they were rendered
+_CATALOG_PDF_CACHE = _BytesLRU(
+    int(os.environ.get("CATALOG_PDF_CACHE_MAX_ENTRIES", "32")),
+    int(os.environ.get("CATALOG_PDF_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+)
+
+# Catalog ingestion: rows parsed per chunk (0 = whole sheet at once) and optional RSS cap in MB (0 = no cap)
+_PRODUCTS_INGEST_CHUNKSIZE = int(os.environ.get("PRODUCTS_INGEST_CHUNKSIZE", "20000"))
+_PRODUCTS_INGEST_MAX_RSS_MB = int(os.environ.get("PRODUCTS_INGEST_MAX_RSS_MB", "0"))
+
+# Raw CSV exports per URL with their validators (ETag/Last-Modified) and content hash,
+# so unchanged sheets skip the download body and the whole normalization pipeline
+_CSV_FETCH_CACHE = {}
+_CSV_FETCH_TIMEOUT = int(os.environ.get("PRODUCTS_FETCH_TIMEOUT", "30"))  # seconds
 
 # Simple JSON persistence for clients
 CLIENTS_PATH = os.path.join(BASE_DIR, "data", "clients.json")
@@ -43,17 +143,72 @@ os.makedirs(os.path.join(BASE_DIR, "data"), exist_ok=True)
 
 DATABASE_URL = os.environ.get("DATABASE_URL") or os.environ.get("RAILWAY_DATABASE_URL")
 _ENGINE = None
-_HISTORY_SYNCED = False
+# Postgres pool, per worker process (each gunicorn worker has its own engine)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))  # seconds; stay under the provider's idle cutoff
+# Schema changes run once per worker at startup (gunicorn.conf.py), never inside a request;
+# with DB_AUTO_MIGRATE=0 only via `flask --app app init-db`
+DB_AUTO_MIGRATE = os.environ.get("DB_AUTO_MIGRATE", "1").strip().lower() not in ("0", "false", "no")
+_DB_MIGRATE_LOCK_KEY = 72010425  # pg_advisory_xact_lock key: one worker migrates, the rest wait
+_ENGINE_LOCK = threading.Lock()
+
+# Local SQLite file used for server-side state when there is no DATABASE_URL
+LOCAL_DB_PATH = os.environ.get("LOCAL_DB_PATH", os.path.join(BASE_DIR, "data", "local.db"))
+_LOCAL_DB = threading.local()
+_LOCAL_DB_INIT_LOCK = threading.Lock()
+_LOCAL_DB_READY = False
+
+# Orders live in the historial table: Postgres when DATABASE_URL is set, else the local SQLite file.
+# orders/*.json is only an import source, or an export when ORDERS_JSON_EXPORT=1.
+ORDERS_JSON_EXPORT = os.environ.get("ORDERS_JSON_EXPORT", "0").strip().lower() in ("1", "true", "yes")
+# New or changed files in orders/ and pdfs/ are imported by a background thread (ORDERS_SYNC=0 leaves it
+# to `flask import-orders`); ORDERS_SYNC_INTERVAL > 0 rescans every that many seconds
+_ORDERS_SYNC_ON_START = os.environ.get("ORDERS_SYNC", "1").strip().lower() not in ("0", "false", "no")
+_ORDERS_SYNC_INTERVAL = int(os.environ.get("ORDERS_SYNC_INTERVAL", "0"))
+_ORDERS_SYNC_BATCH = 200  # orders per multi-row upsert
+
+# Remito PDFs are content-addressed blobs (SHA-256, stored once) in remito_blobs. REMITO_BLOB_BACKEND:
+# "db" keeps the bytes in that table, "disk" under REMITO_BLOB_DIR; default db with DATABASE_URL, else disk
+REMITO_BLOB_BACKEND = os.environ.get("REMITO_BLOB_BACKEND", "").strip().lower()
+REMITO_BLOB_DIR = os.environ.get("REMITO_BLOB_DIR", os.path.join(BASE_DIR, "data", "blobs"))
+_BLOB_CHUNK = 256 * 1024  # bytes per query when streaming a blob out of the database
+_HISTORY_SYNC_LOCK = threading.Lock()
+_HISTORY_SYNC_START_LOCK = threading.Lock()
+_HISTORY_SYNC_THREAD = None
+
+# Server-side cart store: the cookie only carries a short session id ("sid").
+# CART_STORE: "" (Postgres if configured, else SQLite), "db", "sqlite" or "memory"
+CART_STORE = os.environ.get("CART_STORE", "").strip().lower()
+_CART_STORE_TTL = int(os.environ.get("CART_STORE_TTL_DAYS", "30")) * 86400  # idle carts are purged after this
+
+# Checkout worker pool: PDF rendering, DB copy and email run after the order is saved.
+# Jobs are queued in the local SQLite file so they survive restarts.
+_CHECKOUT_WORKERS = int(os.environ.get("CHECKOUT_WORKERS", "2"))
+_CHECKOUT_JOB_MAX_ATTEMPTS = int(os.environ.get("CHECKOUT_JOB_MAX_ATTEMPTS", "5"))
+_CHECKOUT_JOB_STALE = 600  # seconds before a "running" job left by a dead process is picked up again
+_CHECKOUT_JOB_KEEP = int(os.environ.get("CHECKOUT_JOB_KEEP_DAYS", "7")) * 86400  # finished jobs are pruned after this
+_CHECKOUT_JOB_LAST_PRUNE = 0.0
+_CHECKOUT_EXECUTOR = None
+_CHECKOUT_EXECUTOR_LOCK = threading.Lock()
+
+class DatabaseUnavailable(RuntimeError):
+    """DATABASE_URL is set but Postgres can't be used. Requests answer 503 instead of writing to
+    the local SQLite file, which would split the data between two stores."""
+
 
 def _get_engine():
+    """Postgres engine for this worker, or None when DATABASE_URL is not set (local SQLite mode).
+    Raises DatabaseUnavailable if it is set but the server can't be reached; the next call retries."""
     global _ENGINE
     if _ENGINE is not None:
         return _ENGINE
-    if sa is None:
-        return None
     url = DATABASE_URL
     if not url:
         return None
+    if sa is None:
+        raise DatabaseUnavailable("DATABASE_URL está definido pero SQLAlchemy no está instalado")
     if url.startswith("postgres://"):
         url = "postgresql+psycopg2://" + url[len("postgres://"):]
     # Ensure SSL for managed providers like Railway
@@ -65,57 +220,445 @@ def _get_engine():
             url = _up.urlunsplit((parsed.scheme, parsed.netloc, parsed.path, new_query, parsed.fragment))
     except Exception:
         pass
-    try:
-        _ENGINE = sa.create_engine(url, pool_pre_ping=True)
-        with _ENGINE.begin() as conn:
-            conn.execute(_sql_text(
-                """
-                CREATE TABLE IF NOT EXISTS clients (
-                  id SERIAL PRIMARY KEY,
-                  name TEXT NOT NULL,
-                  zone TEXT,
-                  email TEXT,
-                  phone TEXT,
-                  default_margin DOUBLE PRECISION,
-                  notes TEXT,
-                  created_at TIMESTAMPTZ DEFAULT NOW()
-                )
-                """
-            ))
-            conn.execute(_sql_text(
-                """
-                CREATE TABLE IF NOT EXISTS historial (
-                  order_id TEXT PRIMARY KEY,
-                  client_name TEXT,
-                  client_email TEXT,
-                  responsible TEXT,
-                  created_at TIMESTAMPTZ DEFAULT NOW(),
-                  total DOUBLE PRECISION,
-                  state TEXT,
-                  pdf_filename TEXT,
-                  data JSONB,
-                  updated_at TIMESTAMPTZ DEFAULT NOW()
-                )
-                """
-            ))
-            # Ensure pdf_data column exists to persist PDF bytes
-            conn.execute(_sql_text(
-                """
-                ALTER TABLE historial
-                ADD COLUMN IF NOT EXISTS pdf_data BYTEA
-                """
-            ))
+    with _ENGINE_LOCK:
+        if _ENGINE is not None:
+            return _ENGINE
+        try:
+            eng = sa.create_engine(
+                url,
+                pool_pre_ping=True,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE,
+            )
+            # Fail now if the server can't be reached, not halfway through a transaction
+            with eng.connect() as conn:
+                conn.execute(_sql_text("SELECT 1"))
+        except Exception as e:
+            raise DatabaseUnavailable(f"no se pudo conectar a la base de datos: {type(e).__name__}") from e
+        _ENGINE = eng
         return _ENGINE
-    except Exception:
-        _ENGINE = None
-        return None
+
 
 def db_enabled():
-    return _get_engine() is not None
+    """Whether state lives in Postgres. Depends only on configuration: with DATABASE_URL set an
+    unreachable server raises DatabaseUnavailable (503), it never falls back to SQLite."""
+    return bool(DATABASE_URL)
 
-def db_list_clients(q: str = ""):
+
+# Tables shared by Postgres and the local SQLite file (portable types only)
+_CART_STORE_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS cart_sessions (
+      sid TEXT PRIMARY KEY,
+      item_count INTEGER NOT NULL DEFAULT 0,
+      total DOUBLE PRECISION NOT NULL DEFAULT 0,
+      updated_at DOUBLE PRECISION NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cart_items (
+      sid TEXT NOT NULL,
+      pos INTEGER NOT NULL,
+      item TEXT NOT NULL,
+      PRIMARY KEY (sid, pos)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS cart_sessions_updated_idx ON cart_sessions (updated_at)",
+)
+
+# Dashboard rollups: per day, per day+client and per day+product, plus each order's
+# contribution so edits and deletes subtract exactly what the order added
+_SALES_ROLLUP_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily (
+      day TEXT PRIMARY KEY,
+      orders INTEGER NOT NULL DEFAULT 0,
+      sales DOUBLE PRECISION NOT NULL DEFAULT 0,
+      items_sales DOUBLE PRECISION NOT NULL DEFAULT 0,
+      margin_val DOUBLE PRECISION NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily_client (
+      day TEXT NOT NULL,
+      client TEXT NOT NULL,
+      orders INTEGER NOT NULL DEFAULT 0,
+      sales DOUBLE PRECISION NOT NULL DEFAULT 0,
+      PRIMARY KEY (day, client)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily_product (
+      day TEXT NOT NULL,
+      name TEXT NOT NULL,
+      qty DOUBLE PRECISION NOT NULL DEFAULT 0,
+      PRIMARY KEY (day, name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_order_contrib (
+      order_id TEXT PRIMARY KEY,
+      data TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_rollup_meta (
+      name TEXT PRIMARY KEY,
+      value TEXT
+    )
+    """,
+)
+
+# Local order store without DATABASE_URL: same columns as the Postgres historial
+_LOCAL_HISTORY_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS historial (
+      order_id TEXT PRIMARY KEY,
+      client_name TEXT,
+      client_email TEXT,
+      responsible TEXT,
+      created_at TEXT,
+      total DOUBLE PRECISION,
+      state TEXT,
+      pdf_filename TEXT,
+      data TEXT,
+      pdf_data BLOB,
+      updated_at TEXT,
+      pdf_sha256 TEXT,
+      version INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS remito_blobs (
+      sha256 TEXT PRIMARY KEY,
+      size BIGINT NOT NULL,
+      data BLOB
+    )
+    """,
+)
+_LOCAL_HISTORY_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS historial_created_at_idx ON historial (created_at DESC, order_id DESC)",
+    # Client search is LIKE '%q%', which no b-tree index can serve; drop the one earlier versions created
+    "DROP INDEX IF EXISTS historial_client_lower_idx",
+    "CREATE INDEX IF NOT EXISTS historial_pdf_filename_idx ON historial (pdf_filename)",
+    "CREATE INDEX IF NOT EXISTS historial_pdf_sha256_idx ON historial (pdf_sha256)",
+    "CREATE INDEX IF NOT EXISTS historial_state_idx ON historial (state, created_at DESC, order_id DESC, total)",
+)
+# Columns added to the local historial after its first release: (name, type)
+_LOCAL_HISTORY_ADDED_COLUMNS = (("pdf_sha256", "TEXT"), ("version", "INTEGER NOT NULL DEFAULT 0"))
+
+# What the orders/ and pdfs/ import has already seen, so unchanged files are skipped
+_ORDER_MANIFEST_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS order_file_manifest (
+      path TEXT PRIMARY KEY,
+      mtime DOUBLE PRECISION NOT NULL,
+      size BIGINT NOT NULL,
+      sha256 TEXT NOT NULL
+    )
+    """,
+)
+
+# Pipeline transitions, one row per state change (version is the historial version it produced)
+# changed_at is stored like historial.updated_at: TIMESTAMPTZ on Postgres, ISO text on SQLite
+_STATE_LOG_TABLE = """
+    CREATE TABLE IF NOT EXISTS historial_state_log (
+      order_id TEXT NOT NULL,
+      version INTEGER NOT NULL,
+      from_state TEXT,
+      to_state TEXT NOT NULL,
+      changed_at {ts} NOT NULL,
+      changed_by TEXT,
+      PRIMARY KEY (order_id, version)
+    )
+    """
+# Log rows of deleted orders, left behind before delete_order removed them; they would collide
+# with the versions of a new order reusing the id
+_STATE_LOG_ORPHANS = """
+    DELETE FROM historial_state_log
+    WHERE NOT EXISTS (SELECT 1 FROM historial h WHERE h.order_id = historial_state_log.order_id)
+    """
+_STATE_LOG_DDL = (
+    _STATE_LOG_TABLE.format(ts="TIMESTAMPTZ"),
+    # Earlier versions kept epoch seconds
+    """
+    DO $$
+    BEGIN
+      IF (SELECT data_type FROM information_schema.columns
+          WHERE table_name = 'historial_state_log' AND column_name = 'changed_at') = 'double precision' THEN
+        ALTER TABLE historial_state_log ALTER COLUMN changed_at TYPE TIMESTAMPTZ USING to_timestamp(changed_at);
+      END IF;
+    END $$
+    """,
+    _STATE_LOG_ORPHANS,
+)
+_LOCAL_STATE_LOG_DDL = (
+    _STATE_LOG_TABLE.format(ts="TEXT"),
+    """
+    UPDATE historial_state_log SET changed_at = strftime('%Y-%m-%dT%H:%M:%f+00:00', changed_at, 'unixepoch')
+    WHERE typeof(changed_at) IN ('real', 'integer')
+    """,
+    _STATE_LOG_ORPHANS,
+)
+
+# Local-only: the checkout job queue belongs to this host's workers
+_CHECKOUT_JOBS_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS checkout_jobs (
+      order_id TEXT PRIMARY KEY,
+      status TEXT NOT NULL,
+      steps TEXT NOT NULL DEFAULT '',
+      attempts INTEGER NOT NULL DEFAULT 0,
+      error TEXT,
+      created_at DOUBLE PRECISION NOT NULL,
+      updated_at DOUBLE PRECISION NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS checkout_jobs_status_idx ON checkout_jobs (status)",
+)
+
+
+def init_db() -> None:
+    """Create or upgrade the schema: the local SQLite file (which always holds the checkout job queue)
+    and, when DATABASE_URL is set, the Postgres tables. Idempotent; `flask --app app init-db` runs it."""
+    _local_db()
     eng = _get_engine()
-    if not eng:
+    if eng is not None:
+        _pg_init_schema(eng)
+
+
+def _pg_init_schema(eng) -> None:
+    """Postgres DDL in one transaction. Gunicorn workers run init_db at startup at the same
+    time, and concurrent CREATE ... IF NOT EXISTS can still collide in pg_catalog, so the first
+    statement takes a transaction-scoped advisory lock: one worker migrates, the rest wait and
+    then find everything in place."""
+    with eng.begin() as conn:
+        conn.execute(_sql_text("SELECT pg_advisory_xact_lock(:key)"), {"key": _DB_MIGRATE_LOCK_KEY})
+        conn.execute(_sql_text(
+            """
+            CREATE TABLE IF NOT EXISTS clients (
+              id SERIAL PRIMARY KEY,
+              name TEXT NOT NULL,
+              zone TEXT,
+              email TEXT,
+              phone TEXT,
+              default_margin DOUBLE PRECISION,
+              notes TEXT,
+              created_at TIMESTAMPTZ DEFAULT NOW()
+            )
+            """
+        ))
+        conn.execute(_sql_text(
+            """
+            CREATE TABLE IF NOT EXISTS historial (
+              order_id TEXT PRIMARY KEY,
+              client_name TEXT,
+              client_email TEXT,
+              responsible TEXT,
+              created_at TIMESTAMPTZ DEFAULT NOW(),
+              total DOUBLE PRECISION,
+              state TEXT,
+              pdf_filename TEXT,
+              data JSONB,
+              updated_at TIMESTAMPTZ DEFAULT NOW()
+            )
+            """
+        ))
+        # Ensure pdf_data column exists to persist PDF bytes
+        conn.execute(_sql_text(
+            """
+            ALTER TABLE historial
+            ADD COLUMN IF NOT EXISTS pdf_data BYTEA
+            """
+        ))
+        # Date-bounded scans and the newest-first history listing
+        conn.execute(_sql_text(
+            "CREATE INDEX IF NOT EXISTS historial_created_at_idx ON historial (created_at DESC, order_id DESC)"
+        ))
+        # Remito bytes live in remito_blobs; pdf_data only holds rows not moved there yet
+        conn.execute(_sql_text(
+            """
+            CREATE TABLE IF NOT EXISTS remito_blobs (
+              sha256 TEXT PRIMARY KEY,
+              size BIGINT NOT NULL,
+              data BYTEA
+            )
+            """
+        ))
+        conn.execute(_sql_text("ALTER TABLE historial ADD COLUMN IF NOT EXISTS pdf_sha256 TEXT"))
+        # Bumped by every write; pipeline moves check it (optimistic concurrency)
+        conn.execute(_sql_text("ALTER TABLE historial ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0"))
+        # Pipeline columns: per-state newest-first pages, counts and totals (total makes it covering)
+        conn.execute(_sql_text(
+            "CREATE INDEX IF NOT EXISTS historial_state_idx ON historial (state, created_at DESC, order_id DESC, total)"
+        ))
+        conn.execute(_sql_text("CREATE INDEX IF NOT EXISTS historial_pdf_filename_idx ON historial (pdf_filename)"))
+        conn.execute(_sql_text("CREATE INDEX IF NOT EXISTS historial_pdf_sha256_idx ON historial (pdf_sha256)"))
+        for ddl in _CART_STORE_DDL + _SALES_ROLLUP_DDL + _ORDER_MANIFEST_DDL + _STATE_LOG_DDL:
+            conn.execute(_sql_text(ddl))
+        conn.execute(_sql_text("DROP INDEX IF EXISTS historial_client_lower_idx"))
+        # Client search uses LIKE '%q%': a trigram index needs pg_trgm, which may require privileges.
+        # A savepoint keeps a refused CREATE EXTENSION from aborting the rest of the migration.
+        try:
+            with conn.begin_nested():
+                conn.execute(_sql_text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(_sql_text(
+                    "CREATE INDEX IF NOT EXISTS historial_client_trgm_idx ON historial USING gin (lower(client_name) gin_trgm_ops)"
+                ))
+        except Exception:
+            # Without pg_trgm client search stays unindexed (a b-tree can't serve LIKE '%q%')
+            pass
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or upgrade the database schema."""
+    init_db()
+    print("ok")
+
+
+def _local_db() -> sqlite3.Connection:
+    """Per-thread connection to the local SQLite file (WAL, so readers don't block the writer)."""
+    global _LOCAL_DB_READY
+    conn = getattr(_LOCAL_DB, "conn", None)
+    if conn is not None:
+        return conn
+    conn = sqlite3.connect(LOCAL_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with _LOCAL_DB_INIT_LOCK:
+        if not _LOCAL_DB_READY:
+            with conn:
+                for ddl in _CART_STORE_DDL + _SALES_ROLLUP_DDL + _LOCAL_HISTORY_DDL + _ORDER_MANIFEST_DDL + _LOCAL_STATE_LOG_DDL + _CHECKOUT_JOBS_DDL:
+                    conn.execute(ddl)
+                # SQLite has no ADD COLUMN IF NOT EXISTS; indexes on added columns need them first
+                have = {r[1] for r in conn.execute("PRAGMA table_info(historial)")}
+                for name, kind in _LOCAL_HISTORY_ADDED_COLUMNS:
+                    if name not in have:
+                        conn.execute(f"ALTER TABLE historial ADD COLUMN {name} {kind}")
+                for ddl in _LOCAL_HISTORY_INDEXES:
+                    conn.execute(ddl)
+            _LOCAL_DB_READY = True
+    _LOCAL_DB.conn = conn
+    return conn
+
+
+class _QueryTimings:
+    """Per-query latency histograms (cumulative ms buckets, Prometheus style) for /metrics."""
+
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: dict[str, dict] = {}
+
+    def observe(self, name: str, seconds: float) -> None:
+        ms = seconds * 1000.0
+        with self._lock:
+            d = self._data.get(name)
+            if d is None:
+                d = self._data[name] = {"count": 0, "sum_ms": 0.0, "max_ms": 0.0, "hist": [0] * (len(self.BUCKETS_MS) + 1)}
+            d["count"] += 1
+            d["sum_ms"] += ms
+            d["max_ms"] = max(d["max_ms"], ms)
+            d["hist"][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {}
+            for name, d in sorted(self._data.items()):
+                buckets, acc = [], 0
+                for bound, n in zip(self.BUCKETS_MS + ("+Inf",), d["hist"]):
+                    acc += n
+                    buckets.append([bound, acc])  # [upper bound ms, queries <= bound]
+                out[name] = {
+                    "count": d["count"],
+                    "sum_ms": round(d["sum_ms"], 3),
+                    "avg_ms": round(d["sum_ms"] / d["count"], 3),
+                    "max_ms": round(d["max_ms"], 3),
+                    "buckets": buckets,
+                }
+            return out
+
+
+_QUERY_TIMINGS = _QueryTimings()
+
+
+def _local_db_ro() -> sqlite3.Connection:
+    """Per-thread read-only connection to the local file: autocommit reads see the latest WAL snapshot."""
+    conn = getattr(_LOCAL_DB, "ro", None)
+    if conn is not None:
+        return conn
+    _local_db()  # schema first
+    conn = sqlite3.connect(LOCAL_DB_PATH, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON")
+    _LOCAL_DB.ro = conn
+    return conn
+
+
+@contextmanager
+def _tx_rollback_hooks(run):
+    try:
+        yield
+    except BaseException:
+        for fn in reversed(run.on_rollback):
+            fn()
+        raise
+
+
+@contextmanager
+def _sql_tx(use_db: bool, readonly: bool = False):
+    """One transaction on Postgres (use_db) or the local SQLite file. Yields run(sql, params) -> list of dicts.
+    Both drivers accept the same :name placeholders, so callers write the SQL once.
+    readonly: list/lookup queries; Postgres runs them in autocommit with a read-only session (no BEGIN/COMMIT
+    round trips, and a misplaced write fails loudly), SQLite on a separate query_only connection.
+    Every statement is timed into _QUERY_TIMINGS under the calling function's name.
+    run.on_commit / run.on_rollback take callables for side effects outside the database (blob files):
+    rollback hooks run before the rollback, while the transaction's row locks are still held."""
+    caller = sys._getframe(2).f_code.co_name  # skip the contextmanager frame
+    if use_db:
+        eng = _get_engine()
+        if readonly:
+            ctx = eng.connect().execution_options(isolation_level="AUTOCOMMIT", postgresql_readonly=True)
+        else:
+            ctx = eng.begin()
+        label = "pg." + caller
+        with ctx as conn:
+            def run(sql, params=None):
+                t0 = time.perf_counter()
+                # The SQL strings are constants, so SQLAlchemy's compiled cache serves them after the first call
+                res = conn.execute(_sql_text(sql), params or {})
+                rows = [dict(r) for r in res.mappings().all()] if res.returns_rows else []
+                _QUERY_TIMINGS.observe(label, time.perf_counter() - t0)
+                return rows
+            run.use_db, run.on_commit, run.on_rollback = True, [], []
+            with _tx_rollback_hooks(run):
+                yield run
+        for fn in run.on_commit:
+            fn()
+    else:
+        conn = _local_db_ro() if readonly else _local_db()
+        label = "sqlite." + caller
+        with conn:
+            def run(sql, params=None):
+                t0 = time.perf_counter()
+                # sqlite3 keeps a per-connection cache of prepared statements keyed by the SQL text
+                rows = [dict(r) for r in conn.execute(sql, params or {}).fetchall()]
+                _QUERY_TIMINGS.observe(label, time.perf_counter() - t0)
+                return rows
+            run.use_db, run.on_commit, run.on_rollback = False, [], []
+            with _tx_rollback_hooks(run):
+                yield run
+        for fn in run.on_commit:
+            fn()
+
+
+def db_list_clients(q: str = ""):
+    if not _get_engine():
         return None
     q = (q or "").strip()
     sql = "SELECT id, name, zone, email, phone, default_margin, notes, created_at FROM clients"
@@ -124,79 +667,77 @@ def db_list_clients(q: str = ""):
         sql += " WHERE lower(name) LIKE :q OR lower(zone) LIKE :q"
         params["q"] = f"%{q.lower()}%"
     sql += " ORDER BY name ASC"
-    with eng.begin() as conn:
-        rows = conn.execute(_sql_text(sql), params).mappings().all()
-        return [dict(r) for r in rows]
+    with _sql_tx(True, readonly=True) as run:
+        return run(sql, params)
 
 def db_get_client_by_id(cid: int):
-    eng = _get_engine()
-    if not eng:
+    if not _get_engine():
         return None
-    with eng.begin() as conn:
-        row = conn.execute(_sql_text(
-            "SELECT id, name, zone, email, phone, default_margin, notes, created_at FROM clients WHERE id = :id"
-        ), {"id": cid}).mappings().first()
-        return dict(row) if row else None
+    with _sql_tx(True, readonly=True) as run:
+        rows = run(
+            "SELECT id, name, zone, email, phone, default_margin, notes, created_at FROM clients WHERE id = :id",
+            {"id": cid},
+        )
+        return rows[0] if rows else None
 
 def db_get_client_by_name(name: str):
-    eng = _get_engine()
-    if not eng:
+    if not _get_engine():
         return None
-    with eng.begin() as conn:
-        row = conn.execute(_sql_text(
-            "SELECT id, name, zone, email, phone, default_margin, notes, created_at FROM clients WHERE lower(name) = :n"
-        ), {"n": (name or "").strip().lower()}).mappings().first()
-        return dict(row) if row else None
+    with _sql_tx(True, readonly=True) as run:
+        rows = run(
+            "SELECT id, name, zone, email, phone, default_margin, notes, created_at FROM clients WHERE lower(name) = :n",
+            {"n": (name or "").strip().lower()},
+        )
+        return rows[0] if rows else None
 
 def db_insert_client(data: dict):
-    eng = _get_engine()
-    if not eng:
+    if not _get_engine():
         return None
-    with eng.begin() as conn:
-        row = conn.execute(_sql_text(
+    with _sql_tx(True) as run:
+        rows = run(
             """
             INSERT INTO clients (name, zone, email, phone, default_margin, notes)
             VALUES (:name, :zone, :email, :phone, :default_margin, :notes)
             RETURNING id
-            """
-        ), {
-            "name": data.get("name", ""),
-            "zone": data.get("zone"),
-            "email": data.get("email"),
-            "phone": data.get("phone"),
-            "default_margin": float(data.get("default_margin")) if data.get("default_margin") is not None else None,
-            "notes": data.get("notes"),
-        }).scalar_one()
-        return int(row)
+            """,
+            {
+                "name": data.get("name", ""),
+                "zone": data.get("zone"),
+                "email": data.get("email"),
+                "phone": data.get("phone"),
+                "default_margin": float(data.get("default_margin")) if data.get("default_margin") is not None else None,
+                "notes": data.get("notes"),
+            },
+        )
+        return int(rows[0]["id"])
 
 def db_update_client(cid: int, data: dict):
-    eng = _get_engine()
-    if not eng:
+    if not _get_engine():
         return False
-    with eng.begin() as conn:
-        conn.execute(_sql_text(
+    with _sql_tx(True) as run:
+        run(
             """
             UPDATE clients
             SET name = :name, zone = :zone, email = :email, phone = :phone, default_margin = :default_margin, notes = :notes
             WHERE id = :id
-            """
-        ), {
-            "id": cid,
-            "name": data.get("name", ""),
-            "zone": data.get("zone"),
-            "email": data.get("email"),
-            "phone": data.get("phone"),
-            "default_margin": float(data.get("default_margin")) if data.get("default_margin") is not None else None,
-            "notes": data.get("notes"),
-        })
+            """,
+            {
+                "id": cid,
+                "name": data.get("name", ""),
+                "zone": data.get("zone"),
+                "email": data.get("email"),
+                "phone": data.get("phone"),
+                "default_margin": float(data.get("default_margin")) if data.get("default_margin") is not None else None,
+                "notes": data.get("notes"),
+            },
+        )
         return True
 
 def db_delete_client(cid: int):
-    eng = _get_engine()
-    if not eng:
+    if not _get_engine():
         return False
-    with eng.begin() as conn:
-        conn.execute(_sql_text("DELETE FROM clients WHERE id = :id"), {"id": cid})
+    with _sql_tx(True) as run:
+        run("DELETE FROM clients WHERE id = :id", {"id": cid})
         return True
 
 
@@ -221,147 +762,593 @@ def _parse_dt(value) -> datetime:
     return datetime.now(timezone.utc)
 
 
-def db_upsert_history(order: dict | None, pdf_bytes: bytes | None = None):
-    eng = _get_engine()
-    if not eng or not order:
-        return False
-    created_at_raw = order.get("created_at")
-    created_dt = _parse_dt(created_at_raw)
-    params = {
-        "order_id": order.get("order_id"),
-        "client_name": order.get("client_name"),
-        "client_email": order.get("client_email"),
-        "responsible": order.get("responsible"),
-        "created_at": created_dt,
-        "total": float(order.get("total", 0) or 0),
-        "state": order.get("state"),
-        "pdf_filename": order.get("pdf_filename"),
-        "data": json.dumps(order, ensure_ascii=False),
-    }
-    if not params["order_id"]:
+_HISTORY_COLUMNS = (
+    "order_id", "client_name", "client_email", "responsible", "created_at",
+    "total", "state", "pdf_filename", "data", "pdf_sha256", "updated_at",
+)
+
+
+def _history_upsert_rows(run, use_db: bool, orders: list, pdf_shas: list | None = None) -> None:
+    """Insert or replace orders in historial with one multi-row INSERT ... ON CONFLICT.
+
+    pdf_shas[i] is the blob of orders[i]'s remito; None keeps whatever PDF is already stored, and
+    the blob itself is never rewritten by an order update. Postgres keeps
+    created_at as TIMESTAMPTZ and data as JSONB, the local store as ISO text and JSON text.
+    """
+    if not orders:
+        return
+    params = {"now": datetime.now(timezone.utc) if use_db else datetime.now(timezone.utc).isoformat()}
+    values = []
+    for i, order in enumerate(orders):
+        created = order.get("created_at")
+        params.update({
+            f"order_id{i}": order.get("order_id"),
+            f"client_name{i}": order.get("client_name"),
+            f"client_email{i}": order.get("client_email"),
+            f"responsible{i}": order.get("responsible"),
+            f"created_at{i}": _parse_dt(created) if use_db else str(created or datetime.now().isoformat()),
+            f"total{i}": float(order.get("total", 0) or 0),
+            f"state{i}": order.get("state"),
+            f"pdf_filename{i}": order.get("pdf_filename"),
+            f"data{i}": json.dumps(order, ensure_ascii=False),
+            f"pdf_sha256{i}": pdf_shas[i] if pdf_shas else None,
+        })
+        data = f"CAST(:data{i} AS JSONB)" if use_db else f":data{i}"
+        values.append(
+            f"(:order_id{i}, :client_name{i}, :client_email{i}, :responsible{i}, :created_at{i}, "
+            f":total{i}, :state{i}, :pdf_filename{i}, {data}, :pdf_sha256{i}, :now)"
+        )
+    run(
+        f"""
+        INSERT INTO historial ({", ".join(_HISTORY_COLUMNS)})
+        VALUES {", ".join(values)}
+        ON CONFLICT (order_id) DO UPDATE SET
+          client_name = excluded.client_name,
+          client_email = excluded.client_email,
+          responsible = excluded.responsible,
+          created_at = excluded.created_at,
+          total = excluded.total,
+          state = excluded.state,
+          pdf_filename = excluded.pdf_filename,
+          data = excluded.data,
+          pdf_sha256 = coalesce(excluded.pdf_sha256, historial.pdf_sha256),
+          pdf_data = CASE WHEN excluded.pdf_sha256 IS NULL THEN historial.pdf_data END,
+          version = historial.version + 1,
+          updated_at = excluded.updated_at
+        """,
+        params,
+    )
+
+
+def _store_upsert(order: dict, pdf_bytes: bytes | None = None):
+    """Upsert into the active order store (Postgres or the local SQLite historial)."""
+    if not order or not order.get("order_id"):
         return False
-    with eng.begin() as conn:
+    use_db = db_enabled()
+    with _sql_tx(use_db) as run:
         if pdf_bytes is None:
-            conn.execute(_sql_text(
-                """
-                INSERT INTO historial (order_id, client_name, client_email, responsible, created_at, total, state, pdf_filename, data, updated_at)
-                VALUES (:order_id, :client_name, :client_email, :responsible, :created_at, :total, :state, :pdf_filename, CAST(:data AS JSONB), NOW())
-                ON CONFLICT (order_id) DO UPDATE SET
-                  client_name = EXCLUDED.client_name,
-                  client_email = EXCLUDED.client_email,
-                  responsible = EXCLUDED.responsible,
-                  created_at = EXCLUDED.created_at,
-                  total = EXCLUDED.total,
-                  state = EXCLUDED.state,
-                  pdf_filename = EXCLUDED.pdf_filename,
-                  data = EXCLUDED.data,
-                  updated_at = NOW()
-                """
-            ), params)
+            _history_upsert_rows(run, use_db, [order])
         else:
-            conn.execute(_sql_text(
-                """
-                INSERT INTO historial (order_id, client_name, client_email, responsible, created_at, total, state, pdf_filename, data, pdf_data, updated_at)
-                VALUES (:order_id, :client_name, :client_email, :responsible, :created_at, :total, :state, :pdf_filename, CAST(:data AS JSONB), :pdf_data, NOW())
-                ON CONFLICT (order_id) DO UPDATE SET
-                  client_name = EXCLUDED.client_name,
-                  client_email = EXCLUDED.client_email,
-                  responsible = EXCLUDED.responsible,
-                  created_at = EXCLUDED.created_at,
-                  total = EXCLUDED.total,
-                  state = EXCLUDED.state,
-                  pdf_filename = EXCLUDED.pdf_filename,
-                  data = EXCLUDED.data,
-                  pdf_data = EXCLUDED.pdf_data,
-                  updated_at = NOW()
-                """
-            ), {**params, "pdf_data": pdf_bytes})
+            sha = _blob_put(run, pdf_bytes)
+            old = run("SELECT pdf_sha256 FROM historial WHERE order_id = :id", {"id": order["order_id"]})
+            _history_upsert_rows(run, use_db, [order], [sha])
+            _blob_release(run, [r["pdf_sha256"] for r in old if r["pdf_sha256"] != sha])
     return True
 
 
-def _sync_history_from_files(force: bool = False):
-    global _HISTORY_SYNCED
-    if _HISTORY_SYNCED and not force:
-        return
-    eng = _get_engine()
-    if not eng:
+def _blob_path(sha: str) -> str:
+    return os.path.join(REMITO_BLOB_DIR, sha[:2], f"{sha}.pdf")
+
+
+def _blob_on_disk() -> bool:
+    return REMITO_BLOB_BACKEND == "disk" or (REMITO_BLOB_BACKEND != "db" and not db_enabled())
+
+
+def _blob_put(run, data: bytes) -> str:
+    """Store a remito once per content; returns its SHA-256. Disk blobs keep only size in the table.
+    The upsert always touches the row, so it stays locked until commit and a concurrent
+    _blob_release of the same content waits instead of deleting it from under us."""
+    sha = hashlib.sha256(data).hexdigest()
+    on_disk = _blob_on_disk()
+    run(
+        """
+        INSERT INTO remito_blobs (sha256, size, data) VALUES (:sha, :size, :data)
+        ON CONFLICT (sha256) DO UPDATE SET size = excluded.size
+        """,
+        {"sha": sha, "size": len(data), "data": None if on_disk else data},
+    )
+    if on_disk:
+        # Written after the row lock is held; removed again if this transaction rolls back
+        path = _blob_path(sha)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _atomic_write(path, data)
+            run.on_rollback.append(lambda: _blob_unlink([sha]))
+    return sha
+
+
+def _blob_release(run, shas) -> None:
+    """Drop blobs no order points to any more. On-disk files are moved aside inside the
+    transaction (restored on rollback) and removed once it commits."""
+    lock = " FOR UPDATE" if run.use_db else ""  # SQLite already serializes writers
+    for sha in sorted({s for s in shas if s}):
+        # Wait for any transaction that is putting the same blob; the DELETE's fresh snapshot then sees its reference
+        if not run(f"SELECT sha256 FROM remito_blobs WHERE sha256 = :sha{lock}", {"sha": sha}):
+            continue
+        rows = run(
+            """
+            DELETE FROM remito_blobs WHERE sha256 = :sha
+              AND NOT EXISTS (SELECT 1 FROM historial WHERE pdf_sha256 = :sha)
+            RETURNING (data IS NULL) AS on_disk
+            """,
+            {"sha": sha},
+        )
+        if rows and rows[0]["on_disk"]:
+            path = _blob_path(sha)
+            try:
+                os.replace(path, path + ".del")
+            except OSError:
+                continue
+            run.on_rollback.append(lambda p=path: os.replace(p + ".del", p))
+            run.on_commit.append(lambda p=path: _remove_quietly(p + ".del"))
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _blob_unlink(shas: list) -> None:
+    for sha in shas:
+        _remove_quietly(_blob_path(sha))
+
+
+class _BlobReader(io.RawIOBase):
+    """Seekable file over a remito_blobs row, fetched _BLOB_CHUNK bytes per query so a
+    download never loads the whole PDF (Range requests seek straight to their offset)."""
+
+    def __init__(self, sha: str, size: int, use_db: bool):
+        self._sha, self._size, self._use_db = sha, size, use_db
+        self._pos = 0
+        self._buf_start, self._buf = 0, b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, b):
+        if self._pos >= self._size:
+            return 0
+        if not (self._buf_start <= self._pos < self._buf_start + len(self._buf)):
+            with _sql_tx(self._use_db, readonly=True) as run:
+                rows = run(
+                    "SELECT substr(data, :start, :n) AS chunk FROM remito_blobs WHERE sha256 = :sha",
+                    {"start": self._pos + 1, "n": _BLOB_CHUNK, "sha": self._sha},
+                )
+            if not rows or rows[0]["chunk"] is None:
+                return 0
+            self._buf_start, self._buf = self._pos, bytes(rows[0]["chunk"])
+        offset = self._pos - self._buf_start
+        n = min(len(b), len(self._buf) - offset)
+        b[:n] = self._buf[offset:offset + n]
+        self._pos += n
+        return n
+
+
+def _parse_order_file(fname: str, raw: bytes) -> dict | None:
+    """Order dict from the contents of orders/<fname>, with the fields the store needs filled in."""
+    try:
+        data = json.loads(raw.decode("utf-8"))
+    except Exception:
+        return None
+    if not isinstance(data, dict):
+        return None
+    order_id = data.get("order_id") or os.path.splitext(fname)[0]
+    data.setdefault("order_id", order_id)
+    data.setdefault("filename", fname)
+    if not data.get("created_at"):
+        data["created_at"] = datetime.now(timezone.utc).isoformat()
+    if not data.get("pdf_filename"):
+        # Legacy orders only have the remito-<id>.pdf naming convention
+        candidate = f"remito-{order_id}.pdf"
+        if os.path.isfile(os.path.join(PDF_DIR, candidate)):
+            data["pdf_filename"] = candidate
+    return data
+
+
+def _manifest_upsert_rows(run, rows: list) -> None:
+    if not rows:
         return
-    if not os.path.isdir(ORDERS_DIR):
-        _HISTORY_SYNCED = True
+    params = {}
+    values = []
+    for i, r in enumerate(rows):
+        params.update({f"path{i}": r["path"], f"mtime{i}": r["mtime"], f"size{i}": r["size"], f"sha{i}": r["sha256"]})
+        values.append(f"(:path{i}, :mtime{i}, :size{i}, :sha{i})")
+    run(
+        f"""
+        INSERT INTO order_file_manifest (path, mtime, size, sha256) VALUES {", ".join(values)}
+        ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, size = excluded.size, sha256 = excluded.sha256
+        """,
+        params,
+    )
+
+
+def _sync_history_from_files(overwrite: bool = False, wait: bool = False) -> int:
+    """Import new or changed orders/*.json files and remitos into the order store (Postgres or local SQLite).
+
+    A manifest of (path, mtime, size, sha256) per file means unchanged files are only stat'ed.
+    A file that changed on disk replaces the stored order. A file the manifest has never seen
+    is imported only if the store lacks that order, because the store is the source of truth;
+    overwrite replaces it anyway. Orders are written in multi-row batches and PDFs are read
+    one at a time. Only one process syncs at a time; unless wait is set, a sync already running
+    elsewhere makes this call return 0 right away. Returns the number of orders written.
+    """
+    if not _HISTORY_SYNC_LOCK.acquire(blocking=wait):
+        return 0
+    try:
+        with _orders_sync_file_lock(wait) as locked:
+            if not locked:
+                return 0
+            return _sync_history_run(overwrite)
+    finally:
+        _HISTORY_SYNC_LOCK.release()
+
+
+@contextmanager
+def _orders_sync_file_lock(wait: bool = False):
+    """Cross-process lock; without wait it yields False when another process is already syncing."""
+    if fcntl is None:
+        yield True
         return
-    for fname in os.listdir(ORDERS_DIR):
-        if not fname.endswith(".json"):
-            continue
-        fpath = os.path.join(ORDERS_DIR, fname)
+    with open(os.path.join(BASE_DIR, "data", "orders_sync.lock"), "a+") as fh:
         try:
-            with open(fpath, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except Exception:
-            continue
-        if not isinstance(data, dict):
-            continue
-        order_id = data.get("order_id") or os.path.splitext(fname)[0]
-        data.setdefault("order_id", order_id)
-        data.setdefault("filename", fname)
-        if not data.get("created_at"):
-            data["created_at"] = datetime.now(timezone.utc).isoformat()
-        pdf_name = data.get("pdf_filename")
-        if not pdf_name:
-            candidate = f"remito-{order_id}.pdf"
-            if os.path.isfile(os.path.join(PDF_DIR, candidate)):
-                pdf_name = candidate
-        pdf_bytes = None
-        if pdf_name:
-            data["pdf_filename"] = pdf_name
-            pdf_path = os.path.join(PDF_DIR, pdf_name)
-            if os.path.isfile(pdf_path):
-                try:
-                    with open(pdf_path, "rb") as pf:
-                        pdf_bytes = pf.read()
-                except Exception:
-                    pdf_bytes = None
+            fcntl.flock(fh, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _sync_history_run(overwrite: bool) -> int:
+    use_db = db_enabled()
+    with _sql_tx(use_db) as run:
+        manifest = {r["path"]: r for r in run("SELECT path, mtime, size, sha256 FROM order_file_manifest")}
+        known = {r["order_id"] for r in run("SELECT order_id FROM historial")}
+
+    def changed(key: str, st, raw: bytes, seen: list) -> bool:
+        """Queue the file's manifest entry; True if its content is new to the store or differs."""
+        prev = manifest.get(key)
+        digest = hashlib.sha256(raw).hexdigest()
+        seen.append({"path": key, "mtime": st.st_mtime, "size": st.st_size, "sha256": digest})
+        return prev is not None and prev["sha256"] != digest
+
+    def unchanged(key: str, st) -> bool:
+        prev = manifest.get(key)
+        return prev is not None and float(prev["mtime"]) == st.st_mtime and int(prev["size"]) == st.st_size
+
+    def flush(orders: dict, seen: list) -> None:
+        with _sql_tx(use_db) as run:
+            batch = list(orders.values())
+            _history_upsert_rows(run, use_db, batch)
+            # Keep the dashboard rollups in step once they have been built
+            if batch and run("SELECT value FROM sales_rollup_meta WHERE name = 'built_at'"):
+                for order in batch:
+                    _sales_rollup_replace(run, order["order_id"], _sales_contribution(order))
+            _manifest_upsert_rows(run, seen)
+        orders.clear()
+        seen.clear()
+
+    written = 0
+    orders, seen = {}, []
+    if os.path.isdir(ORDERS_DIR):
+        for entry in os.scandir(ORDERS_DIR):
+            if not entry.name.endswith(".json") or not entry.is_file():
+                continue
+            key = f"orders/{entry.name}"
+            st = entry.stat()
+            if not overwrite and unchanged(key, st):
+                continue
+            try:
+                with open(entry.path, "rb") as f:
+                    raw = f.read()
+            except OSError:
+                continue
+            modified = changed(key, st, raw, seen)
+            order = _parse_order_file(entry.name, raw)
+            if order is None:
+                continue
+            if overwrite or modified or order["order_id"] not in known:
+                orders[order["order_id"]] = order
+            if len(orders) >= _ORDERS_SYNC_BATCH or len(seen) >= 4 * _ORDERS_SYNC_BATCH:
+                written += len(orders)
+                flush(orders, seen)
+        written += len(orders)
+        flush(orders, seen)
+
+    # Remitos are attached to the order that names them, one file in memory at a time
+    if os.path.isdir(PDF_DIR):
+        with _sql_tx(use_db) as run:
+            owners = {
+                r["pdf_filename"]: bool(r["has_pdf"])
+                for r in run(
+                    "SELECT pdf_filename, (pdf_sha256 IS NOT NULL OR pdf_data IS NOT NULL) AS has_pdf"
+                    " FROM historial WHERE pdf_filename IS NOT NULL"
+                )
+            }
+        for entry in os.scandir(PDF_DIR):
+            if not entry.name.endswith(".pdf") or entry.name not in owners or not entry.is_file():
+                continue
+            key = f"pdfs/{entry.name}"
+            st = entry.stat()
+            if not overwrite and unchanged(key, st):
+                continue
+            try:
+                with open(entry.path, "rb") as f:
+                    raw = f.read()
+            except OSError:
+                continue
+            modified = changed(key, st, raw, seen)
+            with _sql_tx(use_db) as run:
+                if overwrite or modified or not owners[entry.name]:
+                    sha = _blob_put(run, raw)
+                    old = run("SELECT pdf_sha256 FROM historial WHERE pdf_filename = :fn", {"fn": entry.name})
+                    run(
+                        "UPDATE historial SET pdf_sha256 = :sha, pdf_data = NULL WHERE pdf_filename = :fn",
+                        {"sha": sha, "fn": entry.name},
+                    )
+                    _blob_release(run, [r["pdf_sha256"] for r in old if r["pdf_sha256"] != sha])
+                _manifest_upsert_rows(run, seen)
+            seen.clear()
+    return written
+
+
+def _migrate_pdf_blobs() -> int:
+    """Move remitos still stored inline in historial.pdf_data to the blob store, a few rows per transaction."""
+    use_db = db_enabled()
+    moved = 0
+    while True:
+        with _sql_tx(use_db) as run:
+            rows = run("SELECT order_id, pdf_data FROM historial WHERE pdf_data IS NOT NULL LIMIT 20")
+            for r in rows:
+                sha = _blob_put(run, bytes(r["pdf_data"]))
+                run("UPDATE historial SET pdf_sha256 = :sha, pdf_data = NULL WHERE order_id = :id", {"sha": sha, "id": r["order_id"]})
+        if not rows:
+            return moved
+        moved += len(rows)
+
+
+def _history_sync_loop() -> None:
+    try:
+        _migrate_pdf_blobs()
+    except Exception:
+        pass
+    while True:
         try:
-            db_upsert_history(data, pdf_bytes=pdf_bytes)
+            _sync_history_from_files()
         except Exception:
-            continue
-    _HISTORY_SYNCED = True
+            pass
+        if _ORDERS_SYNC_INTERVAL <= 0:
+            return
+        time.sleep(_ORDERS_SYNC_INTERVAL)
 
 
-def db_delete_history(order_id: str):
-    eng = _get_engine()
-    if not eng or not order_id:
-        return False
-    with eng.begin() as conn:
-        conn.execute(_sql_text("DELETE FROM historial WHERE order_id = :order_id"), {"order_id": order_id})
-    return True
+def start_history_sync() -> None:
+    """Run the orders/*.json import in a background thread, once per process (then every
+    ORDERS_SYNC_INTERVAL seconds if set), so no request waits for it."""
+    global _HISTORY_SYNC_THREAD
+    if _HISTORY_SYNC_THREAD is not None or not _ORDERS_SYNC_ON_START:
+        return
+    with _HISTORY_SYNC_START_LOCK:
+        if _HISTORY_SYNC_THREAD is None:
+            _HISTORY_SYNC_THREAD = threading.Thread(target=_history_sync_loop, name="orders-sync", daemon=True)
+            _HISTORY_SYNC_THREAD.start()
 
 
-def db_list_history(q: str = ""):
-    eng = _get_engine()
-    if not eng:
+def _order_from_row(row: dict) -> dict | None:
+    """Order dict from a historial row with order_id, data and state, or None without data."""
+    data = row["data"]
+    if data is None:
         return None
-    params = {}
-    sql = """
-        SELECT order_id, client_name, client_email, responsible, created_at, total, state, pdf_filename, data,
-               (pdf_data IS NOT NULL) AS has_pdf
-        FROM historial
+    if isinstance(data, str):
+        data = json.loads(data)
+    data.setdefault("order_id", row["order_id"])
+    # Pipeline moves only update the state column
+    if row["state"]:
+        data["state"] = row["state"]
+    return data
+
+
+def load_order(order_id: str) -> dict | None:
+    """Full order dict from the order store, or None."""
+    if not order_id:
+        return None
+    with _sql_tx(db_enabled(), readonly=True) as run:
+        rows = run("SELECT order_id, data, state FROM historial WHERE order_id = :id", {"id": order_id})
+    return _order_from_row(rows[0]) if rows else None
+
+
+def save_order(order: dict, pdf_bytes: bytes | None = None) -> None:
+    """Insert or replace an order (and its PDF when given). With ORDERS_JSON_EXPORT the
+    orders/<id>.json copy is written too."""
+    _store_upsert(order, pdf_bytes=pdf_bytes)
+    if ORDERS_JSON_EXPORT:
+        _write_order_file(order)
+
+
+def save_order_pdf(order_id: str, pdf_filename: str, pdf_bytes: bytes) -> None:
+    """Attach the rendered remito to a stored order without rewriting the order data."""
+    with _sql_tx(db_enabled()) as run:
+        sha = _blob_put(run, pdf_bytes)
+        old = run("SELECT pdf_sha256 FROM historial WHERE order_id = :id", {"id": order_id})
+        run(
+            "UPDATE historial SET pdf_filename = :fn, pdf_sha256 = :sha, pdf_data = NULL WHERE order_id = :id",
+            {"fn": pdf_filename, "sha": sha, "id": order_id},
+        )
+        _blob_release(run, [r["pdf_sha256"] for r in old if r["pdf_sha256"] != sha])
+
+
+PIPELINE_STATES = ("Pedido", "Enviado", "Entregado (A cobrar)", "Cobrado")
+
+
+def set_order_states(moves: list, changed_by: str | None = None) -> list:
+    """Move orders between pipeline states in one transaction.
+
+    moves: [(order_id, state, expected_version or None)]. Each move is a single-column UPDATE of
+    historial.state guarded by the row version (optimistic concurrency) plus one historial_state_log
+    row; the order data and its remito are not read or rewritten. Returns one result per move:
+    {"order_id", "ok", "version", "state"} or {"order_id", "ok": False, "error": "missing"|"conflict"}.
     """
+    use_db = db_enabled()
+    now = datetime.now(timezone.utc) if use_db else datetime.now(timezone.utc).isoformat()
+    results = []
+    with _sql_tx(use_db) as run:
+        for order_id, state, expected in moves:
+            cur = run("SELECT state, version FROM historial WHERE order_id = :id", {"id": order_id})
+            if not cur:
+                results.append({"order_id": order_id, "ok": False, "error": "missing"})
+                continue
+            version = int(cur[0]["version"] or 0)
+            if expected is not None and int(expected) != version:
+                results.append({"order_id": order_id, "ok": False, "error": "conflict", "version": version})
+                continue
+            if cur[0]["state"] == state:
+                results.append({"order_id": order_id, "ok": True, "version": version, "state": state})
+                continue
+            updated = run(
+                """
+                UPDATE historial SET state = :state, version = version + 1, updated_at = :now
+                WHERE order_id = :id AND version = :version RETURNING version
+                """,
+                {"state": state, "now": now, "id": order_id, "version": version},
+            )
+            if not updated:
+                # Changed by someone else between the read and the update
+                results.append({"order_id": order_id, "ok": False, "error": "conflict"})
+                continue
+            new_version = int(updated[0]["version"])
+            run(
+                """
+                INSERT INTO historial_state_log (order_id, version, from_state, to_state, changed_at, changed_by)
+                VALUES (:id, :version, :from_state, :to_state, :now, :by)
+                """,
+                {"id": order_id, "version": new_version, "from_state": cur[0]["state"], "to_state": state, "now": now, "by": changed_by},
+            )
+            results.append({"order_id": order_id, "ok": True, "version": new_version, "state": state})
+    if ORDERS_JSON_EXPORT:
+        for r in results:
+            if r["ok"]:
+                _write_order_file(load_order(r["order_id"]))
+    return results
+
+
+def set_order_state(order_id: str, state: str, version: int | None = None, changed_by: str | None = None) -> dict:
+    return set_order_states([(order_id, state, version)], changed_by=changed_by)[0]
+
+
+def order_state_log(order_id: str) -> list:
+    """State transitions of an order, oldest first (changed_display: dd/mm/YYYY HH:MM UTC)."""
+    with _sql_tx(db_enabled(), readonly=True) as run:
+        rows = run(
+            "SELECT version, from_state, to_state, changed_at, changed_by FROM historial_state_log WHERE order_id = :id ORDER BY version",
+            {"id": order_id},
+        )
+    for r in rows:
+        r["changed_display"] = _parse_dt(r["changed_at"]).strftime("%d/%m/%Y %H:%M")
+    return rows
+
+
+def delete_order(order_id: str) -> None:
+    """Remove the order from the store (and its remito blob if no other order shares it) and its JSON export, if any.
+    Its state log goes too: a later order reusing the id starts again at version 1."""
+    with _sql_tx(db_enabled()) as run:
+        rows = run("DELETE FROM historial WHERE order_id = :id RETURNING pdf_sha256", {"id": order_id})
+        run("DELETE FROM historial_state_log WHERE order_id = :id", {"id": order_id})
+        _blob_release(run, [r["pdf_sha256"] for r in rows])
+    try:
+        os.remove(os.path.join(ORDERS_DIR, f"{order_id}.json"))
+    except OSError:
+        pass
+
+
+def _history_cursor(created_at, order_id) -> str:
+    """Opaque keyset cursor for a listing row: "<created_at iso>|<order_id>"."""
+    ts = created_at.isoformat() if isinstance(created_at, datetime) else str(created_at or "")
+    return f"{ts}|{order_id}"
+
+
+def _parse_history_cursor(cursor: str | None):
+    if not cursor or "|" not in cursor:
+        return None
+    ts, order_id = cursor.rsplit("|", 1)
+    return ts, order_id
+
+
+def list_orders(q: str = "", limit: int | None = None, before: str | None = None, after: str | None = None):
+    """History rows newest first, without the order data blob, from Postgres or the local store.
+
+    limit/before/after give keyset pagination on (created_at, order_id): "before" returns the page
+    of older rows after that cursor, "after" the page of newer rows preceding it. Returns a list, or
+    (rows, has_more) when limit is given.
+    """
+    use_db = db_enabled()
+    params = {}
+    where = []
     q = (q or "").strip()
     if q:
-        sql += " WHERE lower(client_name) LIKE :q"
+        # Postgres: served by the pg_trgm index on lower(client_name) when the extension is available;
+        # otherwise (and on SQLite) a scan
+        where.append("lower(client_name) LIKE :q")
         params["q"] = f"%{q.lower()}%"
-    sql += " ORDER BY created_at DESC, order_id DESC"
-    with eng.begin() as conn:
-        rows = conn.execute(_sql_text(sql), params).mappings().all()
+    newer_first = True
+    # The local store keeps created_at as ISO text, which compares in date order
+    cursor_ts = "CAST(:c_ts AS TIMESTAMPTZ)" if use_db else ":c_ts"
+    cursor = _parse_history_cursor(after) or _parse_history_cursor(before)
+    if cursor:
+        params["c_ts"], params["c_id"] = cursor
+        if _parse_history_cursor(after):
+            where.append(f"(created_at, order_id) > ({cursor_ts}, :c_id)")
+            newer_first = False
+        else:
+            where.append(f"(created_at, order_id) < ({cursor_ts}, :c_id)")
+    field = (lambda k: f"data->>'{k}'") if use_db else (lambda k: f"json_extract(data, '$.{k}')")
+    sql = f"""
+        SELECT order_id, client_name, client_email, responsible, created_at, total,
+               coalesce(state, {field('state')}) AS state,
+               coalesce(pdf_filename, {field('pdf_filename')}, 'remito-' || order_id || '.pdf') AS pdf_filename,
+               coalesce({field('filename')}, order_id || '.json') AS filename,
+               (pdf_sha256 IS NOT NULL OR pdf_data IS NOT NULL) AS has_pdf, version
+        FROM historial
+    """
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, order_id DESC" if newer_first else " ORDER BY created_at ASC, order_id ASC"
+    if limit is not None:
+        sql += " LIMIT :limit"
+        params["limit"] = int(limit) + 1
+    with _sql_tx(use_db, readonly=True) as run:
+        rows = run(sql, params)
+    has_more = limit is not None and len(rows) > limit
+    if has_more:
+        rows = rows[:limit]
+    if not newer_first:
+        rows = list(reversed(rows))
     result = []
     for r in rows:
-        data_obj = r.get("data")
-        if isinstance(data_obj, str):
-            try:
-                data_obj = json.loads(data_obj)
-            except Exception:
-                data_obj = {}
-        data_obj = data_obj or {}
         created_at = r.get("created_at")
         if isinstance(created_at, datetime):
             try:
@@ -369,23 +1356,10 @@ def db_list_history(q: str = ""):
             except Exception:
                 created_display = created_at.strftime("%d/%m/%Y")
         else:
-            created_display = ""
-        pdf_name = r.get("pdf_filename") or data_obj.get("pdf_filename")
-        if not pdf_name:
-            legacy = f"remito-{r.get('order_id')}.pdf"
-            pdf_name = legacy
-        if pdf_name:
-            pdf_path = os.path.join(PDF_DIR, pdf_name)
-            if not os.path.exists(pdf_path):
-                # keep link if DB has the PDF content
-                has_pdf = bool(r.get("has_pdf"))
-                if not has_pdf:
-                    pdf_name = None
-        filename = data_obj.get("filename") or f"{r.get('order_id')}.json"
-        if filename:
-            file_path = os.path.join(ORDERS_DIR, filename)
-            if not os.path.exists(file_path):
-                filename = filename  # keep reference even if missing
+            try:
+                created_display = datetime.fromisoformat(str(created_at).replace("Z", "+00:00")).strftime("%d/%m/%Y")
+            except Exception:
+                created_display = str(created_at or "")[:10]
         result.append({
             "order_id": r.get("order_id"),
             "created_at": created_at.isoformat() if isinstance(created_at, datetime) else str(created_at or ""),
@@ -393,13 +1367,36 @@ def db_list_history(q: str = ""):
             "client_name": r.get("client_name"),
             "responsible": r.get("responsible"),
             "total": float(r.get("total") or 0),
-            "pdf_name": pdf_name,
-            "filename": filename,
-            "state": r.get("state") or data_obj.get("state"),
-            "items": data_obj.get("items") if isinstance(data_obj, dict) else None,
+            # The remito is in the store (blob or not yet migrated bytes), so no filesystem check is needed
+            "pdf_name": r.get("pdf_filename") if r.get("has_pdf") else None,
+            "filename": r.get("filename"),
+            "state": r.get("state"),
+            "version": int(r.get("version") or 0),
+            "cursor": _history_cursor(created_at, r.get("order_id")),
         })
+    if limit is not None:
+        return result, has_more
     return result
 
+
+@app.cli.command("import-orders")
+@click.option("--overwrite", is_flag=True, help="Reemplazar pedidos que ya están en la base.")
+def import_orders_command(overwrite):
+    """Import new or changed orders/*.json files (and their remitos) into the order store."""
+    n = _sync_history_from_files(overwrite=overwrite, wait=True)
+    print(f"{n} pedidos importados")
+
+
+@app.cli.command("export-orders")
+def export_orders_command():
+    """Write every stored order to orders/<id>.json."""
+    with _sql_tx(db_enabled(), readonly=True) as run:
+        rows = run("SELECT order_id, data, state FROM historial WHERE data IS NOT NULL")
+    for r in rows:
+        _write_order_file(_order_from_row(r))
+    print(f"{len(rows)} pedidos exportados")
+
+
 def load_clients():
     if not os.path.exists(CLIENTS_PATH):
         return []
@@ -427,6 +1424,12 @@ ALLOWED_USERS = {
 }
 
 
+@app.before_request
+def start_background_sync():
+    # orders/*.json import runs off the request path; no-op after the first request
+    start_history_sync()
+
+
 @app.before_request
 def require_login():
     # Allow access to login page and static files without authentication
@@ -436,6 +1439,19 @@ def require_login():
         return redirect(url_for("login"))
 
 
+@app.errorhandler(DatabaseUnavailable)
+def database_unavailable(e):
+    # No local fallback with DATABASE_URL set: tell the client to retry instead
+    msg = "La base de datos no está disponible en este momento. Reintente en unos minutos."
+    if request.path.startswith("/api/") or "application/json" in request.headers.get("Accept", ""):
+        resp = jsonify({"ok": False, "error": msg})
+    else:
+        resp = app.response_class(msg, mimetype="text/plain")
+    resp.status_code = 503
+    resp.headers["Retry-After"] = "30"
+    return resp
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
@@ -457,11 +1473,12 @@ def logout():
     return redirect(url_for("login"))
 
 
-def load_products(sheet_name: str = "generales") -> pd.DataFrame:
+def load_products(sheet_name: str = "generales", fallback_local: bool = True) -> pd.DataFrame:
     """Load products either from remote URL or local CSV. Expected columns: name, cost, vencimiento
-    sheet_name: 'generales' or 'ansioliticos'"""
+    sheet_name: 'generales' or 'ansioliticos'
+    fallback_local: when False, download errors are raised instead of falling back to the local CSV"""
     if REMOTE_CSV_URL:
-        df = pd.read_csv(REMOTE_CSV_URL)
+        return _load_remote_products(REMOTE_CSV_URL)
     elif GOOGLE_SHEETS_URL:
         # Convert a Google Sheets edit URL to a CSV export URL using sheet name
         try:
@@ -480,164 +1497,852 @@ def load_products(sheet_name: str = "generales") -> pd.DataFrame:
                     "ansioliticos": gid_ansioliticos,
                 }
                 gid = sheet_gid_map.get(sheet_name, gid_generales)
-                # Google Sheets CSV export by gid
-                # Add cache-busting param to avoid stale proxies/browsers
-                import time as _time
-                export_url = f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=csv&gid={gid}&cachebust={int(_time.time())}"
-                df = pd.read_csv(export_url)
+                # Google Sheets CSV export by gid (freshness is handled by conditional requests)
+                export_url = f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=csv&gid={gid}"
+                return _load_remote_products(export_url)
             else:
                 # Fallback: try direct
-                df = pd.read_csv(url)
+                return _load_remote_products(url)
         except Exception:
+            if not fallback_local:
+                raise
             # Fallback to local if conversion fails
-            if not os.path.exists(DATA_CSV_PATH):
-                return pd.DataFrame(columns=["name", "cost", "vencimiento"]).astype({"name": str, "cost": float, "vencimiento": str})
-            df = pd.read_csv(DATA_CSV_PATH)
+            return _load_local_products()
     else:
-        if not os.path.exists(DATA_CSV_PATH):
-            return pd.DataFrame(columns=["name", "cost", "vencimiento"]).astype({"name": str, "cost": float, "vencimiento": str})
-        df = pd.read_csv(DATA_CSV_PATH)
-    # Normalize columns in case of mixed names
-    # First, try to detect column names by checking all columns (case-insensitive)
-    cols_lower = {str(c).lower().strip(): c for c in df.columns}
-    def _has_known_headers(cl: dict[str, str]) -> bool:
-        keys = set(cl.keys())
-        name_keys = {"name", "producto", "product", "nombre", "descripcion", "descripción"}
-        cost_keys = {"cost", "precio", "costo", "price", "-3%", "- 3%"}
-        venc_keys = {"vencimiento", "fecha vencimiento", "fecha_vencimiento", "fecha vencimeinto", "vto", "fecha vto", "venc", "fecha"}
-        return len(keys.intersection(name_keys)) > 0 or len(keys.intersection(cost_keys)) > 0 or len(keys.intersection(venc_keys)) > 0
-    # If no recognizable headers exist, assume first row is data that was used as header -> prepend it back
-    if not _has_known_headers(cols_lower) and len(df.columns) > 0:
+        return _load_local_products()
+
+
+def _load_local_products() -> pd.DataFrame:
+    if not os.path.exists(DATA_CSV_PATH):
+        return _empty_products_frame()
+    digest = hashlib.sha256()
+    with open(DATA_CSV_PATH, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    df = _ingest_products_csv(DATA_CSV_PATH)
+    df.attrs["source_sha256"] = digest.hexdigest()
+    return df
+
+
+def _fetch_csv(url: str) -> tuple[bytes | None, bool]:
+    """Fetch a CSV export sending If-None-Match/If-Modified-Since from the previous download.
+    Returns (body, changed); changed is False on 304 (body None) or when the bytes hash to the same content.
+    Only the validators, the hash and the parsed frame are kept between fetches, never the raw bytes."""
+    entry = _CSV_FETCH_CACHE.get(url) or {}
+    headers = {"Cache-Control": "no-cache"}
+    # A 304 is only useful while the parsed frame for those bytes is still around
+    if entry.get("df") is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=_CSV_FETCH_TIMEOUT) as resp:
+            body = resp.read()
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry.get("df") is not None:
+            entry["fetched_at"] = time.time()
+            return None, False
+        raise
+    digest = hashlib.sha256(body).hexdigest()
+    changed = entry.get("sha256") != digest
+    _CSV_FETCH_CACHE[url] = {
+        "etag": etag,
+        "last_modified": last_modified,
+        "sha256": digest,
+        "fetched_at": time.time(),
+        # keep the normalized frame only while the bytes stay identical
+        "df": None if changed else entry.get("df"),
+    }
+    return body, changed
+
+
+def _load_remote_products(url: str) -> pd.DataFrame:
+    body, changed = _fetch_csv(url)
+    entry = _CSV_FETCH_CACHE[url]
+    if not changed and entry.get("df") is not None:
+        return entry["df"]
+    df = _ingest_products_csv(body)
+    # Lets the refresh tell an unchanged sheet apart across workers, which don't share this cache
+    df.attrs["source_sha256"] = entry["sha256"]
+    entry["df"] = df
+    return df
+
+
+# Header aliases recognized in the sheets (lowercase, stripped)
+_NAME_HEADER_KEYS = ["name", "producto", "product", "nombre", "descripcion", "descripción"]
+_COST_HEADER_KEYS = ["cost", "precio", "costo", "price", "-3%", "- 3%"]
+_VENC_HEADER_KEYS = ["vencimiento", "fecha vencimiento", "fecha_vencimiento", "fecha vencimeinto", "vto", "fecha vto", "venc", "fecha"]
+_KNOWN_HEADER_KEYS = set(_NAME_HEADER_KEYS) | set(_COST_HEADER_KEYS) | set(_VENC_HEADER_KEYS)
+# Optional explicit product code; when present it is used as the stable cart key
+_SKU_HEADER_KEYS = ["sku", "codigo", "código", "cod", "cod.", "code", "ean"]
+_PRODUCT_COLUMNS = ["id", "name", "name_lc", "cost", "vencimiento", "sku"]
+
+# Cost parsing: keep digits, separators and sign; with a comma, '.' followed by 3 digits is a thousands separator
+_COST_STRIP_RE = re.compile(r"[^0-9,.-]")
+_COST_THOUSANDS_RE = re.compile(r"\.(?=\d{3}(\D|$))")
+
+
+def _empty_products_frame() -> pd.DataFrame:
+    return pd.DataFrame(columns=_PRODUCT_COLUMNS).astype({"id": int, "name": str, "name_lc": str, "cost": float, "vencimiento": str, "sku": str})
+
+
+def _detect_product_columns(labels: list) -> tuple[bool, int | None, int | None, int | None, int | None]:
+    """Locate name/cost/vencimiento (and an optional SKU) by position from the raw header labels.
+    Returns (has_header, name_pos, cost_pos, venc_pos, sku_pos). Without any recognizable header
+    the first row is data, and the columns are taken as A=name, B=cost, C=vencimiento."""
+    lowered = [str(c).lower().strip() for c in labels]
+    has_header = bool(_KNOWN_HEADER_KEYS.intersection(lowered))
+    ncols = len(lowered)
+    if not has_header:
+        return False, (0 if ncols > 0 else None), (1 if ncols > 1 else None), (2 if ncols > 2 else None), None
+    # Last occurrence wins for duplicated labels
+    positions = {label: pos for pos, label in enumerate(lowered)}
+
+    def _find(keys):
+        for key in keys:
+            if key in positions:
+                return positions[key]
+        return None
+
+    name_pos = _find(_NAME_HEADER_KEYS)
+    if name_pos is None and ncols > 0:
+        name_pos = 0
+    cost_pos = _find(_COST_HEADER_KEYS)
+    if cost_pos is None and ncols > 1:
+        cost_pos = 1
+    venc_pos = _find(_VENC_HEADER_KEYS)
+    if venc_pos is None:
+        venc_pos = next((pos for pos, lc in enumerate(lowered) if ("venc" in lc) or ("vto" in lc) or ("fecha" in lc)), None)
+    if venc_pos is None and ncols > 2:
+        venc_pos = 2
+    sku_pos = _find(_SKU_HEADER_KEYS)
+    if sku_pos in (name_pos, cost_pos, venc_pos):
+        sku_pos = None
+    return True, name_pos, cost_pos, venc_pos, sku_pos
+
+
+def _parse_cost(raw: str) -> float:
+    """'$ 1.234,56' -> 1234.56; invalid or missing costs become 0.0."""
+    if not isinstance(raw, str):
+        return 0.0
+    text = _COST_STRIP_RE.sub("", raw)
+    if "," in text:
+        text = _COST_THOUSANDS_RE.sub("", text).replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return 0.0
+
+
+def _parse_cost_column(raw: pd.Series) -> np.ndarray:
+    # Price lists repeat a lot of values: parse each distinct string once and broadcast back
+    codes, uniques = pd.factorize(raw.astype(str), use_na_sentinel=False)
+    parsed = np.fromiter((_parse_cost(u) for u in uniques), dtype=np.float64, count=len(uniques))
+    return parsed[codes]
+
+
+def _normalize_product_chunk(names: pd.Series, costs: pd.Series | None, vencs: pd.Series | None, skus: pd.Series | None = None) -> tuple:
+    """Normalize raw name/cost/vencimiento/sku columns into (names, costs, vencimientos, skus) arrays."""
+    names = names.astype(str).str.strip()
+    # Remove rows where name is empty after stripping (keep items even if cost is 0)
+    keep = (names != "").to_numpy()
+    names = names[keep]
+    n = len(names)
+    cost = _parse_cost_column(costs[keep]) if costs is not None else np.zeros(n, dtype=np.float64)
+    venc = vencs[keep].fillna("").astype(str) if vencs is not None else pd.Series([""] * n, dtype=object)
+    sku = skus[keep].fillna("").astype(str).str.strip() if skus is not None else pd.Series([""] * n, dtype=object)
+    # Interning collapses repeated vencimientos (and duplicated names) to a single string object
+    return (
+        np.array([sys.intern(v) for v in names], dtype=object),
+        cost,
+        np.array([sys.intern(v) for v in venc], dtype=object),
+        sku.to_numpy(dtype=object),
+    )
+
+
+def _current_rss_mb() -> float | None:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except Exception:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is the peak so far (KiB on Linux, bytes on macOS); good enough as an upper bound
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _count_csv_lines(source) -> int:
+    """Upper bound on the rows in a CSV: LF, CRLF and CR-only (old Mac / some Excel exports) line ends."""
+    if isinstance(source, bytes):
+        return max(source.count(b"\n"), source.count(b"\r")) + 1
+    lf = cr = 0
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            lf += block.count(b"\n")
+            cr += block.count(b"\r")
+    return max(lf, cr) + 1
+
+
+def _ingest_products_csv(source) -> pd.DataFrame:
+    """Parse a CSV export (raw bytes or a file path) into id, name, name_lc, cost, vencimiento.
+
+    Only the three detected columns are parsed, in chunks of _PRODUCTS_INGEST_CHUNKSIZE rows.
+    Each chunk is normalized and copied into columns preallocated from the line count, so
+    the raw sheet is never held as a full DataFrame. Process RSS is sampled per chunk and the
+    load is aborted with MemoryError above PRODUCTS_INGEST_MAX_RSS_MB. Stats end up in df.attrs["ingest"].
+    """
+    def _open():
+        return BytesIO(source) if isinstance(source, bytes) else source
+
+    labels = list(pd.read_csv(_open(), nrows=0).columns)
+    has_header, name_pos, cost_pos, venc_pos, sku_pos = _detect_product_columns(labels)
+    if name_pos is None:
+        return _empty_products_frame()
+    usecols = sorted({pos for pos in (name_pos, cost_pos, venc_pos, sku_pos) if pos is not None})
+    capacity = _count_csv_lines(source)
+    names = np.empty(capacity, dtype=object)
+    costs = np.empty(capacity, dtype=np.float64)
+    vencs = np.empty(capacity, dtype=object)
+    skus = np.empty(capacity, dtype=object)
+    filled = 0
+    chunks = 0
+    peak_rss = _current_rss_mb()
+    # Without recognizable headers the first row is data (columns A/B/C)
+    reader = pd.read_csv(
+        _open(),
+        header=None,
+        skiprows=1 if has_header else 0,
+        usecols=usecols,
+        # names and vencimientos stay as written; costs keep numeric inference for _parse_cost
+        dtype={pos: str for pos in (name_pos, venc_pos, sku_pos) if pos is not None and pos != cost_pos},
+        chunksize=_PRODUCTS_INGEST_CHUNKSIZE or None,
+    )
+    for chunk in ([reader] if isinstance(reader, pd.DataFrame) else reader):
+        chunk_names, chunk_costs, chunk_vencs, chunk_skus = _normalize_product_chunk(
+            chunk[name_pos],
+            chunk[cost_pos] if cost_pos is not None else None,
+            chunk[venc_pos] if venc_pos is not None else None,
+            chunk[sku_pos] if sku_pos is not None else None,
+        )
+        k = len(chunk_names)
+        if filled + k > len(names):
+            # The line count is only an estimate; grow instead of failing the load
+            grow = max(filled + k, 2 * len(names))
+            names, costs, vencs, skus = (np.resize(a, grow) for a in (names, costs, vencs, skus))
+        names[filled:filled + k] = chunk_names
+        costs[filled:filled + k] = chunk_costs
+        vencs[filled:filled + k] = chunk_vencs
+        skus[filled:filled + k] = chunk_skus
+        filled += k
+        chunks += 1
+        del chunk
+        rss = _current_rss_mb()
+        if rss is not None:
+            peak_rss = max(peak_rss or 0.0, rss)
+            if _PRODUCTS_INGEST_MAX_RSS_MB and rss > _PRODUCTS_INGEST_MAX_RSS_MB:
+                raise MemoryError(f"catalog ingest exceeded {_PRODUCTS_INGEST_MAX_RSS_MB} MB RSS ({rss:.0f} MB after {filled} rows)")
+    if filled == 0:
+        return _empty_products_frame()
+    names = names[:filled]
+    df = pd.DataFrame({
+        "id": np.arange(filled, dtype=np.int64),
+        "name": names,
+        # normalized name for quick case-insensitive filtering
+        "name_lc": pd.Series(names, dtype=object).str.lower().to_numpy(),
+        "cost": costs[:filled],
+        "vencimiento": vencs[:filled],
+        "sku": skus[:filled],
+    })
+    df.attrs["ingest"] = {
+        "rows": filled,
+        "chunks": chunks,
+        "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+    }
+    return df
+
+
+_FUZZY_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+# Minimum trigram (Dice) similarity for a word to count as a typo-tolerant match
+_FUZZY_MIN_SIMILARITY = float(os.environ.get("PRODUCTS_FUZZY_MIN_SIMILARITY", "0.45"))
+
+
+def _fold_text(text: str) -> str:
+    """Lowercase and strip accents: 'Clonazepám' -> 'clonazepam'."""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def _word_trigrams(word: str) -> set:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProductSearchIndex:
+    """N-gram postings (1 to 3 characters) over the lowercase product names of one catalog version.
+
+    The query is split on whitespace and every token must be a literal substring of the
+    name (AND), so "alprazolam denver" also finds "ALPRAZOLAM 0.5 MG ... DENVER". Matching is
+    literal: the old str.contains treated the query as a regex ("0.5" also matched "0x5",
+    "(" raised), which is no longer the case. Tokens of up to three
+    characters are answered straight from their postings; longer tokens intersect their
+    trigram postings and confirm the substring on the few remaining candidates.
+    Results keep catalog order.
+    """
+
+    __slots__ = ("names", "postings", "vocab", "vocab_sorted", "word_rows", "row_words", "word_grams", "word_gram_count")
+
+    # Once the candidate set is this small, checking substrings directly is cheaper than intersecting
+    _VERIFY_THRESHOLD = 64
+
+    def __init__(self, names):
+        self.names = [str(n) for n in names]
+        postings = {}
+        for i, name in enumerate(self.names):
+            grams = set(name)
+            grams.update(name[j:j + 2] for j in range(len(name) - 1))
+            grams.update(name[j:j + 3] for j in range(len(name) - 2))
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        self.postings = postings
+        # Word-level structures for fuzzy search: accent-folded vocabulary, rows per word and
+        # padded trigram postings per word (the vocabulary is much smaller than the catalog)
+        word_ids = {}
+        word_rows = []
+        row_words = []
+        for i, name in enumerate(self.names):
+            wids = []
+            for word in set(_FUZZY_TOKEN_RE.findall(_fold_text(name))):
+                wid = word_ids.get(word)
+                if wid is None:
+                    wid = word_ids[word] = len(word_rows)
+                    word_rows.append([])
+                word_rows[wid].append(i)
+                wids.append(wid)
+            row_words.append(tuple(wids))
+        self.vocab = list(word_ids)
+        self.vocab_sorted = sorted(word_ids.items())
+        self.word_rows = word_rows
+        self.row_words = row_words
+        word_grams = {}
+        gram_count = []
+        for wid, word in enumerate(self.vocab):
+            grams = _word_trigrams(word)
+            gram_count.append(len(grams))
+            for gram in grams:
+                word_grams.setdefault(gram, []).append(wid)
+        self.word_grams = word_grams
+        self.word_gram_count = gram_count
+
+    def _grams(self, tok: str) -> list:
+        if len(tok) <= 3:
+            return [self.postings.get(tok, ())]
+        return sorted((self.postings.get(tok[j:j + 3], ()) for j in range(len(tok) - 2)), key=len)
+
+    def search(self, q: str) -> list[int]:
+        tokens = list(dict.fromkeys((q or "").lower().split()))
+        if not tokens:
+            return list(range(len(self.names)))
+        names = self.names
+        # Most selective token first, so later tokens only filter a small set
+        plans = sorted(((tok, self._grams(tok)) for tok in tokens), key=lambda tp: len(tp[1][0]))
+        result = None
+        for tok, grams in plans:
+            if result is not None and len(result) <= self._VERIFY_THRESHOLD:
+                result = {i for i in result if tok in names[i]}
+            elif len(tok) <= 3:
+                result = set(grams[0]) if result is None else result.intersection(grams[0])
+            else:
+                candidates = result
+                for posting in grams:
+                    candidates = set(posting) if candidates is None else candidates.intersection(posting)
+                    if len(candidates) <= self._VERIFY_THRESHOLD:
+                        break
+                result = {i for i in candidates if tok in names[i]}
+            if not result:
+                return []
+        return sorted(result)
+
+    def _match_words(self, tok: str) -> dict:
+        """Vocabulary words matching one folded query token -> (kind, similarity).
+        kind 2: the word starts with the token, 1: contains it, 0: trigram similarity only."""
+        matches = {}
+        lo = bisect.bisect_left(self.vocab_sorted, (tok,))
+        for word, wid in self.vocab_sorted[lo:]:
+            if not word.startswith(tok):
+                break
+            matches[wid] = (2, 1.0 if word == tok else 0.95)
+        if len(tok) < 3:
+            return matches
+        tok_grams = _word_trigrams(tok)
+        shared = {}
+        for gram in tok_grams:
+            for wid in self.word_grams.get(gram, ()):
+                shared[wid] = shared.get(wid, 0) + 1
+        for wid, count in shared.items():
+            if wid in matches:
+                continue
+            similarity = 2.0 * count / (len(tok_grams) + self.word_gram_count[wid])
+            if tok in self.vocab[wid]:
+                matches[wid] = (1, max(similarity, 0.9))
+            elif similarity >= _FUZZY_MIN_SIMILARITY:
+                matches[wid] = (0, similarity)
+        return matches
+
+    def _expand_rows(self, word_matches: dict) -> dict:
+        best = {}
+        for wid, hit in word_matches.items():
+            for row in self.word_rows[wid]:
+                if row not in best or hit > best[row]:
+                    best[row] = hit
+        return best
+
+    def search_fuzzy(self, q: str) -> list[int]:
+        """Accent- and typo-tolerant search, ranked by relevance.
+
+        Rows where every token is a word prefix come first, then rows where every token
+        is contained in a word, then trigram-similar matches ("alprazolan" finds
+        "alprazolam"). Within a tier rows are ordered by similarity, then catalog order.
+        Rows must match all tokens; if none do, rows matching any token are returned.
+        """
+        tokens = list(dict.fromkeys(_FUZZY_TOKEN_RE.findall(_fold_text(q or ""))))
+        if not tokens:
+            return list(range(len(self.names)))
+        matches = [self._match_words(tok) for tok in tokens]
+        # Expand the most selective token into rows, then only check the remaining
+        # tokens against the words of those candidate rows
+        order = sorted(range(len(tokens)), key=lambda k: sum(len(self.word_rows[wid]) for wid in matches[k]))
+        per_token = [None] * len(tokens)
+        per_token[order[0]] = self._expand_rows(matches[order[0]])
+        rows = set(per_token[order[0]])
+        for k in order[1:]:
+            token_matches = matches[k]
+            best = {}
+            for row in rows:
+                for wid in self.row_words[row]:
+                    hit = token_matches.get(wid)
+                    if hit is not None and (row not in best or hit > best[row]):
+                        best[row] = hit
+            per_token[k] = best
+            rows = set(best)
+        if not rows:
+            per_token = [self._expand_rows(token_matches) for token_matches in matches]
+            rows = set().union(*per_token)
+        scored = []
+        for row in rows:
+            hits = [best[row] for best in per_token if row in best]
+            tier = min(kind for kind, _ in hits) if len(hits) == len(tokens) else -1
+            scored.append((-tier, -sum(similarity for _, similarity in hits), row))
+        scored.sort()
+        return [row for _, _, row in scored]
+
+
+def _product_key(sheet_name: str, *parts) -> str:
+    """Stable product key: short hash of the sheet plus the whitespace/case-normalized parts."""
+    text = "|".join([sheet_name] + [" ".join(str(p).lower().split()) for p in parts])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+class ProductRow:
+    """Read-only view of one row of a ProductStore."""
+
+    __slots__ = ("store", "pos")
+
+    def __init__(self, store: "ProductStore", pos: int):
+        self.store = store
+        self.pos = pos
+
+    @property
+    def id(self) -> int:
+        return int(self.store.ids[self.pos])
+
+    @property
+    def name(self) -> str:
+        return self.store.names[self.pos]
+
+    @property
+    def cost(self) -> float:
+        return float(self.store.cost[self.pos])
+
+    @property
+    def vencimiento(self) -> str:
+        return self.store.vencimientos[self.pos]
+
+    @property
+    def key(self) -> str:
+        return self.store.keys[self.pos]
+
+
+class ProductStore:
+    """Compact, array-backed catalog for one version: NumPy arrays for id and cost, interned
+    name/vencimiento strings. Built once per version so request handlers can page, price and
+    serialize rows without touching the DataFrame.
+
+    Rows also get a stable key that survives rows being inserted or reordered in the sheet
+    (unlike the positional id). The key is the SKU column when the sheet has one, else a
+    hash of sheet + name. Names repeated in the sheet (same product, different lot) hash
+    sheet + name + vencimiento, and exact duplicates get a -2, -3... suffix.
+    """
+
+    __slots__ = ("sheet", "ids", "names", "cost", "vencimientos", "keys", "_pos_by_id", "_pos_by_key")
+
+    def __init__(self, df: pd.DataFrame, sheet_name: str = "generales"):
+        self.sheet = sheet_name
+        self.ids = df["id"].to_numpy(dtype=np.int64)
+        self.names = [sys.intern(str(v)) for v in df["name"]]
+        self.cost = df["cost"].to_numpy(dtype=np.float64)
+        self.vencimientos = [sys.intern(str(v)) for v in df["vencimiento"]]
+        self._pos_by_id = {int(pid): pos for pos, pid in enumerate(self.ids)}
+        skus = df["sku"].tolist() if "sku" in df.columns else [""] * len(self.names)
+        name_counts = {}
+        for name in df["name_lc"]:
+            name_counts[name] = name_counts.get(name, 0) + 1
+        keys = []
+        pos_by_key = {}
+        for pos, (name_lc, sku) in enumerate(zip(df["name_lc"], skus)):
+            if sku:
+                key = f"sku:{sku}"
+            elif name_counts[name_lc] > 1:
+                key = _product_key(sheet_name, name_lc, self.vencimientos[pos])
+            else:
+                key = _product_key(sheet_name, name_lc)
+            base, n = key, 1
+            while key in pos_by_key:
+                n += 1
+                key = f"{base}-{n}"
+            pos_by_key[key] = pos
+            keys.append(key)
+        self.keys = keys
+        self._pos_by_key = pos_by_key
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get(self, pid: int) -> ProductRow | None:
+        pos = self._pos_by_id.get(pid)
+        return ProductRow(self, pos) if pos is not None else None
+
+    def get_by_key(self, key: str) -> ProductRow | None:
+        pos = self._pos_by_key.get(key)
+        return ProductRow(self, pos) if pos is not None else None
+
+    def has_key(self, key: str) -> bool:
+        return key in self._pos_by_key
+
+    def lookup(self, refs) -> np.ndarray:
+        """Row positions for many (key, id) references in one pass; the key wins and the id is the
+        fallback. Unknown references get -1."""
+        by_key = self._pos_by_key
+        by_id = self._pos_by_id
+        out = np.full(len(refs), -1, dtype=np.int64)
+        for i, (key, pid) in enumerate(refs):
+            pos = by_key.get(key) if key else by_id.get(pid)
+            if pos is not None:
+                out[i] = pos
+        return out
+
+    def cart_items(self, positions, margins, qtys) -> list[dict]:
+        """Cart lines for resolved positions, priced in one vectorized pass with per-line margins."""
+        positions = np.asarray(positions, dtype=np.int64)
+        margins = np.asarray(margins, dtype=np.float64)
+        cost = self.cost[positions]
+        final = np.round(cost * (1 + margins / 100), 2)
+        return [
+            {
+                "id": pid,
+                "key": self.keys[pos],
+                "sheet": self.sheet,
+                "name": self.names[pos],
+                "cost": c,
+                "vencimiento": self.vencimientos[pos],
+                "margin": m,
+                "final_price": f,
+                "qty": q,
+            }
+            for pos, pid, c, m, f, q in zip(
+                positions.tolist(), self.ids[positions].tolist(), cost.tolist(), margins.tolist(), final.tolist(), qtys
+            )
+        ]
+
+    def records(self, positions, margin: float) -> list[dict]:
+        """JSON-ready dicts (id, name, vencimiento, cost, final_price) for the given row positions."""
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) == 0:
+            return []
+        cost = self.cost[positions]
+        final = np.round(cost * (1 + margin / 100), 2)
+        names = self.names
+        vencs = self.vencimientos
+        keys = self.keys
+        return [
+            {"id": pid, "key": keys[pos], "name": names[pos], "vencimiento": vencs[pos], "cost": c, "final_price": f}
+            for pos, pid, c, f in zip(positions.tolist(), self.ids[positions].tolist(), cost.tolist(), final.tolist())
+        ]
+
+
+def _products_entry(sheet_name: str, df: pd.DataFrame, ts: float, version: int, **extra) -> dict:
+    """Cache entry for one catalog version with its search index and product store."""
+    return {
+        "df": df,
+        "ts": ts,
+        "version": version,
+        "index": ProductSearchIndex(df["name_lc"]),
+        "store": ProductStore(df, sheet_name),
+        **extra,
+    }
+
+
+def _search_catalog(entry: dict, q: str, mode: str = "") -> list[int] | None:
+    """Row positions matching q (None means the whole catalog). mode='fuzzy' ranks by relevance."""
+    if not q:
+        return None
+    if mode == "fuzzy":
+        return entry["index"].search_fuzzy(q)
+    return entry["index"].search(q)
+
+
+def _paginate(total_count: int, page: int, per_page: int) -> tuple[int, int, int]:
+    total_pages = (total_count + per_page - 1) // per_page if per_page > 0 else 1
+    start = (page - 1) * per_page
+    return total_pages, start, min(start + per_page, total_count)
+
+
+def _products_refresh_lock(sheet_name: str) -> threading.Lock:
+    with _PRODUCTS_REFRESH_LOCKS_GUARD:
+        lock = _PRODUCTS_REFRESH_LOCKS.get(sheet_name)
+        if lock is None:
+            lock = threading.Lock()
+            _PRODUCTS_REFRESH_LOCKS[sheet_name] = lock
+        return lock
+
+
+def _products_snapshot_path(sheet_name: str) -> str:
+    return os.path.join(PRODUCTS_SHARED_DIR, f"{sheet_name}.pkl")
+
+
+def _products_ts_path(sheet_name: str) -> str:
+    return os.path.join(PRODUCTS_SHARED_DIR, f"{sheet_name}.ts.json")
+
+
+@contextmanager
+def _products_file_lock(sheet_name: str):
+    """Cross-process lock around a sheet refresh (no-op without fcntl or shared dir)."""
+    if not PRODUCTS_SHARED_DIR or fcntl is None:
+        yield
+        return
+    os.makedirs(PRODUCTS_SHARED_DIR, exist_ok=True)
+    with open(os.path.join(PRODUCTS_SHARED_DIR, f"{sheet_name}.lock"), "a+") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
         try:
-            first_row = [str(c) for c in df.columns]
-            df.columns = list(range(len(df.columns)))
-            import pandas as _pd
-            df = _pd.concat([_pd.DataFrame([first_row]), df], ignore_index=True)
-            cols_lower = {str(c).lower().strip(): c for c in df.columns}
-        except Exception:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _products_snapshot_write(sheet_name: str, entry: dict):
+    os.makedirs(PRODUCTS_SHARED_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PRODUCTS_SHARED_DIR, prefix=f".{sheet_name}-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(
+                {"version": entry["version"], "ts": entry["ts"], "source_sha256": entry.get("source_sha256"), "df": entry["df"]},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        # Atomic rename: readers see either the previous snapshot or the new one, never a partial file
+        os.replace(tmp_path, _products_snapshot_path(sheet_name))
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
             pass
-    
-    # Try to find name column (product name)
-    name_col = None
-    for key in ["name", "producto", "product", "nombre", "descripcion", "descripción"]:
-        if key in cols_lower:
-            name_col = cols_lower[key]
-            break
-    # If still not found, use first column
-    if not name_col and len(df.columns) > 0:
-        name_col = df.columns[0]
-    
-    # Try to find cost column
-    cost_col = None
-    for key in ["cost", "precio", "costo", "price", "-3%", "- 3%"]:
-        if key in cols_lower:
-            cost_col = cols_lower[key]
-            break
-    # If still not found, try to find numeric columns (usually second column)
-    if not cost_col and len(df.columns) > 1:
-        # Check if second column looks numeric
-        second_col = df.columns[1]
-        if second_col != name_col:
+        raise
+    st = os.stat(_products_snapshot_path(sheet_name))
+    entry["snapshot_id"] = (st.st_ino, st.st_mtime_ns)
+
+
+def _products_snapshot_adopt(sheet_name: str) -> bool:
+    """Load the shared snapshot if another worker published a newer version. A single stat when unchanged."""
+    if not PRODUCTS_SHARED_DIR:
+        return False
+    path = _products_snapshot_path(sheet_name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    entry = _PRODUCTS_CACHE.get(sheet_name) or {}
+    snapshot_id = (st.st_ino, st.st_mtime_ns)
+    if entry.get("snapshot_id") == snapshot_id:
+        return False
+    try:
+        with open(path, "rb") as f:
+            snap = pickle.load(f)
+    except Exception:
+        return False
+    if entry.get("df") is not None and snap.get("version", 0) < entry.get("version", 0):
+        return False
+    _PRODUCTS_CACHE[sheet_name] = _products_entry(
+        sheet_name, snap["df"], snap.get("ts", 0), snap.get("version", 0),
+        snapshot_id=snapshot_id, source_sha256=snap.get("source_sha256"),
+    )
+    return True
+
+
+def _products_ts_publish(sheet_name: str, entry: dict):
+    """Tell the other workers that the published version was re-checked against an unchanged source,
+    without rewriting the snapshot: a small sidecar with the renewed ts."""
+    meta = {"version": entry["version"], "source_sha256": entry.get("source_sha256"), "ts": entry["ts"]}
+    _atomic_write(_products_ts_path(sheet_name), json.dumps(meta).encode("utf-8"))
+
+
+def _products_ts_adopt(sheet_name: str) -> bool:
+    """Renew the cached entry's ts from the sidecar if a peer re-checked this same version later.
+    Only read once the entry has expired, so fresh entries don't pay for it."""
+    entry = _PRODUCTS_CACHE.get(sheet_name)
+    if not PRODUCTS_SHARED_DIR or not entry or entry.get("df") is None:
+        return False
+    try:
+        with open(_products_ts_path(sheet_name), "rb") as f:
+            meta = json.loads(f.read())
+    except (OSError, ValueError):
+        return False
+    if meta.get("version") != entry.get("version") or meta.get("source_sha256") != entry.get("source_sha256"):
+        return False
+    if meta.get("ts", 0) <= entry.get("ts", 0):
+        return False
+    entry["ts"] = meta["ts"]
+    return True
+
+
+def _products_refresh(sheet_name: str, force: bool = False):
+    """Download and normalize a sheet, storing it in the cache. Must be called holding the sheet lock.
+    If a previous catalog is cached, a failed download keeps it live instead of using the local CSV."""
+    metrics = _PRODUCTS_METRICS.setdefault(sheet_name, {"refresh_count": 0, "refresh_failures": 0})
+    with _products_file_lock(sheet_name):
+        # Another worker may have published a fresh snapshot while we waited for the file lock
+        _products_snapshot_adopt(sheet_name)
+        _products_ts_adopt(sheet_name)
+        previous = _PRODUCTS_CACHE.get(sheet_name) or {}
+        if not force and previous.get("df") is not None and time.time() - previous.get("ts", 0) < _PRODUCTS_CACHE_TTL:
+            return previous["df"]
+        started = time.monotonic()
+        try:
+            df = load_products(sheet_name=sheet_name, fallback_local=previous.get("df") is None)
+        except Exception as e:
+            metrics["refresh_failures"] += 1
+            metrics["last_refresh_duration"] = round(time.monotonic() - started, 3)
+            metrics["last_error"] = str(e)[:200]
+            metrics["last_failure_at"] = time.time()
+            return None
+        metrics["refresh_count"] += 1
+        metrics["last_refresh_duration"] = round(time.monotonic() - started, 3)
+        metrics["last_refresh_at"] = time.time()
+        metrics["last_error"] = None
+        metrics["last_ingest"] = df.attrs.get("ingest")
+        sha = df.attrs.get("source_sha256")
+        if df is previous.get("df") or (sha and sha == previous.get("source_sha256")):
+            # Unchanged source (304 / same bytes, possibly first fetched by this worker after adopting
+            # a peer's snapshot): keep version, index, store and snapshot; renew the TTL here and for peers
+            previous["ts"] = time.time()
+            if PRODUCTS_SHARED_DIR and previous.get("snapshot_id"):
+                try:
+                    _products_ts_publish(sheet_name, previous)
+                except Exception as e:
+                    metrics["last_error"] = f"snapshot: {e}"[:200]
+            return previous["df"]
+        entry = _products_entry(sheet_name, df, time.time(), previous.get("version", 0) + 1, source_sha256=sha)
+        if PRODUCTS_SHARED_DIR:
             try:
-                # Try to convert a sample value
-                sample_val = str(df[second_col].iloc[0] if len(df) > 0 else "")
-                if any(c.isdigit() for c in sample_val.replace(".", "").replace(",", "").replace("-", "")):
-                    cost_col = second_col
-            except:
-                pass
-    # If still not found, use second column
-    if not cost_col and len(df.columns) > 1:
-        cost_col = df.columns[1]
-    
-    # Try to find vencimiento column
-    venc_col = None
-    for key in ["vencimiento", "fecha vencimiento", "fecha_vencimiento", "fecha vencimeinto", "vto", "fecha vto", "venc", "fecha"]:
-        if key in cols_lower:
-            venc_col = cols_lower[key]
-            break
-    # If still not found, pick first column whose lowercase contains 'venc' or 'vto'
-    if not venc_col:
-        for c in df.columns:
-            lc = str(c).strip().lower()
-            if ("venc" in lc) or ("vto" in lc) or ("venci" in lc) or ("fecha" in lc):
-                venc_col = c
-                break
-    # If still not found, fallback to column C (3rd column) as requested
-    if not venc_col and len(df.columns) > 2:
-        venc_col = df.columns[2]
-    
-    # Rename columns to standard names
-    rename_map = {}
-    if name_col:
-        rename_map[name_col] = "name"
-    if cost_col:
-        rename_map[cost_col] = "cost"
-    if venc_col:
-        rename_map[venc_col] = "vencimiento"
-    
-    if rename_map:
-        df = df.rename(columns=rename_map)
-    
-    # Ensure required columns exist, create empty ones if missing
-    if "name" not in df.columns:
-        if len(df.columns) > 0:
-            df["name"] = df.iloc[:, 0].astype(str)
-        else:
-            df["name"] = ""
-    if "cost" not in df.columns:
-        if len(df.columns) > 1:
-            df["cost"] = df.iloc[:, 1]
-        else:
-            df["cost"] = 0.0
-    if "vencimiento" not in df.columns:
-        df["vencimiento"] = ""
-    
-    # Coerce types and normalize values
-    df["name"] = df["name"].astype(str).str.strip()
-    # Remove rows where name is empty after stripping
-    df = df[df["name"] != ""]
-    
-    # Normalize cost: handle LATAM formats "$ 1.234,56" -> "1234.56"
-    cost_s = df["cost"].astype(str).str.strip()
-    # Keep only digits, separators and sign
-    cost_s = cost_s.str.replace(r"[^0-9,.-]", "", regex=True)
-    # If there is a comma, treat '.' as thousands separator and remove it
-    has_comma = cost_s.str.contains(",")
-    cost_s = cost_s.where(~has_comma, cost_s.str.replace(r"\.(?=\d{3}(\D|$))", "", regex=True))
-    # Replace comma decimal with dot
-    cost_s = cost_s.str.replace(",", ".", regex=False)
-    df["cost"] = pd.to_numeric(cost_s, errors="coerce")
-    # Missing/invalid costs should not exclude the product; fill with 0.0
-    df["cost"] = df["cost"].fillna(0.0)
-    
-    # Normalize vencimiento
-    df["vencimiento"] = df["vencimiento"].fillna("").astype(str)
-    
-    # Drop rows without name only (keep items even if cost is 0)
-    df = df.dropna(subset=["name"]).reset_index(drop=True)
-    
-    # Only proceed if we have data
-    if len(df) == 0:
-        return pd.DataFrame(columns=["id", "name", "name_lc", "cost", "vencimiento"]).astype({"id": int, "name": str, "name_lc": str, "cost": float, "vencimiento": str})
-    
-    df["id"] = df.index.astype(int)
-    # Add normalized name for quick case-insensitive filtering
-    df["name_lc"] = df["name"].astype(str).str.lower()
-    return df[["id", "name", "name_lc", "cost", "vencimiento"]]
-
-def load_products_cached(sheet_name: str = "generales") -> pd.DataFrame:
-    """Return products DataFrame using in-memory cache with TTL, per sheet."""
-    import time as _time
-    now = int(_time.time())
-    cache_key = sheet_name
-    cache_entry = _PRODUCTS_CACHE.get(cache_key, {})
-    if cache_entry.get("df") is not None and cache_entry.get("ts") and (now - cache_entry["ts"] < _PRODUCTS_CACHE_TTL):
-        return cache_entry["df"]
-    df = load_products(sheet_name=sheet_name)
-    _PRODUCTS_CACHE[cache_key] = {"df": df, "ts": now}
+                _products_snapshot_write(sheet_name, entry)
+            except Exception as e:
+                metrics["last_error"] = f"snapshot: {e}"[:200]
+        _PRODUCTS_CACHE[sheet_name] = entry
     return df
 
 
+def _products_refresh_background(sheet_name: str):
+    lock = _products_refresh_lock(sheet_name)
+    # Single-flight: if another thread is already refreshing this sheet, keep serving stale data
+    if not lock.acquire(blocking=False):
+        return
+
+    def _run():
+        try:
+            _products_refresh(sheet_name)
+        finally:
+            lock.release()
+
+    try:
+        threading.Thread(target=_run, name=f"products-refresh-{sheet_name}", daemon=True).start()
+    except Exception:
+        lock.release()
+
+
+def load_products_cached(sheet_name: str = "generales", force: bool = False) -> pd.DataFrame:
+    """Return products DataFrame using in-memory cache with TTL, per sheet.
+    Expired entries are served stale while a background thread refreshes them; force=True
+    refreshes synchronously (used by nocache=1)."""
+    now = time.time()
+    _products_snapshot_adopt(sheet_name)
+    cache_entry = _PRODUCTS_CACHE.get(sheet_name) or {}
+    df = cache_entry.get("df")
+    if not force and df is not None:
+        if now - cache_entry.get("ts", 0) < _PRODUCTS_CACHE_TTL:
+            return df
+        if _products_ts_adopt(sheet_name) and now - cache_entry.get("ts", 0) < _PRODUCTS_CACHE_TTL:
+            return df
+        metrics = _PRODUCTS_METRICS.get(sheet_name) or {}
+        if now - metrics.get("last_failure_at", 0) < _PRODUCTS_REFRESH_RETRY:
+            return df
+        if _PRODUCTS_CACHE_SWR:
+            _products_refresh_background(sheet_name)
+            return df
+    with _products_refresh_lock(sheet_name):
+        cache_entry = _PRODUCTS_CACHE.get(sheet_name) or {}
+        # Another thread may have refreshed while we waited for the lock
+        if cache_entry.get("df") is not None and cache_entry.get("ts", 0) >= now:
+            return cache_entry["df"]
+        refreshed = _products_refresh(sheet_name, force=force)
+    if refreshed is not None:
+        return refreshed
+    return (_PRODUCTS_CACHE.get(sheet_name) or {}).get("df")
+
+
+def load_catalog_cached(sheet_name: str = "generales", force: bool = False) -> dict:
+    """Cache entry (df, store, index, version) for a sheet, refreshed like load_products_cached.
+    If nothing could be cached (first load failed), a throwaway entry with version None is returned;
+    responses built from it must not go into the response caches."""
+    df = load_products_cached(sheet_name=sheet_name, force=force)
+    entry = _PRODUCTS_CACHE.get(sheet_name)
+    # The cached entry wins even if a concurrent refresh swapped it in after our load
+    if entry and entry.get("df") is not None:
+        return entry
+    return _products_entry(sheet_name, df if df is not None else _empty_products_frame(), time.time(), None)
+
+
+def products_cache_stats() -> dict:
+    now = time.time()
+    stats = {}
+    for sheet_name in sorted(set(_PRODUCTS_CACHE) | set(_PRODUCTS_METRICS)):
+        entry = _PRODUCTS_CACHE.get(sheet_name) or {}
+        metrics = dict(_PRODUCTS_METRICS.get(sheet_name) or {})
+        df = entry.get("df")
+        stats[sheet_name] = {
+            "rows": int(len(df)) if df is not None else 0,
+            "version": entry.get("version"),
+            "cache_age": round(now - entry["ts"], 1) if entry.get("ts") else None,
+            "stale": bool(entry.get("ts")) and (now - entry["ts"] >= _PRODUCTS_CACHE_TTL),
+            "refreshing": _products_refresh_lock(sheet_name).locked(),
+            **metrics,
+        }
+    return stats
+
+
 def products_cache_clear(sheet_name: str | None = None):
     if not sheet_name:
         _PRODUCTS_CACHE.clear()
@@ -649,38 +2354,372 @@ def products_cache_clear(sheet_name: str | None = None):
         _PRODUCTS_CACHE.clear()
 
 
+class _MemoryCartStore:
+    """Process-local stand-in (single worker, development). Same interface as _SqlCartStore."""
+
+    def __init__(self):
+        self._carts = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            items, _, _ = self._carts.get(sid, ([], 0, 0.0))
+            return [dict(i) for i in items]
+
+    def totals(self, sid):
+        with self._lock:
+            _, count, total = self._carts.get(sid, ([], 0, 0.0))
+            return count, total
+
+    def write(self, sid, changed, length, count, total):
+        with self._lock:
+            items = list(self._carts.get(sid, ([], 0, 0.0))[0][:length])
+            for pos, item in changed.items():
+                if pos < len(items):
+                    items[pos] = dict(item)
+                else:
+                    items.append(dict(item))
+            self._carts[sid] = (items, count, total)
+
+
+class _SqlCartStore:
+    """Cart rows (one per item position) plus a cart_sessions row with the cached totals,
+    on Postgres or the local SQLite file. Writes only touch the positions that changed."""
+
+    def __init__(self, use_db: bool):
+        self.use_db = use_db
+        self._last_purge = 0.0
+
+    def load(self, sid):
+        with _sql_tx(self.use_db) as run:
+            rows = run("SELECT item FROM cart_items WHERE sid = :sid ORDER BY pos", {"sid": sid})
+        return [json.loads(r["item"]) for r in rows]
+
+    def totals(self, sid):
+        with _sql_tx(self.use_db) as run:
+            rows = run("SELECT item_count, total FROM cart_sessions WHERE sid = :sid", {"sid": sid})
+        if not rows:
+            return 0, 0.0
+        return int(rows[0]["item_count"]), float(rows[0]["total"])
+
+    def write(self, sid, changed, length, count, total):
+        now = time.time()
+        with _sql_tx(self.use_db) as run:
+            run("DELETE FROM cart_items WHERE sid = :sid AND pos >= :n", {"sid": sid, "n": length})
+            for pos, item in changed.items():
+                run(
+                    """
+                    INSERT INTO cart_items (sid, pos, item) VALUES (:sid, :pos, :item)
+                    ON CONFLICT (sid, pos) DO UPDATE SET item = excluded.item
+                    """,
+                    {"sid": sid, "pos": pos, "item": json.dumps(item, ensure_ascii=False)},
+                )
+            run(
+                """
+                INSERT INTO cart_sessions (sid, item_count, total, updated_at) VALUES (:sid, :c, :t, :now)
+                ON CONFLICT (sid) DO UPDATE SET item_count = excluded.item_count, total = excluded.total, updated_at = excluded.updated_at
+                """,
+                {"sid": sid, "c": count, "t": total, "now": now},
+            )
+            # Drop carts idle for longer than the TTL, at most once per hour per process
+            if now - self._last_purge > 3600:
+                self._last_purge = now
+                cutoff = {"cutoff": now - _CART_STORE_TTL}
+                run("DELETE FROM cart_items WHERE sid IN (SELECT sid FROM cart_sessions WHERE updated_at < :cutoff)", cutoff)
+                run("DELETE FROM cart_sessions WHERE updated_at < :cutoff", cutoff)
+
+
+_CART_STORES = {}
+
+
+def _cart_store():
+    if CART_STORE == "memory":
+        backend = "memory"
+    elif CART_STORE in ("", "db") and db_enabled():
+        backend = "db"
+    else:
+        backend = "sqlite"
+    store = _CART_STORES.get(backend)
+    if store is None:
+        store = _MemoryCartStore() if backend == "memory" else _SqlCartStore(use_db=backend == "db")
+        _CART_STORES[backend] = store
+    return store
+
+
+def _cart_sid(create: bool = False):
+    sid = session.get("sid")
+    if sid is None and create:
+        sid = secrets.token_urlsafe(16)
+        session["sid"] = sid
+        session.modified = True
+    return sid
+
+
+def _cart_totals_of(cart):
+    count = sum(int(i.get("qty", 0)) for i in cart)
+    total = round(sum(float(i.get("final_price", 0)) * int(i.get("qty", 0)) for i in cart), 2)
+    return count, total
+
+
 def get_cart():
-    return session.setdefault("cart", [])
+    """Cart items for this session, loaded once per request. Mutate the list and pass it to save_cart."""
+    if "cart" in g:
+        return g.cart
+    legacy = session.pop("cart", None)  # carts from before the server-side store lived in the cookie
+    sid = _cart_sid(create=legacy is not None)
+    cart = _cart_store().load(sid) if sid else []
+    g.cart = cart
+    g.cart_saved = [dict(i) for i in cart]
+    if legacy is not None:
+        session.modified = True
+        save_cart(legacy)
+    return g.cart
+
+
+def save_cart(cart):
+    """Persist only the item positions that changed since get_cart, and refresh the cached totals."""
+    saved = g.cart_saved if "cart_saved" in g else None
+    if saved is None:
+        get_cart()
+        saved = g.cart_saved
+    changed = {pos: item for pos, item in enumerate(cart) if pos >= len(saved) or saved[pos] != item}
+    if not changed and len(cart) == len(saved):
+        return
+    count, total = _cart_totals_of(cart)
+    _cart_store().write(_cart_sid(create=True), changed, len(cart), count, total)
+    g.cart = cart
+    g.cart_saved = [dict(i) for i in cart]
+    g.cart_totals = (count, total)
+
+
+def cart_totals():
+    """(item count, total) for the session's cart, from the cached totals row when the cart wasn't loaded."""
+    if "cart_totals" not in g:
+        if "cart" in g or "cart" in session:
+            g.cart_totals = _cart_totals_of(get_cart())
+        else:
+            sid = _cart_sid()
+            g.cart_totals = _cart_store().totals(sid) if sid else (0, 0.0)
+    return g.cart_totals
+
+
+@app.context_processor
+def inject_globals():
+    return {
+        "cart_count": cart_totals()[0],
+        "current_client_name": session.get("current_client_name"),
+        "current_client_email": session.get("current_client_email"),
+        "sales_responsible": session.get("sales_responsible"),
+        "editing_order_id": session.get("edit_order_id"),
+    }
+
+
+_SALES_ROLLUP_READY = False
+_SALES_ROLLUP_LOCK = threading.Lock()
+
+# Postgres: build every order's contribution in one set-based statement over historial (JSONB items
+# unnested with jsonb_array_elements), then derive the daily tables from it. Same rules as
+# _sales_contribution; non-numeric qty/price/cost count as 0.
+_PG_NUM = r"CASE WHEN ({v}) ~ '^\s*-?[0-9]+(\.[0-9]*)?([eE][-+]?[0-9]+)?\s*$' THEN ({v})::float8 ELSE 0 END"
+_PG_SALES_ROLLUP_BUILD = (
+    f"""
+    INSERT INTO sales_order_contrib (order_id, data)
+    WITH o AS (
+      SELECT order_id, left(data->>'created_at', 10) AS day, btrim(coalesce(data->>'client_name', '')) AS client,
+             coalesce(total, 0) AS total,
+             CASE WHEN jsonb_typeof(data->'items') = 'array' THEN data->'items' ELSE '[]'::jsonb END AS items
+      FROM historial
+      WHERE length(coalesce(data->>'created_at', '')) >= 10
+    ), it AS (
+      SELECT o.order_id, btrim(coalesce(e->>'name', '')) AS name,
+             {_PG_NUM.format(v="e->>'qty'")} AS qty,
+             {_PG_NUM.format(v="e->>'final_price'")} AS price,
+             {_PG_NUM.format(v="e->>'cost'")} AS cost
+      FROM o CROSS JOIN LATERAL jsonb_array_elements(o.items) AS e
+    ), sums AS (
+      SELECT order_id, sum(price * qty) AS items_sales, sum(greatest(price - cost, 0) * qty) AS margin_val
+      FROM it GROUP BY order_id
+    ), prods AS (
+      SELECT order_id, jsonb_object_agg(name, qty) AS products
+      FROM (SELECT order_id, name, sum(qty) AS qty FROM it WHERE name <> '' GROUP BY order_id, name) x
+      GROUP BY order_id
+    )
+    SELECT o.order_id, jsonb_build_object(
+      'day', o.day, 'client', o.client, 'total', o.total,
+      'items_sales', coalesce(sums.items_sales, 0), 'margin_val', coalesce(sums.margin_val, 0),
+      'products', coalesce(prods.products, '{{}}'::jsonb)
+    )::text
+    FROM o LEFT JOIN sums USING (order_id) LEFT JOIN prods USING (order_id)
+    """,
+    """
+    INSERT INTO sales_daily (day, orders, sales, items_sales, margin_val)
+    SELECT c->>'day', count(*), sum((c->>'total')::float8), sum((c->>'items_sales')::float8), sum((c->>'margin_val')::float8)
+    FROM (SELECT data::jsonb AS c FROM sales_order_contrib) x
+    GROUP BY 1
+    """,
+    """
+    INSERT INTO sales_daily_client (day, client, orders, sales)
+    SELECT c->>'day', c->>'client', count(*), sum((c->>'total')::float8)
+    FROM (SELECT data::jsonb AS c FROM sales_order_contrib) x
+    WHERE c->>'client' <> ''
+    GROUP BY 1, 2
+    """,
+    """
+    INSERT INTO sales_daily_product (day, name, qty)
+    SELECT c->>'day', p.key, sum(p.value::float8)
+    FROM (SELECT data::jsonb AS c FROM sales_order_contrib) x
+    CROSS JOIN LATERAL jsonb_each_text(c->'products') AS p
+    GROUP BY 1, 2
+    """,
+)
+
+
+def _sales_contribution(order: dict) -> dict | None:
+    """What one order adds to the dashboard rollups, or None if it has no usable date."""
+    created = str(order.get("created_at") or "")
+    if len(created) < 10:
+        return None
+    contrib = {
+        "day": created[:10],
+        "client": (order.get("client_name") or "").strip(),
+        "total": float(order.get("total") or 0.0),
+        "items_sales": 0.0,
+        "margin_val": 0.0,
+        "products": {},
+    }
+    for it in order.get("items") or []:
+        try:
+            qty = float(it.get("qty", 0))
+            price = float(it.get("final_price", 0))
+            cost = float(it.get("cost", 0))
+        except Exception:
+            qty = 0.0; price = 0.0; cost = 0.0
+        contrib["items_sales"] += price * qty
+        contrib["margin_val"] += max(price - cost, 0) * qty
+        name = str(it.get("name") or "").strip()
+        if name:
+            contrib["products"][name] = contrib["products"].get(name, 0.0) + qty
+    return contrib
+
+
+def _sales_rollup_add(run, contrib: dict, sign: int) -> None:
+    """Add (sign=1) or subtract (sign=-1) one order's contribution; rows that drop to zero are removed."""
+    day = contrib["day"]
+    run(
+        """
+        INSERT INTO sales_daily (day, orders, sales, items_sales, margin_val) VALUES (:day, :o, :s, :i, :m)
+        ON CONFLICT (day) DO UPDATE SET orders = sales_daily.orders + excluded.orders, sales = sales_daily.sales + excluded.sales,
+          items_sales = sales_daily.items_sales + excluded.items_sales, margin_val = sales_daily.margin_val + excluded.margin_val
+        """,
+        {"day": day, "o": sign, "s": sign * contrib["total"], "i": sign * contrib["items_sales"], "m": sign * contrib["margin_val"]},
+    )
+    if contrib["client"]:
+        run(
+            """
+            INSERT INTO sales_daily_client (day, client, orders, sales) VALUES (:day, :client, :o, :s)
+            ON CONFLICT (day, client) DO UPDATE SET orders = sales_daily_client.orders + excluded.orders, sales = sales_daily_client.sales + excluded.sales
+            """,
+            {"day": day, "client": contrib["client"], "o": sign, "s": sign * contrib["total"]},
+        )
+    for name, qty in contrib["products"].items():
+        run(
+            """
+            INSERT INTO sales_daily_product (day, name, qty) VALUES (:day, :name, :q)
+            ON CONFLICT (day, name) DO UPDATE SET qty = sales_daily_product.qty + excluded.qty
+            """,
+            {"day": day, "name": name, "q": sign * qty},
+        )
+    if sign < 0:
+        run("DELETE FROM sales_daily WHERE day = :day AND orders <= 0", {"day": day})
+        run("DELETE FROM sales_daily_client WHERE day = :day AND orders <= 0", {"day": day})
+        run("DELETE FROM sales_daily_product WHERE day = :day AND qty <= 1e-9", {"day": day})
+
+
+def _sales_rollup_replace(run, order_id: str, contrib: dict | None) -> None:
+    rows = run("SELECT data FROM sales_order_contrib WHERE order_id = :id", {"id": order_id})
+    if rows:
+        _sales_rollup_add(run, json.loads(rows[0]["data"]), -1)
+        run("DELETE FROM sales_order_contrib WHERE order_id = :id", {"id": order_id})
+    if contrib is not None:
+        _sales_rollup_add(run, contrib, 1)
+        run(
+            "INSERT INTO sales_order_contrib (order_id, data) VALUES (:id, :data)",
+            {"id": order_id, "data": json.dumps(contrib, ensure_ascii=False)},
+        )
+
+
+def sales_rollup_apply(order: dict) -> None:
+    """Update the rollups for a created or edited order (replaces its previous contribution)."""
+    if not order or not order.get("order_id") or not _sales_rollup_ensure():
+        return
+    with _sql_tx(db_enabled()) as run:
+        _sales_rollup_replace(run, order["order_id"], _sales_contribution(order))
+
+
+def sales_rollup_remove(order_id: str) -> None:
+    if not order_id or not _sales_rollup_ensure():
+        return
+    with _sql_tx(db_enabled()) as run:
+        _sales_rollup_replace(run, order_id, None)
 
 
-def save_cart(cart):
-    session["cart"] = cart
-    session.modified = True
+def _sales_rollup_ensure() -> bool:
+    """Build the rollups from the full order history once (first run or new store); False if that failed."""
+    global _SALES_ROLLUP_READY
+    if _SALES_ROLLUP_READY:
+        return True
+    with _SALES_ROLLUP_LOCK:
+        if _SALES_ROLLUP_READY:
+            return True
+        use_db = db_enabled()
+        try:
+            with _sql_tx(use_db, readonly=True) as run:
+                built = run("SELECT value FROM sales_rollup_meta WHERE name = 'built_at'")
+            if not built:
+                # Orders imported from files later are added by the sync once built_at exists
+                with _sql_tx(use_db) as run:
+                    for table in ("sales_daily", "sales_daily_client", "sales_daily_product", "sales_order_contrib"):
+                        run(f"DELETE FROM {table}")
+                    if use_db:
+                        # Aggregated inside Postgres; no order rows leave the database
+                        for sql in _PG_SALES_ROLLUP_BUILD:
+                            run(sql)
+                    else:
+                        # Read inside the write transaction so a concurrent import can't slip in between
+                        for r in run("SELECT order_id, data FROM historial WHERE data IS NOT NULL"):
+                            _sales_rollup_replace(run, r["order_id"], _sales_contribution(json.loads(r["data"])))
+                    run(
+                        """
+                        INSERT INTO sales_rollup_meta (name, value) VALUES ('built_at', :v)
+                        ON CONFLICT (name) DO UPDATE SET value = excluded.value
+                        """,
+                        {"v": datetime.now(timezone.utc).isoformat()},
+                    )
+            _SALES_ROLLUP_READY = True
+        except Exception:
+            return False
+    return True
 
 
-@app.context_processor
-def inject_globals():
-    cart = session.get("cart", [])
-    return {
-        "cart_count": sum(int(i.get("qty", 0)) for i in cart),
-        "current_client_name": session.get("current_client_name"),
-        "current_client_email": session.get("current_client_email"),
-        "sales_responsible": session.get("sales_responsible"),
-        "editing_order_id": session.get("edit_order_id"),
-    }
+@app.cli.command("rebuild-sales-rollups")
+def rebuild_sales_rollups_command():
+    """Recompute the dashboard rollups from every stored order (e.g. after copying orders in by hand)."""
+    global _SALES_ROLLUP_READY
+    _sync_history_from_files(wait=True)
+    with _sql_tx(db_enabled()) as run:
+        run("DELETE FROM sales_rollup_meta WHERE name = 'built_at'")
+    _SALES_ROLLUP_READY = False
+    print("ok" if _sales_rollup_ensure() else "error")
 
 
 @app.route("/")
 def dashboard():
-    df = load_products()
     # Productos en stock debe considerar ambas hojas
     try:
         total_productos = len(load_products_cached(sheet_name="generales")) + len(load_products_cached(sheet_name="ansioliticos"))
     except Exception:
-        total_productos = len(df)
-    clients = load_clients()
+        total_productos = 0
     # Time window selection for KPIs/Chart/Top products
-    from datetime import timedelta
     raw_days = request.args.get("days")
     if raw_days is not None:
         try:
@@ -694,109 +2733,35 @@ def dashboard():
         days = int(session.get("dashboard_days", 30))
     today = date.today()
     start_date = today - timedelta(days=days - 1)
-    from collections import defaultdict
-    today_str = date.today().isoformat()
-    # Period aggregations
+    start_iso, end_iso = start_date.isoformat(), today.isoformat()
+    # Read the precomputed rollups for the window only: O(days) rows, not O(orders)
+    sales_by_day = {}
+    margin_val_by_day = {}
+    sales_val_by_day = {}
+    clients_count_by_day = {}
     ventas_periodo = 0.0
-    clientes_periodo_set = set()
-    sales_by_day = defaultdict(float)
-    clients_by_day = defaultdict(set)
-    margin_val_by_day = defaultdict(float)
-    sales_val_by_day = defaultdict(float)
-    # Aggregations
-    top_counts = {}
-    if db_enabled():
-        _sync_history_from_files()
-        rows = db_list_history("") or []
-        for r in rows:
-            created = str(r.get("created_at") or "")
-            client_name = (r.get("client_name") or "").strip()
-            total = float(r.get("total") or 0.0)
-            day = created[:10] if len(created) >= 10 else None
-            if day:
-                sales_by_day[day] += total
-                if client_name:
-                    clients_by_day[day].add(client_name)
-                # KPI period sums
-                try:
-                    d_obj = date.fromisoformat(day)
-                except Exception:
-                    d_obj = None
-                if d_obj and (start_date <= d_obj <= today):
-                    ventas_periodo += total
-                    if client_name:
-                        clientes_periodo_set.add(client_name)
-            for it in (r.get("items") or []):
-                try:
-                    qty = float(it.get("qty", 0))
-                    price = float(it.get("final_price", 0))
-                    cost = float(it.get("cost", 0))
-                except Exception:
-                    qty = 0.0; price = 0.0; cost = 0.0
-                margin_val = max(price - cost, 0) * qty
-                if day:
-                    margin_val_by_day[day] += margin_val
-                    sales_val_by_day[day] += price * qty
-                # Top products within selected date range
-                try:
-                    d_obj = date.fromisoformat(day) if day else None
-                except Exception:
-                    d_obj = None
-                if d_obj and (start_date <= d_obj <= today):
-                    name = str(it.get("name") or "").strip()
-                    if name:
-                        top_counts[name] = top_counts.get(name, 0.0) + float(qty)
-    else:
-        if os.path.isdir(ORDERS_DIR):
-            for fname in os.listdir(ORDERS_DIR):
-                if not fname.endswith(".json"):
-                    continue
-                try:
-                    with open(os.path.join(ORDERS_DIR, fname), "r", encoding="utf-8") as f:
-                        order = json.load(f)
-                    created = order.get("created_at", "")
-                    client_name = (order.get("client_name") or "").strip()
-                    if len(created) >= 10:
-                        day = created[:10]
-                        total = float(order.get("total", 0.0))
-                        sales_by_day[day] += total
-                        if client_name:
-                            clients_by_day[day].add(client_name)
-                        # KPI period sums (file-based)
-                        try:
-                            d_obj = date.fromisoformat(day)
-                        except Exception:
-                            d_obj = None
-                        if d_obj and (start_date <= d_obj <= today):
-                            ventas_periodo += total
-                            if client_name:
-                                clientes_periodo_set.add(client_name)
-                    if created.startswith(today_str):
-                        ventas_hoy += float(order.get("total", 0.0))
-                        if client_name:
-                            clientes_hoy_set.add(client_name)
-                    for it in order.get("items", []):
-                        qty = float(it.get("qty", 0))
-                        price = float(it.get("final_price", 0))
-                        cost = float(it.get("cost", 0))
-                        margin_val = max(price - cost, 0) * qty
-                        created_day = created[:10] if len(created) >= 10 else None
-                        if created_day:
-                            margin_val_by_day[created_day] += margin_val
-                            sales_val_by_day[created_day] += price * qty
-                        # Top products within selected date range
-                        try:
-                            d_obj = date.fromisoformat(created_day) if created_day else None
-                        except Exception:
-                            d_obj = None
-                        if d_obj and (start_date <= d_obj <= today):
-                            name = str(it.get("name") or "").strip()
-                            if name:
-                                top_counts[name] = top_counts.get(name, 0.0) + float(qty)
-                except Exception:
-                    continue
-    # KPIs within selected period
-    clientes_periodo = len(clientes_periodo_set)
+    clientes_periodo = 0
+    top_counts = []
+    if _sales_rollup_ensure():
+        window = {"start": start_iso, "end": end_iso}
+        with _sql_tx(db_enabled(), readonly=True) as run:
+            for r in run("SELECT day, sales, items_sales, margin_val FROM sales_daily WHERE day >= :start AND day <= :end", window):
+                sales_by_day[r["day"]] = float(r["sales"])
+                sales_val_by_day[r["day"]] = float(r["items_sales"])
+                margin_val_by_day[r["day"]] = float(r["margin_val"])
+            for r in run("SELECT day, COUNT(*) AS n FROM sales_daily_client WHERE day >= :start AND day <= :end GROUP BY day", window):
+                clients_count_by_day[r["day"]] = int(r["n"])
+            rows = run("SELECT COUNT(DISTINCT client) AS n FROM sales_daily_client WHERE day >= :start AND day <= :end", window)
+            clientes_periodo = int(rows[0]["n"]) if rows else 0
+            top_counts = run(
+                """
+                SELECT name, SUM(qty) AS qty FROM sales_daily_product
+                WHERE day >= :start AND day <= :end
+                GROUP BY name ORDER BY qty DESC, name LIMIT 30
+                """,
+                window,
+            )
+        ventas_periodo = sum(sales_by_day.values())
     # Compute margin % within period
     period_sales_base = 0.0
     period_margin_val = 0.0
@@ -816,15 +2781,14 @@ def dashboard():
     # Compose chronological labels and values for last N days
     sales_labels = [f"{d.day}/{d.month}" for d in last_n]
     sales_values = [round(sales_by_day.get(k, 0.0), 2) for k in iso_labels]
-    clients_values = [len(clients_by_day.get(k, set())) for k in iso_labels]
+    clients_values = [clients_count_by_day.get(k, 0) for k in iso_labels]
     margin_values = []
     for k in iso_labels:
         base = sales_val_by_day.get(k, 0.0)
         mv = margin_val_by_day.get(k, 0.0)
         margin_values.append(round((mv / base * 100) if base > 0 else 0.0, 1))
-    # Build Top 30 list by quantity within period
-    top_products = sorted(top_counts.items(), key=lambda kv: kv[1], reverse=True)[:30]
-    top_products = [{"name": k, "qty": round(v, 2)} for k, v in top_products]
+    # Top 30 by quantity within period
+    top_products = [{"name": r["name"], "qty": round(float(r["qty"]), 2)} for r in top_counts]
     return render_template(
         "dashboard.html",
         stats=stats,
@@ -840,6 +2804,36 @@ def dashboard():
  
 
 
+def _activate_client_by_name(client_name_param: str):
+    """Set a registered client (name/email/margin) as active in session; clears the cart on change."""
+    if not client_name_param:
+        return
+    try:
+        target = None
+        if db_enabled():
+            target = db_get_client_by_name(client_name_param)
+        else:
+            clients = load_clients()
+            target = next((c for c in clients if c.get("name", "").strip().lower() == client_name_param.lower()), None)
+        if target:
+            # If client changed, clear cart
+            prev_id = session.get("current_client_id")
+            prev_name = session.get("current_client_name")
+            new_id = target.get("id")
+            new_name = target.get("name")
+            if prev_id != new_id or (prev_id is None and prev_name and prev_name != new_name):
+                save_cart([])
+            session["current_client_id"] = new_id
+            session["current_client_name"] = new_name
+            session["current_client_email"] = target.get("email", "")
+            # update default margin from client if present
+            if target.get("default_margin") is not None:
+                session["current_client_margin"] = float(target.get("default_margin", 20.0))
+            session.modified = True
+    except Exception:
+        pass
+
+
 @app.route("/api/products")
 def api_products():
     sheet_name = request.args.get("sheet", "generales").strip().lower()
@@ -847,12 +2841,9 @@ def api_products():
         sheet_name = "generales"
     # Allow forcing a refresh from the client
     nocache = request.args.get("nocache") in ("1", "true", "yes")
-    if nocache:
-        products_cache_clear(sheet_name)
-        df = load_products(sheet_name=sheet_name)
-    else:
-        df = load_products_cached(sheet_name=sheet_name)
+    catalog = load_catalog_cached(sheet_name=sheet_name, force=nocache)
     q = request.args.get("q", "").strip().lower()
+    mode = "fuzzy" if request.args.get("mode", "").strip().lower() == "fuzzy" else ""
     # Pagination params
     try:
         page = int(request.args.get("page", "1"))
@@ -865,69 +2856,126 @@ def api_products():
     page = max(page, 1)
     per_page = max(min(per_page, 500), 1)  # cap per_page to a reasonable number
     # If a client name is provided, set it as active in session (name/email/margin)
-    client_name_param = request.args.get("client", "").strip()
-    if client_name_param:
-        try:
-            target = None
-            if db_enabled():
-                target = db_get_client_by_name(client_name_param)
-            else:
-                clients = load_clients()
-                target = next((c for c in clients if c.get("name", "").strip().lower() == client_name_param.lower()), None)
-            if target:
-                # If client changed, clear cart
-                prev_id = session.get("current_client_id")
-                prev_name = session.get("current_client_name")
-                new_id = target.get("id")
-                new_name = target.get("name")
-                if prev_id != new_id or (prev_id is None and prev_name and prev_name != new_name):
-                    session["cart"] = []
-                session["current_client_id"] = new_id
-                session["current_client_name"] = new_name
-                session["current_client_email"] = target.get("email", "")
-                # update default margin from client if present
-                if target.get("default_margin") is not None:
-                    session["current_client_margin"] = float(target.get("default_margin", 20.0))
-                session.modified = True
-        except Exception:
-            pass
+    _activate_client_by_name(request.args.get("client", "").strip())
     margin = request.args.get("margin")
     if margin is None:
         margin = session.get("current_client_margin", 20.0)
     margin = float(margin or 0)
-    if q:
-        # filter by precomputed lowercase column
-        df = df[df["name_lc"].str.contains(q)]
-    # Paginate first, then compute price only for the slice
-    # Global filter already applied above; now paginate
-    total_count = len(df)
-    total_pages = (total_count + per_page - 1) // per_page if per_page > 0 else 1
-    start = (page - 1) * per_page
-    end = start + per_page
-    df_page = df.iloc[start:end].copy() if total_count > 0 else df.iloc[0:0].copy()
-    df_page["final_price"] = (df_page["cost"] * (1 + margin / 100)).round(2)
+    # The payload only depends on these, so it is served from the response cache when possible
+    cache_key = (sheet_name, catalog.get("version"), q, mode, page, per_page, margin)
+    cacheable = not nocache and catalog.get("version") is not None
+    cached = _API_PRODUCTS_CACHE.get(cache_key) if cacheable else None
+    if cached is None:
+        # Filter through the per-version search index, paginate, then price only the page
+        positions = _search_catalog(catalog, q, mode)
+        store = catalog["store"]
+        total_count = len(positions) if positions is not None else len(store)
+        total_pages, start, end = _paginate(total_count, page, per_page)
+        page_positions = positions[start:end] if positions is not None else range(start, max(start, end))
+        body = json.dumps({
+            "products": store.records(page_positions, margin),
+            "margin": margin,
+            "page": page,
+            "per_page": per_page,
+            "total_count": int(total_count),
+            "total_pages": int(total_pages),
+            "sheet": sheet_name,
+            "mode": mode or "substring",
+            "refreshed": bool(nocache),
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = hashlib.sha1(body).hexdigest()
+        if cacheable:
+            _API_PRODUCTS_CACHE.put(cache_key, body, etag)
+    else:
+        body, etag = cached
+    resp = Response(body, mimetype="application/json")
+    resp.set_etag(etag)
+    # Browsers must revalidate, which turns repeated identical pages into 304s
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+
+@app.route("/api/session")
+def api_session():
+    """Per-user state kept out of the cacheable /api/products payload. ?client= activates a client."""
+    _activate_client_by_name(request.args.get("client", "").strip())
     return jsonify({
-        "products": df_page[["id","name","vencimiento","cost","final_price"]].to_dict(orient="records"),
-        "margin": margin,
+        "cart_count": cart_totals()[0],
         "current_client_name": session.get("current_client_name"),
         "current_client_email": session.get("current_client_email"),
-        "cart_count": sum(int(i.get("qty", 0)) for i in session.get("cart", [])),
-        "page": page,
-        "per_page": per_page,
-        "total_count": int(total_count),
-        "total_pages": int(total_pages),
-        "sheet": sheet_name,
-        "refreshed": bool(nocache),
+        "margin": float(session.get("current_client_margin", 20.0) or 0),
     })
 
 
+def _db_pool_stats() -> dict | None:
+    eng = _ENGINE
+    if eng is None:
+        return None
+    pool = eng.pool
+    stats = {"size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "recycle": DB_POOL_RECYCLE}
+    for name in ("checkedout", "checkedin", "overflow"):
+        fn = getattr(pool, name, None)
+        if callable(fn):
+            stats[name] = fn()
+    return stats
+
+
+@app.route("/metrics")
+def metrics():
+    return jsonify({
+        "products_cache": products_cache_stats(),
+        "api_products_cache": _API_PRODUCTS_CACHE.stats(),
+        "catalog_pdf_cache": _CATALOG_PDF_CACHE.stats(),
+        "checkout_jobs": checkout_jobs_stats(),
+        "db_pool": _db_pool_stats(),
+        "queries": _QUERY_TIMINGS.stats(),
+    })
+
+
+def cart_flag_stale_items(cart: list) -> int:
+    """Mark cart items whose product key no longer exists in the current catalog of their sheet
+    (row removed or renamed in the sheet). Sets item["stale"] and returns how many were flagged.
+    Items added before keys existed carry no key and are left alone."""
+    stores = {}
+    flagged = 0
+    for item in cart:
+        key = item.get("key")
+        if not key:
+            continue
+        sheet_name = item.get("sheet") or "generales"
+        if sheet_name not in stores:
+            try:
+                stores[sheet_name] = load_catalog_cached(sheet_name=sheet_name)["store"]
+            except Exception:
+                stores[sheet_name] = None
+        store = stores[sheet_name]
+        stale = store is not None and not store.has_key(key)
+        if stale:
+            flagged += 1
+        if bool(item.get("stale")) != stale:
+            item["stale"] = stale
+    return flagged
+
+
 @app.route("/cart")
 def cart_view():
     cart = get_cart()
+    if cart_flag_stale_items(cart):
+        flash("Algunos productos del carrito ya no están en la lista de precios actual", "error")
     total = sum(item["final_price"] * item["qty"] for item in cart)
     return render_template("cart.html", cart=cart, total=round(total, 2))
 
 
+def _cart_merge(cart: list, item: dict) -> None:
+    """Append item, or add its qty to an existing line for the same product and margin."""
+    for c in cart:
+        same = c.get("key") == item["key"] if c.get("key") else c["id"] == item["id"]
+        if same and abs(c["margin"] - item["margin"]) < 1e-6:
+            c["qty"] += item["qty"]
+            return
+    cart.append(item)
+
+
 @app.route("/cart/add", methods=["POST"])
 def cart_add():
     # Require a selected/active client before adding to cart
@@ -948,46 +2996,36 @@ def cart_add():
     if sheet_name not in ("generales", "ansioliticos"):
         sheet_name = "generales"
     
-    df = load_products_cached(sheet_name=sheet_name)
-    pid = int(request.form.get("id"))
+    store = load_catalog_cached(sheet_name=sheet_name)["store"]
     qty = max(1, int(request.form.get("qty", 1)))
     margin = float(request.form.get("margin", 20.0))
-    row = df[df["id"] == pid]
-    if row.empty:
+    # Prefer the stable key; the positional id is kept for older pages/forms
+    key = request.form.get("key", "").strip()
+    r = store.get_by_key(key) if key else store.get(int(request.form.get("id")))
+    if r is None:
+        if wants_json:
+            return jsonify({"ok": False, "error": "Producto no encontrado, actualice la lista de precios"}), 404
         flash("Producto no encontrado", "error")
         return redirect(url_for("products"))
-    r = row.iloc[0]
-    final_price = round(float(r["cost"]) * (1 + margin / 100), 2)
+    final_price = round(r.cost * (1 + margin / 100), 2)
     item = {
-        "id": int(r["id"]),
-        "name": str(r["name"]),
-        "cost": float(r["cost"]),
-        "vencimiento": str(r.get("vencimiento", "")),
+        "id": r.id,
+        "key": r.key,
+        "sheet": sheet_name,
+        "name": r.name,
+        "cost": r.cost,
+        "vencimiento": r.vencimiento,
         "margin": margin,
         "final_price": final_price,
         "qty": qty,
     }
     cart = get_cart()
     # Merge if same product and margin
-    merged = False
-    for c in cart:
-        if c["id"] == item["id"] and abs(c["margin"] - item["margin"]) < 1e-6:
-            c["qty"] += item["qty"]
-            merged = True
-            break
-    if not merged:
-        cart.append(item)
+    _cart_merge(cart, item)
     save_cart(cart)
     # AJAX support: if client expects JSON, return cart status
-    wants_json = (
-        "application/json" in (request.headers.get("Accept", ""))
-        or request.headers.get("X-Requested-With") == "XMLHttpRequest"
-        or request.form.get("ajax") == "1"
-        or (request.headers.get("Referer") and "/products" in request.headers.get("Referer"))
-    )
     if wants_json:
-        count = sum(int(i.get("qty", 0)) for i in cart)
-        return jsonify({"ok": True, "cart_count": count})
+        return jsonify({"ok": True, "cart_count": cart_totals()[0]})
     return redirect(url_for("cart_view"))
 
 
@@ -1033,6 +3071,97 @@ def cart_remove():
         flash("No se pudo eliminar el item", "error")
     return redirect(url_for("cart_view"))
 
+@app.route("/api/cart/batch", methods=["POST"])
+def api_cart_batch():
+    """Apply many cart operations with a single cart write.
+
+    Body: {"sheet": "generales", "ops": [
+        {"op": "add", "key": "...", "id": 3, "qty": 2, "margin": 20, "sheet": "generales"},
+        {"op": "update", "index": 0, "qty": 5},   # or "key" instead of "index"; qty <= 0 removes
+        {"op": "remove", "index": 1}]}
+    Indexes refer to the cart as it was before the batch. Invalid ops are reported in "errors"
+    and skipped; the rest are applied.
+    """
+    payload = request.get_json(silent=True) or {}
+    ops = payload.get("ops")
+    if not isinstance(ops, list):
+        return jsonify({"ok": False, "error": "Formato inválido: se espera una lista 'ops'"}), 400
+    default_sheet = str(payload.get("sheet") or "generales").strip().lower()
+    default_margin = float(session.get("current_client_margin", 20.0) or 0)
+    cart = get_cart()
+    errors = []
+    adds = {}  # sheet -> [(op index, key, id, qty, margin)]
+    qty_by_index = {}  # original index -> new qty (0 removes)
+
+    def _index_of(op):
+        if op.get("key"):
+            return next((i for i, c in enumerate(cart) if c.get("key") == op["key"]), None)
+        try:
+            idx = int(op.get("index"))
+        except (TypeError, ValueError):
+            return None
+        return idx if 0 <= idx < len(cart) else None
+
+    for n, op in enumerate(ops):
+        if not isinstance(op, dict):
+            errors.append({"op": n, "error": "Operación inválida"})
+            continue
+        kind = op.get("op")
+        try:
+            if kind == "add":
+                if not session.get("current_client_name"):
+                    errors.append({"op": n, "error": "Debe seleccionar un cliente registrado antes de agregar al carrito"})
+                    continue
+                sheet_name = str(op.get("sheet") or default_sheet).strip().lower()
+                if sheet_name not in ("generales", "ansioliticos"):
+                    sheet_name = "generales"
+                pid = int(op["id"]) if op.get("id") not in (None, "") else None
+                margin = float(op["margin"]) if op.get("margin") not in (None, "") else default_margin
+                adds.setdefault(sheet_name, []).append((n, str(op.get("key") or "").strip(), pid, max(1, int(op.get("qty", 1))), margin))
+            elif kind in ("update", "remove"):
+                idx = _index_of(op)
+                if idx is None:
+                    errors.append({"op": n, "error": "No se encontró el item"})
+                    continue
+                qty_by_index[idx] = 0 if kind == "remove" else int(op.get("qty", 0))
+            else:
+                errors.append({"op": n, "error": "Operación desconocida"})
+        except (TypeError, ValueError, KeyError):
+            errors.append({"op": n, "error": "Datos inválidos"})
+
+    # Updates and removals first (against the original indexes), then the adds
+    for idx, qty in qty_by_index.items():
+        if qty > 0:
+            cart[idx]["qty"] = qty
+    removed = sorted((idx for idx, qty in qty_by_index.items() if qty <= 0), reverse=True)
+    for idx in removed:
+        cart.pop(idx)
+    added = 0
+    for sheet_name, lines in adds.items():
+        store = load_catalog_cached(sheet_name=sheet_name)["store"]
+        positions = store.lookup([(key, pid) for _, key, pid, _, _ in lines])
+        found = positions >= 0
+        for (n, _, _, _, _), ok in zip(lines, found.tolist()):
+            if not ok:
+                errors.append({"op": n, "error": "Producto no encontrado, actualice la lista de precios"})
+        kept = [line for line, ok in zip(lines, found.tolist()) if ok]
+        items = store.cart_items(positions[found], [line[4] for line in kept], [line[3] for line in kept])
+        for item in items:
+            _cart_merge(cart, item)
+        added += len(items)
+    save_cart(cart)
+    count, total = cart_totals()
+    return jsonify({
+        "ok": True,
+        "cart_count": count,
+        "total": total,
+        "added": added,
+        "updated": sum(1 for qty in qty_by_index.values() if qty > 0),
+        "removed": len(removed),
+        "errors": errors,
+    })
+
+
 @app.route("/checkout", methods=["POST"]) 
 def checkout():
     cart = get_cart()
@@ -1050,101 +3179,30 @@ def checkout():
 
     edit_id = session.get("edit_order_id")
     if edit_id:
-        # Overwrite existing order
-        fpath = os.path.join(ORDERS_DIR, f"{edit_id}.json")
-        try:
-            with open(fpath, "r", encoding="utf-8") as f:
-                existing = json.load(f)
-        except Exception:
-            existing = {"order_id": edit_id, "created_at": now.isoformat(), "state": "Pedido"}
-        # Preserve created_at and state and pdf filename if present
-        order = {
-            "order_id": existing.get("order_id", edit_id),
-            "client_name": client_name,
-            "client_email": client_email,
-            "responsible": responsible,
-            "created_at": existing.get("created_at", now.isoformat()),
-            "items": cart,
-            "total": round(total, 2),
-            "state": existing.get("state", "Pedido"),
-            "pdf_filename": existing.get("pdf_filename"),
-        }
-        with open(fpath, "w", encoding="utf-8") as f:
-            json.dump(order, f, ensure_ascii=False, indent=2)
-        # Regenerate PDF using stored or new filename
-        client_part = _safe_filename(client_name) or "Cliente"
-        pdf_filename = order.get("pdf_filename") or f"Remito - {client_part} - {order['order_id']}.pdf"
-        pdf_path = os.path.join(PDF_DIR, pdf_filename)
-        generate_pdf_remito(pdf_path, order)
-        # Save filename back
-        order["pdf_filename"] = pdf_filename
-        with open(fpath, "w", encoding="utf-8") as f:
-            json.dump(order, f, ensure_ascii=False, indent=2)
-        if db_enabled():
-            try:
-                pdf_bytes = None
-                try:
-                    with open(pdf_path, "rb") as pf:
-                        pdf_bytes = pf.read()
-                except Exception:
-                    pdf_bytes = None
-                db_upsert_history(order, pdf_bytes=pdf_bytes)
-            except Exception:
-                pass
+        # Overwrite existing order, preserving created_at, state and pdf filename if present
+        existing = load_order(edit_id) or {"order_id": edit_id, "created_at": now.isoformat(), "state": "Pedido"}
+    else:
+        existing = {"order_id": now.strftime("%Y%m%d-%H%M%S"), "created_at": now.isoformat(), "state": "Pedido"}
+    order_id = existing.get("order_id", edit_id)
+    client_part = _safe_filename(client_name) or "Cliente"
+    order = {
+        "order_id": order_id,
+        "client_name": client_name,
+        "client_email": client_email,
+        "responsible": responsible,
+        "created_at": existing.get("created_at", now.isoformat()),
+        "items": cart,
+        "total": round(total, 2),
+        "state": existing.get("state", "Pedido"),
+        "pdf_filename": existing.get("pdf_filename") or f"Remito - {client_part} - {order_id}.pdf",
+    }
+    # The stored order is the durable record; PDF and email are done by the checkout workers
+    save_order(order)
+    enqueue_checkout_job(order_id)
+    if edit_id:
         # Clear edit flag after saving
         session.pop("edit_order_id", None)
-    else:
-        # Create new order
-        order_id = now.strftime("%Y%m%d-%H%M%S")
-        order = {
-            "order_id": order_id,
-            "client_name": client_name,
-            "client_email": client_email,
-            "responsible": responsible,
-            "created_at": now.isoformat(),
-            "items": cart,
-            "total": round(total, 2),
-            "state": "Pedido",
-        }
-        with open(os.path.join(ORDERS_DIR, f"{order_id}.json"), "w", encoding="utf-8") as f:
-            json.dump(order, f, ensure_ascii=False, indent=2)
-        # Generate PDF remito
-        client_part = _safe_filename(client_name) or "Cliente"
-        pdf_filename = f"Remito - {client_part} - {order_id}.pdf"
-        pdf_path = os.path.join(PDF_DIR, pdf_filename)
-        generate_pdf_remito(pdf_path, order)
-        # update order with pdf filename for later use
-        order_record = dict(order)
-        order_record["pdf_filename"] = pdf_filename
-        try:
-            ofile = os.path.join(ORDERS_DIR, f"{order_id}.json")
-            with open(ofile, "r", encoding="utf-8") as f:
-                saved = json.load(f)
-            saved["pdf_filename"] = pdf_filename
-            with open(ofile, "w", encoding="utf-8") as f:
-                json.dump(saved, f, ensure_ascii=False, indent=2)
-            order_record = saved
-        except Exception:
-            pass
-        if db_enabled():
-            try:
-                pdf_bytes = None
-                try:
-                    with open(pdf_path, "rb") as pf:
-                        pdf_bytes = pf.read()
-                except Exception:
-                    pdf_bytes = None
-                db_upsert_history(order_record, pdf_bytes=pdf_bytes)
-            except Exception:
-                pass
-
-    # Optional email automation if SMTP configured and email provided
-    if client_email and os.environ.get("SMTP_HOST"):
-        try:
-            send_remito_email(client_email, pdf_path, order)
-            flash("Remito enviado por email", "success")
-        except Exception:
-            flash("No se pudo enviar el email del remito", "error")
+    flash("Pedido guardado. El remito se genera en segundo plano.", "success")
 
     # Clear cart
     save_cart([])
@@ -1158,16 +3216,14 @@ def checkout():
 
 @app.route("/history/<order_id>/to-cart")
 def history_to_cart(order_id: str):
-    fpath = os.path.join(ORDERS_DIR, f"{order_id}.json")
-    if not os.path.exists(fpath):
+    order = load_order(order_id)
+    if order is None:
         flash("Pedido no encontrado", "error")
         return redirect(url_for("history"))
     try:
-        with open(fpath, "r", encoding="utf-8") as f:
-            order = json.load(f)
         # Load items into cart
         items = order.get("items", [])
-        session["cart"] = items
+        save_cart(items)
         # Set client context
         session["current_client_name"] = order.get("client_name", "")
         session["current_client_email"] = order.get("client_email", "")
@@ -1184,19 +3240,53 @@ def history_to_cart(order_id: str):
         return redirect(url_for("history"))
 
 
-def generate_pdf_remito(pdf_path: str, order: dict):
-    c = canvas.Canvas(pdf_path, pagesize=A4)
-    width, height = A4
-    margin = 15 * mm
+# Page and column geometry shared by the PDF renderers, computed once at import
+_PDF_WIDTH, _PDF_HEIGHT = A4
+_PDF_MARGIN = 15 * mm
+# Remito columns (right-aligned from the right margin)
+_REMITO_X_SUBT = _PDF_WIDTH - _PDF_MARGIN     # Subtotal at far right
+_REMITO_X_CANT = _REMITO_X_SUBT - 45          # Cantidad (right edge)
+_REMITO_X_PUNIT = _REMITO_X_CANT - 60         # P.Unit (right edge)
+_REMITO_X_VENC = _REMITO_X_PUNIT - 80         # Venc. (right edge)
+_REMITO_X_PROD = _PDF_MARGIN                  # Producto starts at left margin
+_REMITO_X_CANT_CENTER = (_REMITO_X_PUNIT + _REMITO_X_CANT) / 2.0  # quantity is centered in its column
+_REMITO_NAME_WIDTH = _REMITO_X_VENC - _REMITO_X_PROD - 6  # product name must end before Venc. (small padding)
+# Product list columns
+_LIST_X_NAME = _PDF_MARGIN
+_LIST_X_VENC = _PDF_WIDTH - _PDF_MARGIN - 120
+_LIST_X_PRICE = _PDF_WIDTH - _PDF_MARGIN - 40
+_LIST_NAME_WIDTH = _LIST_X_VENC - _LIST_X_NAME - 6
+
+
+@lru_cache(maxsize=32768)
+def _fit_text(text: str, font: str, size: float, max_width: float) -> str:
+    """text, or its longest prefix plus an ellipsis that fits max_width.
+
+    Binary search over the prefix length (widths grow with the prefix), so a name costs
+    O(log n) stringWidth calls instead of one per dropped character. Memoized because the
+    same names repeat across remitos and catalog exports.
+    """
+    if stringWidth(text, font, size) <= max_width:
+        return text
+    ell = "…"
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if stringWidth(text[:mid] + ell, font, size) <= max_width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + ell
 
-    # Column positions (right-aligned from the right margin)
-    x_subt = width - margin            # Subtotal at far right
-    x_cant = x_subt - 45               # Cantidad (right edge)
-    x_punit = x_cant - 60              # P.Unit (right edge)
-    x_venc = x_punit - 80              # Venc. (right edge)
-    x_prod = margin                    # Producto starts at left margin
-    # For quantity, compute center point within its column to center-align the number
-    x_cant_center = (x_punit + x_cant) / 2.0
+
+def generate_pdf_remito(order: dict) -> bytes:
+    """Render the remito in memory; callers fan the same bytes out to disk, DB and email."""
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4)
+    width, height = _PDF_WIDTH, _PDF_HEIGHT
+    margin = _PDF_MARGIN
+    x_subt, x_cant, x_punit, x_venc = _REMITO_X_SUBT, _REMITO_X_CANT, _REMITO_X_PUNIT, _REMITO_X_VENC
+    x_prod, x_cant_center = _REMITO_X_PROD, _REMITO_X_CANT_CENTER
 
     y = height - margin
     c.setFont("Helvetica-Bold", 14)
@@ -1233,18 +3323,9 @@ def generate_pdf_remito(pdf_path: str, order: dict):
             y = draw_header(y)
             c.setFont("Helvetica", 9)
 
-        # Ensure product name fits before Venc.
-        available_w = x_venc - x_prod - 6  # small padding
+        # Ensure product name fits before Venc. (truncated with ellipsis if too wide)
         name = str(item["name"]) if item.get("name") else ""
-        # Truncate with ellipsis if too wide
-        max_w = available_w
-        if stringWidth(name, "Helvetica", 9) > max_w:
-            ell = "…"
-            while name and stringWidth(name + ell, "Helvetica", 9) > max_w:
-                name = name[:-1]
-            name = name + ell
-
-        c.drawString(x_prod, y, name)
+        c.drawString(x_prod, y, _fit_text(name, "Helvetica", 9, _REMITO_NAME_WIDTH))
         venc = str(item.get("vencimiento", "")).strip()
         if not venc:
             venc = "-"
@@ -1268,9 +3349,10 @@ def generate_pdf_remito(pdf_path: str, order: dict):
 
     c.showPage()
     c.save()
+    return buffer.getvalue()
 
 
-def send_remito_email(to_email: str, pdf_path: str, order: dict):
+def send_remito_email(to_email: str, pdf_bytes: bytes, pdf_filename: str, order: dict):
     host = os.environ.get("SMTP_HOST")
     port = int(os.environ.get("SMTP_PORT", "587"))
     user = os.environ.get("SMTP_USER")
@@ -1289,9 +3371,7 @@ def send_remito_email(to_email: str, pdf_path: str, order: dict):
         f"Saludos."
     )
     msg.set_content(body)
-    with open(pdf_path, "rb") as f:
-        data = f.read()
-    msg.add_attachment(data, maintype="application", subtype="pdf", filename=os.path.basename(pdf_path))
+    msg.add_attachment(pdf_bytes, maintype="application", subtype="pdf", filename=os.path.basename(pdf_filename))
 
     with smtplib.SMTP(host, port) as s:
         s.starttls()
@@ -1299,26 +3379,213 @@ def send_remito_email(to_email: str, pdf_path: str, order: dict):
         s.send_message(msg)
 
 
+def _atomic_write(path: str, data: bytes) -> None:
+    """Write a file atomically (temp file + rename), so a crash never leaves half a file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _write_order_file(order: dict) -> None:
+    """Export orders/<id>.json and record it in the file manifest, so the sync doesn't re-import our own write."""
+    name = f"{order['order_id']}.json"
+    path = os.path.join(ORDERS_DIR, name)
+    raw = json.dumps(order, ensure_ascii=False, indent=2).encode("utf-8")
+    _atomic_write(path, raw)
+    st = os.stat(path)
+    with _sql_tx(db_enabled()) as run:
+        _manifest_upsert_rows(run, [{
+            "path": f"orders/{name}", "mtime": st.st_mtime, "size": st.st_size,
+            "sha256": hashlib.sha256(raw).hexdigest(),
+        }])
+
+
+def _checkout_executor() -> ThreadPoolExecutor:
+    """Worker pool, created on first use. Also resumes jobs left pending by a previous process."""
+    global _CHECKOUT_EXECUTOR
+    if _CHECKOUT_EXECUTOR is not None:
+        return _CHECKOUT_EXECUTOR
+    with _CHECKOUT_EXECUTOR_LOCK:
+        if _CHECKOUT_EXECUTOR is None:
+            _CHECKOUT_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, _CHECKOUT_WORKERS), thread_name_prefix="checkout")
+            now = time.time()
+            with _sql_tx(False) as run:
+                run(
+                    "UPDATE checkout_jobs SET status = 'pending' WHERE status = 'running' AND updated_at < :stale",
+                    {"stale": now - _CHECKOUT_JOB_STALE},
+                )
+                pending = run("SELECT order_id FROM checkout_jobs WHERE status = 'pending' ORDER BY created_at")
+            _checkout_jobs_prune()
+            for row in pending:
+                _CHECKOUT_EXECUTOR.submit(_run_checkout_job, row["order_id"])
+    return _CHECKOUT_EXECUTOR
+
+
+def enqueue_checkout_job(order_id: str) -> None:
+    """Record a job for the saved order (replacing any previous one) and hand it to the pool."""
+    now = time.time()
+    with _sql_tx(False) as run:
+        run(
+            """
+            INSERT INTO checkout_jobs (order_id, status, steps, attempts, error, created_at, updated_at)
+            VALUES (:id, 'pending', '', 0, NULL, :now, :now)
+            ON CONFLICT (order_id) DO UPDATE SET status = 'pending', steps = '', attempts = 0, error = NULL, updated_at = :now
+            """,
+            {"id": order_id, "now": now},
+        )
+    _checkout_executor().submit(_run_checkout_job, order_id)
+
+
+def _checkout_jobs_prune() -> None:
+    """Drop done/failed jobs older than CHECKOUT_JOB_KEEP_DAYS (at most once an hour per process)."""
+    global _CHECKOUT_JOB_LAST_PRUNE
+    now = time.time()
+    if now - _CHECKOUT_JOB_LAST_PRUNE < 3600:
+        return
+    _CHECKOUT_JOB_LAST_PRUNE = now
+    with _sql_tx(False) as run:
+        run(
+            "DELETE FROM checkout_jobs WHERE status IN ('done', 'failed') AND updated_at < :cutoff",
+            {"cutoff": now - _CHECKOUT_JOB_KEEP},
+        )
+
+
+def _checkout_job_update(order_id: str, **fields) -> None:
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{k} = :{k}" for k in fields)
+    with _sql_tx(False) as run:
+        run(f"UPDATE checkout_jobs SET {assignments} WHERE order_id = :order_id", {**fields, "order_id": order_id})
+
+
+def _run_checkout_job(order_id: str) -> None:
+    """Render the remito, attach it to the stored order and email it. Finished steps are recorded,
+    so a retry after a failure (e.g. SMTP down) doesn't send the email twice."""
+    with _sql_tx(False) as run:
+        claimed = run(
+            "UPDATE checkout_jobs SET status = 'running', updated_at = :now WHERE order_id = :id AND status = 'pending' RETURNING steps, attempts",
+            {"id": order_id, "now": time.time()},
+        )
+    if not claimed:
+        return  # already taken by another worker/process, or removed
+    steps = [st for st in (claimed[0]["steps"] or "").split(",") if st]
+    attempts = int(claimed[0]["attempts"] or 0) + 1
+    try:
+        order = load_order(order_id)
+        if order is None:
+            raise FileNotFoundError(f"pedido {order_id} no encontrado")
+        # Dashboard rollups (idempotent: replaces this order's previous contribution)
+        sales_rollup_apply(order)
+        pdf_path = os.path.join(PDF_DIR, order["pdf_filename"])
+        # Rendered once in memory; the same bytes go to disk, the order store and the email
+        pdf_bytes = None
+        if "pdf" in steps:
+            # Retry after the PDF step already succeeded
+            try:
+                with open(pdf_path, "rb") as pf:
+                    pdf_bytes = pf.read()
+            except OSError:
+                pdf_bytes = None
+        if pdf_bytes is None:
+            pdf_bytes = generate_pdf_remito(order)
+            _atomic_write(pdf_path, pdf_bytes)
+            if "pdf" not in steps:
+                steps.append("pdf")
+            _checkout_job_update(order_id, steps=",".join(steps))
+        if "db" not in steps:
+            save_order_pdf(order_id, order["pdf_filename"], pdf_bytes)
+            steps.append("db")
+            _checkout_job_update(order_id, steps=",".join(steps))
+        # Optional email automation if SMTP configured and email provided
+        if order.get("client_email") and os.environ.get("SMTP_HOST") and "email" not in steps:
+            send_remito_email(order["client_email"], pdf_bytes, order["pdf_filename"], order)
+            steps.append("email")
+        _checkout_job_update(order_id, status="done", steps=",".join(steps), attempts=attempts, error=None)
+        _checkout_jobs_prune()
+    except Exception as e:
+        retry = attempts < _CHECKOUT_JOB_MAX_ATTEMPTS and not isinstance(e, FileNotFoundError)
+        _checkout_job_update(
+            order_id,
+            status="pending" if retry else "failed",
+            steps=",".join(steps),
+            attempts=attempts,
+            error=f"{type(e).__name__}: {e}"[:500],
+        )
+        if retry:
+            # Back off 5s, 10s, 20s... before trying again
+            timer = threading.Timer(5 * 2 ** (attempts - 1), lambda: _checkout_executor().submit(_run_checkout_job, order_id))
+            timer.daemon = True
+            timer.start()
+
+
+def checkout_job_statuses(order_ids) -> dict:
+    """{order_id: {"status", "error"}} for the checkout jobs of the given orders (one history page)."""
+    _checkout_executor()
+    order_ids = list(order_ids)
+    if not order_ids:
+        return {}
+    params = {f"id{i}": oid for i, oid in enumerate(order_ids)}
+    placeholders = ", ".join(f":{k}" for k in params)
+    with _sql_tx(False, readonly=True) as run:
+        rows = run(f"SELECT order_id, status, error FROM checkout_jobs WHERE order_id IN ({placeholders})", params)
+    return {r["order_id"]: r for r in rows}
+
+
+def checkout_jobs_stats() -> dict:
+    with _sql_tx(False, readonly=True) as run:
+        rows = run("SELECT status, COUNT(*) AS n FROM checkout_jobs GROUP BY status")
+    return {r["status"]: int(r["n"]) for r in rows}
+
+
 @app.route("/remitos/<path:filename>")
 def download_remito(filename):
     # Try local file first
     local_path = os.path.join(PDF_DIR, filename)
     if os.path.isfile(local_path):
         return send_from_directory(PDF_DIR, filename, as_attachment=True)
-    # Fallback to DB if available
-    if db_enabled():
-        try:
-            eng = _get_engine()
-            with eng.begin() as conn:
-                row = conn.execute(_sql_text(
-                    "SELECT pdf_data FROM historial WHERE pdf_filename = :fn"
-                ), {"fn": filename}).first()
-            if row and row[0]:
-                buf = BytesIO(row[0])
-                buf.seek(0)
-                return send_file(buf, mimetype="application/pdf", as_attachment=True, download_name=filename)
-        except Exception:
-            pass
+    # Otherwise the remito blob of the order that names it (historial_pdf_filename_idx)
+    try:
+        use_db = db_enabled()
+        with _sql_tx(use_db, readonly=True) as run:
+            rows = run(
+                """
+                SELECT b.sha256, b.size, (b.data IS NULL) AS on_disk, (h.pdf_data IS NOT NULL) AS inline
+                FROM historial h LEFT JOIN remito_blobs b ON b.sha256 = h.pdf_sha256
+                WHERE h.pdf_filename = :fn AND (h.pdf_sha256 IS NOT NULL OR h.pdf_data IS NOT NULL)
+                LIMIT 1
+                """,
+                {"fn": filename},
+            )
+            if rows and rows[0]["sha256"] is None and rows[0]["inline"]:
+                # Not moved to the blob store yet
+                inline = run("SELECT pdf_data FROM historial WHERE pdf_filename = :fn AND pdf_data IS NOT NULL LIMIT 1", {"fn": filename})
+                return send_file(
+                    BytesIO(bytes(inline[0]["pdf_data"])), mimetype="application/pdf",
+                    as_attachment=True, download_name=filename, conditional=True,
+                )
+        if rows and rows[0]["sha256"]:
+            sha, size = rows[0]["sha256"], int(rows[0]["size"])
+            # Content-addressed, so the hash is a strong ETag; Range requests are served too
+            if rows[0]["on_disk"]:
+                return send_file(
+                    _blob_path(sha), mimetype="application/pdf", as_attachment=True,
+                    download_name=filename, etag=sha, conditional=True,
+                )
+            rv = send_file(
+                _BlobReader(sha, size, use_db), mimetype="application/pdf", as_attachment=True,
+                download_name=filename, etag=sha, conditional=False,
+            )
+            rv.content_length = size
+            return rv.make_conditional(request, accept_ranges=True, complete_length=size)
+    except Exception:
+        pass
     # Not found
     flash("Archivo de remito no disponible", "error")
     return redirect(url_for("history"))
@@ -1326,103 +3593,53 @@ def download_remito(filename):
 
 @app.route("/history")
 def history():
-    """List saved orders for demo purposes."""
-    import json
+    """Saved orders, newest first, one keyset page at a time (?before=/?after= cursors)."""
     raw_q = request.args.get("q", "").strip()
-    q_lower = raw_q.lower()
-    orders = []
-    if db_enabled():
-        _sync_history_from_files()
-        orders = db_list_history(raw_q) or []
-    else:
-        if os.path.isdir(ORDERS_DIR):
-            for fname in os.listdir(ORDERS_DIR):
-                if not fname.endswith(".json"):
-                    continue
-                fpath = os.path.join(ORDERS_DIR, fname)
-                try:
-                    with open(fpath, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                    order_id = data.get("order_id", os.path.splitext(fname)[0])
-                    created_at = data.get("created_at", "")
-                    created_display = ""
-                    try:
-                        if created_at:
-                            dt = datetime.fromisoformat(created_at)
-                            created_display = dt.strftime("%d/%m/%Y")
-                    except Exception:
-                        created_display = created_at[:10]
-                    client_name = data.get("client_name", "")
-                    total = data.get("total", 0)
-                    responsible = data.get("responsible", "")
-                    pdf_name = data.get("pdf_filename")
-                    if pdf_name:
-                        pdf_exists = os.path.exists(os.path.join(PDF_DIR, pdf_name))
-                    else:
-                        legacy = f"remito-{order_id}.pdf"
-                        pdf_exists = os.path.exists(os.path.join(PDF_DIR, legacy))
-                        pdf_name = legacy if pdf_exists else None
-                    orders.append({
-                        "order_id": order_id,
-                        "created_at": created_at,
-                        "created_display": created_display,
-                        "client_name": client_name,
-                        "responsible": responsible,
-                        "total": total,
-                        "pdf_name": pdf_name if pdf_exists else None,
-                        "filename": fname,
-                    })
-                except Exception:
-                    continue
-        if q_lower:
-            orders = [o for o in orders if q_lower in (o.get("client_name", "").lower())]
-        orders.sort(key=lambda x: (x.get("created_at", ""), x.get("order_id", "")), reverse=True)
-    return render_template("history.html", orders=orders, q=raw_q)
+    before = request.args.get("before") or None
+    after = request.args.get("after") or None
+    try:
+        per_page = max(1, min(int(request.args.get("per_page", "50")), 200))
+    except ValueError:
+        per_page = 50
+    orders, has_more = list_orders(raw_q, limit=per_page, before=before, after=after)
+    jobs = checkout_job_statuses(o.get("order_id") for o in orders)
+    for o in orders:
+        job = jobs.get(o.get("order_id"))
+        o["job_status"] = job["status"] if job else None
+        o["job_error"] = job["error"] if job else None
+    # Older rows exist past the last one; newer rows exist before the first one
+    older_cursor = orders[-1]["cursor"] if orders and (has_more if not after else True) else None
+    newer_cursor = orders[0]["cursor"] if orders and (has_more if after else bool(before)) else None
+    return render_template(
+        "history.html", orders=orders, q=raw_q,
+        older_cursor=older_cursor, newer_cursor=newer_cursor, per_page=per_page,
+    )
 
 
 @app.route("/history/delete", methods=["POST"])
 def history_delete():
     filename = request.form.get("filename", "").strip()
-    order_id_form = request.form.get("order_id", "").strip()
-    if not filename or not filename.endswith(".json"):
-        flash("Archivo inválido", "error")
+    order_id = request.form.get("order_id", "").strip() or os.path.splitext(filename)[0]
+    if not order_id:
+        flash("Pedido inválido", "error")
         return redirect(url_for("history"))
-    import json as _json
-    fpath = os.path.join(ORDERS_DIR, filename)
     try:
-        pdf_to_remove = None
-        order_id = order_id_form or os.path.splitext(filename)[0]
-        if os.path.isfile(fpath):
+        order = load_order(order_id) or {}
+        pdf_to_remove = order.get("pdf_filename") or f"remito-{order_id}.pdf"
+        delete_order(order_id)
+        pdf_path = os.path.join(PDF_DIR, pdf_to_remove)
+        if os.path.isfile(pdf_path):
             try:
-                with open(fpath, "r", encoding="utf-8") as f:
-                    data = _json.load(f)
-                order_id = data.get("order_id", order_id)
-                pdf_name = data.get("pdf_filename")
-                if not pdf_name:
-                    # legacy fallback
-                    order_id = data.get("order_id", os.path.splitext(filename)[0])
-                    legacy = f"remito-{order_id}.pdf"
-                    legacy_path = os.path.join(PDF_DIR, legacy)
-                    if os.path.isfile(legacy_path):
-                        pdf_to_remove = legacy
-                else:
-                    pdf_to_remove = pdf_name
+                os.remove(pdf_path)
             except Exception:
                 pass
-            os.remove(fpath)
-        if pdf_to_remove:
-            pdf_path = os.path.join(PDF_DIR, pdf_to_remove)
-            if os.path.isfile(pdf_path):
-                try:
-                    os.remove(pdf_path)
-                except Exception:
-                    pass
         flash("Remito eliminado", "success")
-        if db_enabled():
-            try:
-                db_delete_history(order_id)
-            except Exception:
-                pass
+        with _sql_tx(False) as run:
+            run("DELETE FROM checkout_jobs WHERE order_id = :id", {"id": order_id})
+        try:
+            sales_rollup_remove(order_id)
+        except Exception:
+            pass
     except Exception:
         flash("No se pudo eliminar el remito", "error")
     return redirect(url_for("history"))
@@ -1506,7 +3723,7 @@ def clients_use(cid: int):
     # If client changed, clear cart
     prev_id = session.get("current_client_id")
     if prev_id != cid:
-        session["cart"] = []
+        save_cart([])
     session["current_client_id"] = cid
     session["current_client_name"] = client.get("name")
     session["current_client_margin"] = client.get("default_margin", 20.0)
@@ -1535,7 +3752,7 @@ def clients_delete(cid: int):
     if session.get("current_client_id") == cid:
         for key in ("current_client_id", "current_client_name", "current_client_margin", "current_client_email"):
             session.pop(key, None)
-        session["cart"] = []
+        save_cart([])
         session.modified = True
     flash("Cliente eliminado", "success")
     return redirect(url_for("clients_list"))
@@ -1546,7 +3763,7 @@ def products():
     sheet_name = request.args.get("sheet", "generales").strip().lower()
     if sheet_name not in ("generales", "ansioliticos"):
         sheet_name = "generales"
-    df = load_products_cached(sheet_name=sheet_name)
+    catalog = load_catalog_cached(sheet_name=sheet_name)
     q = request.args.get("q", "").strip().lower()
     client_query = request.args.get("client", "").strip()
     # Pagination for initial render
@@ -1565,21 +3782,18 @@ def products():
     if margin is None:
         margin = session.get("current_client_margin", 20.0)
     margin = float(margin or 0)
-    if q:
-        df = df[df["name_lc"].str.contains(q)]
     # Paginate first, then compute price for the slice only
-    total_count = len(df)
-    total_pages = (total_count + per_page - 1) // per_page if per_page > 0 else 1
-    start = (page - 1) * per_page
-    end = start + per_page
-    df_page = df.iloc[start:end].copy() if total_count > 0 else df.iloc[0:0].copy()
-    df_page["final_price"] = (df_page["cost"] * (1 + margin / 100)).round(2)
+    positions = _search_catalog(catalog, q)
+    store = catalog["store"]
+    total_count = len(positions) if positions is not None else len(store)
+    total_pages, start, end = _paginate(total_count, page, per_page)
+    page_positions = positions[start:end] if positions is not None else range(start, max(start, end))
     current_client_name = session.get("current_client_name")
     # Provide clients list for suggestions/validation from DB when available
     clients_src = db_list_clients("") if db_enabled() else load_clients()
     return render_template(
         "products.html",
-        products=df_page[["id","name","vencimiento","cost","final_price"]].to_dict(orient="records"),
+        products=store.records(page_positions, margin),
         margin=margin,
         q=q,
         current_client_name=current_client_name,
@@ -1603,138 +3817,287 @@ def order_new():
 
 
 # Simple pipeline view from saved orders
-@app.route("/pipeline")
-def pipeline_view():
-    columns = {"Pedido": [], "Enviado": [], "Entregado (A cobrar)": [], "Cobrado": []}
-    # Optional filters
-    month_q = request.args.get("month", "").strip()
-    day_q = request.args.get("day", "").strip()
+_PIPELINE_COLUMN_LIMIT = int(os.environ.get("PIPELINE_COLUMN_LIMIT", "50"))  # cards per column before "Ver más"
+
+
+def _pipeline_state_filter(state: str) -> tuple[str, dict]:
+    """WHERE clause for a board column; "Pedido" also takes legacy and unknown states."""
+    if state != "Pedido":
+        return "state = :state", {"state": state}
+    others = [s for s in PIPELINE_STATES if s != "Pedido"]
+    params = {f"other{i}": s for i, s in enumerate(others)}
+    return f"(state IS NULL OR state NOT IN ({', '.join(':' + k for k in params)}))", params
+
+
+def _pipeline_date_range(year: int | None, month: int | None, day: int | None):
+    """[start, end) for the "Cobrado" filters, or None. A day without a month means this month."""
+    if not (year or month or day):
+        return None
+    today = date.today()
+    year = year or today.year
     try:
-        month_sel = int(month_q) if month_q else None
+        if day:
+            start = date(year, month or today.month, day)
+            return start, start + timedelta(days=1)
+        if month:
+            return date(year, month, 1), date(year + month // 12, month % 12 + 1, 1)
+        return date(year, 1, 1), date(year + 1, 1, 1)
     except ValueError:
-        month_sel = None
+        return None
+
+
+def _pipeline_range_params(date_range, use_db: bool) -> dict:
+    start, end = date_range
+    if use_db:
+        return {"d_from": datetime(start.year, start.month, start.day, tzinfo=timezone.utc),
+                "d_to": datetime(end.year, end.month, end.day, tzinfo=timezone.utc)}
+    # The local store keeps ISO text, so date strings bound it
+    return {"d_from": start.isoformat(), "d_to": end.isoformat()}
+
+
+def pipeline_column(state: str, limit: int, before: str | None = None, date_range=None):
+    """One board column, newest first, via historial_state_idx. Returns (cards, has_more)."""
+    use_db = db_enabled()
+    where, params = _pipeline_state_filter(state)
+    where = [where]
+    if date_range:
+        where.append("created_at >= :d_from AND created_at < :d_to")
+        params.update(_pipeline_range_params(date_range, use_db))
+    cursor = _parse_history_cursor(before)
+    if cursor:
+        params["c_ts"], params["c_id"] = cursor
+        where.append("(created_at, order_id) < (CAST(:c_ts AS TIMESTAMPTZ), :c_id)" if use_db else "(created_at, order_id) < (:c_ts, :c_id)")
+    params["limit"] = int(limit) + 1
+    with _sql_tx(use_db, readonly=True) as run:
+        rows = run(
+            f"""
+            SELECT order_id, client_name, responsible, created_at, total, pdf_filename, version
+            FROM historial WHERE {" AND ".join(where)}
+            ORDER BY created_at DESC, order_id DESC LIMIT :limit
+            """,
+            params,
+        )
+    has_more = len(rows) > limit
+    cards = []
+    for r in rows[:limit]:
+        created_at = r.get("created_at")
+        cards.append({
+            "order_id": r.get("order_id"),
+            "client_name": r.get("client_name"),
+            "created_at": created_at.isoformat() if isinstance(created_at, datetime) else str(created_at or ""),
+            "total": float(r.get("total") or 0),
+            "responsible": r.get("responsible"),
+            "state": state,
+            "version": int(r.get("version") or 0),
+            "pdf_filename": r.get("pdf_filename"),
+            "cursor": _history_cursor(created_at, r.get("order_id")),
+        })
+    return cards, has_more
+
+
+def pipeline_column_stats(date_range=None) -> dict:
+    """{state: {"count", "total"}} per board column; the date range only applies to "Cobrado"."""
+    use_db = db_enabled()
+    params = {}
+    where = ""
+    if date_range:
+        where = "WHERE state IS NULL OR state <> 'Cobrado' OR (created_at >= :d_from AND created_at < :d_to)"
+        params.update(_pipeline_range_params(date_range, use_db))
+    with _sql_tx(use_db, readonly=True) as run:
+        rows = run(f"SELECT state, COUNT(*) AS n, SUM(total) AS total FROM historial {where} GROUP BY state", params)
+    stats = {state: {"count": 0, "total": 0.0} for state in PIPELINE_STATES}
+    for r in rows:
+        col = stats.get(r["state"]) or stats["Pedido"]
+        col["count"] += int(r["n"] or 0)
+        col["total"] += float(r["total"] or 0)
+    return stats
+
+
+def _pipeline_first_year() -> int:
+    with _sql_tx(db_enabled(), readonly=True) as run:
+        rows = run("SELECT created_at FROM historial WHERE created_at IS NOT NULL ORDER BY created_at ASC LIMIT 1")
+    if rows:
+        first = rows[0]["created_at"]
+        try:
+            return first.year if isinstance(first, datetime) else int(str(first)[:4])
+        except ValueError:
+            pass
+    return date.today().year
+
+
+@app.route("/pipeline")
+def pipeline_view():
+    """Board with one indexed query per column (PIPELINE_COLUMN_LIMIT cards each, "Ver más" pages
+    on with ?col=<index>&before=<cursor>) and per-column counts and totals.
+    With &partial=1 only that column's page is queried and rendered, as a fragment."""
+    def _int_arg(name):
+        try:
+            return int(request.args.get(name, "").strip() or 0) or None
+        except ValueError:
+            return None
+    # Optional filters, applied only to "Cobrado"
+    year_sel, month_sel, day_sel = _int_arg("year"), _int_arg("month"), _int_arg("day")
+    date_range = _pipeline_date_range(year_sel, month_sel, day_sel)
+    more_col = _int_arg("col")
+    before = request.args.get("before") or None
+    if request.args.get("partial") and more_col and more_col <= len(PIPELINE_STATES):
+        state = PIPELINE_STATES[more_col - 1]
+        cards, has_more = pipeline_column(
+            state, _PIPELINE_COLUMN_LIMIT, before=before,
+            date_range=date_range if state == "Cobrado" else None,
+        )
+        return render_template(
+            "_pipeline_column.html", col=state, idx=more_col, cards=cards,
+            more_cursor=cards[-1]["cursor"] if has_more and cards else None,
+            year_sel=year_sel, month_sel=month_sel, day_sel=day_sel,
+        )
+    columns, more = {}, {}
+    for i, state in enumerate(PIPELINE_STATES, start=1):
+        cards, has_more = pipeline_column(
+            state, _PIPELINE_COLUMN_LIMIT,
+            before=before if more_col == i else None,
+            date_range=date_range if state == "Cobrado" else None,
+        )
+        columns[state] = cards
+        more[state] = cards[-1]["cursor"] if has_more and cards else None
+    this_year = date.today().year
+    return render_template(
+        "pipeline.html", columns=columns, more=more, stats=pipeline_column_stats(date_range),
+        year_sel=year_sel, month_sel=month_sel, day_sel=day_sel,
+        years=list(range(this_year, min(_pipeline_first_year(), this_year) - 1, -1)),
+    )
+
+
+def _parse_version(raw) -> int | None:
     try:
-        day_sel = int(day_q) if day_q else None
-    except ValueError:
-        day_sel = None
-    if db_enabled():
-        # Ensure DB contains existing file-based orders once
-        _sync_history_from_files()
-        rows = db_list_history("") or []
-        for r in rows:
-            state = (r.get("state") or "Pedido") or "Pedido"
-            if state in ("Oportunidad", "Remito"):
-                state = "Pedido"
-            if state not in columns:
-                state = "Pedido"
-            # Apply date filters ONLY to 'Cobrado'
-            if state == "Cobrado" and (month_sel or day_sel):
-                created_at = r.get("created_at", "")
-                try:
-                    dt = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
-                    if month_sel and dt.month != month_sel:
-                        continue
-                    if day_sel and dt.day != day_sel:
-                        continue
-                except Exception:
-                    continue
-            columns[state].append({
-                "order_id": r.get("order_id"),
-                "client_name": r.get("client_name"),
-                "created_at": r.get("created_at"),
-                "total": r.get("total"),
-                "responsible": r.get("responsible"),
-                "state": state,
-                "pdf_filename": r.get("pdf_name") or r.get("pdf_filename"),
-            })
-    else:
-        if os.path.isdir(ORDERS_DIR):
-            for fname in os.listdir(ORDERS_DIR):
-                if not fname.endswith(".json"):
-                    continue
-                try:
-                    with open(os.path.join(ORDERS_DIR, fname), "r", encoding="utf-8") as f:
-                        order = json.load(f)
-                    state = order.get("state", "Pedido")
-                    if state in ("Oportunidad", "Remito"):
-                        state = "Pedido"
-                    if state not in columns:
-                        state = "Pedido"
-                    if state == "Cobrado" and (month_sel or day_sel):
-                        created_at = order.get("created_at", "")
-                        try:
-                            dt = datetime.fromisoformat(created_at)
-                            if month_sel and dt.month != month_sel:
-                                continue
-                            if day_sel and dt.day != day_sel:
-                                continue
-                        except Exception:
-                            continue
-                    columns[state].append(order)
-                except Exception:
-                    continue
-    # Sort each column by created_at desc
-    for k in columns:
-        columns[k].sort(key=lambda o: o.get("created_at", ""), reverse=True)
-    return render_template("pipeline.html", columns=columns, month_sel=month_sel, day_sel=day_sel)
+        return int(raw) if raw not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+_PIPELINE_MOVE_ERRORS = {
+    "missing": "Pedido no encontrado",
+    "conflict": "El pedido fue modificado mientras tanto; se recargó el pipeline",
+}
 
 
 @app.route("/pipeline/<order_id>/state", methods=["POST"])
 def pipeline_set_state(order_id: str):
     new_state = request.form.get("state", "")
-    fpath = os.path.join(ORDERS_DIR, f"{order_id}.json")
-    if not os.path.exists(fpath):
-        flash("Pedido no encontrado", "error")
+    if new_state not in PIPELINE_STATES:
+        flash("Estado inválido", "error")
         return redirect(url_for("pipeline_view"))
     try:
-        with open(fpath, "r", encoding="utf-8") as f:
-            order = json.load(f)
-        order["state"] = new_state
-        with open(fpath, "w", encoding="utf-8") as f:
-            json.dump(order, f, ensure_ascii=False, indent=2)
-        if db_enabled():
-            try:
-                db_upsert_history(order)
-            except Exception:
-                pass
-        flash("Estado actualizado", "success")
+        result = set_order_state(order_id, new_state, _parse_version(request.form.get("version")), changed_by=session.get("user"))
+        if result["ok"]:
+            flash("Estado actualizado", "success")
+        else:
+            flash(_PIPELINE_MOVE_ERRORS[result["error"]], "error")
+    except Exception:
+        flash("No se pudo actualizar el estado", "error")
+    return redirect(url_for("pipeline_view"))
+
+
+@app.route("/pipeline/state", methods=["POST"])
+def pipeline_set_states():
+    """Move the checked cards (form field "move" = "<order_id>|<version>") to one state."""
+    new_state = request.form.get("state", "")
+    if new_state not in PIPELINE_STATES:
+        flash("Estado inválido", "error")
+        return redirect(url_for("pipeline_view"))
+    moves = []
+    for raw in request.form.getlist("move"):
+        order_id, _, version = raw.partition("|")
+        if order_id:
+            moves.append((order_id, new_state, _parse_version(version)))
+    if not moves:
+        flash("No se seleccionó ningún pedido", "error")
+        return redirect(url_for("pipeline_view"))
+    try:
+        results = set_order_states(moves, changed_by=session.get("user"))
+        moved = sum(1 for r in results if r["ok"])
+        failed = len(results) - moved
+        if moved:
+            flash(f"{moved} pedido(s) actualizados", "success")
+        if failed:
+            flash(f"{failed} pedido(s) no se actualizaron: fueron modificados o eliminados", "error")
     except Exception:
         flash("No se pudo actualizar el estado", "error")
     return redirect(url_for("pipeline_view"))
 
 
+@app.route("/api/pipeline/state", methods=["POST"])
+def api_pipeline_state():
+    """Bulk pipeline moves.
+
+    Body: {"moves": [{"order_id": "...", "state": "Enviado", "version": 3}, ...]} ("version" is
+    optional; when given, a move on an order changed since then fails with "conflict").
+    Returns one result per move with the new version.
+    """
+    payload = request.get_json(silent=True) or {}
+    raw_moves = payload.get("moves")
+    if not isinstance(raw_moves, list):
+        return jsonify({"ok": False, "error": "Formato inválido: se espera una lista 'moves'"}), 400
+    moves, errors = [], []
+    for n, m in enumerate(raw_moves):
+        if not isinstance(m, dict) or not m.get("order_id") or m.get("state") not in PIPELINE_STATES:
+            errors.append({"move": n, "error": "Movimiento inválido"})
+            continue
+        moves.append((str(m["order_id"]), m["state"], _parse_version(m.get("version"))))
+    results = set_order_states(moves, changed_by=session.get("user")) if moves else []
+    return jsonify({"ok": True, "results": results, "errors": errors})
+
+
 # Exportar listado de productos a PDF con margen elegido
 @app.route("/products/export-pdf")
 def products_export_pdf():
     sheet_name = request.args.get("sheet", "generales").strip().lower()
     if sheet_name not in ("generales", "ansioliticos"):
         sheet_name = "generales"
-    df = load_products_cached(sheet_name=sheet_name)
+    catalog = load_catalog_cached(sheet_name=sheet_name)
     q = request.args.get("q", "").strip().lower()
     margin = request.args.get("margin")
     if margin is None:
         margin = session.get("current_client_margin", 20.0)
     margin = float(margin or 0)
-    if q:
-        df = df[df["name_lc"].str.contains(q)]
-    df = df.copy()
-    df["final_price"] = (df["cost"] * (1 + margin / 100)).round(2)
-
     sheet_display = "Productos Generales" if sheet_name == "generales" else "Ansioliticos"
-    buf = _generate_pdf_product_list(df.to_dict(orient="records"), margin, sheet_display)
-    filename = f"Catalogo - {sheet_display} - {datetime.now().strftime('%Y%m%d-%H%M')}.pdf"
-    return send_file(buf, mimetype="application/pdf", as_attachment=True, download_name=filename)
+    # Same catalog version + filter + margin gives the same PDF: render once, serve from memory after.
+    # The render time is cached with the bytes, so the printed "Generado" and the filename always agree
+    cache_key = (sheet_name, catalog.get("version"), q, margin)
+    cacheable = catalog.get("version") is not None
+    cached = _CATALOG_PDF_CACHE.get(cache_key) if cacheable else None
+    if cached is None:
+        generated = datetime.now().replace(second=0, microsecond=0)
+        positions = _search_catalog(catalog, q)
+        store = catalog["store"]
+        if positions is None:
+            positions = range(len(store))
+        body = _generate_pdf_product_list(_iter_store_records(store, positions, margin), margin, sheet_display, generated).getvalue()
+        etag = hashlib.sha1(body).hexdigest()
+        if cacheable:
+            _CATALOG_PDF_CACHE.put(cache_key, body, etag, generated)
+    else:
+        body, etag, generated = cached
+    filename = f"Catalogo - {sheet_display} - {generated.strftime('%Y%m%d-%H%M')}.pdf"
+    # send_file streams the buffer in blocks and answers If-None-Match/Range from the ETag
+    return send_file(
+        BytesIO(body), mimetype="application/pdf", as_attachment=True, download_name=filename,
+        etag=etag, conditional=True, max_age=0,
+    )
 
 
-def _generate_pdf_product_list(products: list, margin: float, sheet_name: str = "") -> BytesIO:
+def _iter_store_records(store: ProductStore, positions, margin: float, chunk: int = 1000):
+    """Priced records for the given positions, built one chunk at a time instead of as one big list."""
+    for start in range(0, len(positions), chunk):
+        yield from store.records(positions[start:start + chunk], margin)
+
+
+def _generate_pdf_product_list(products, margin: float, sheet_name: str = "", generated: datetime | None = None) -> BytesIO:
     cbuf = BytesIO()
     c = canvas.Canvas(cbuf, pagesize=A4)
-    width, height = A4
-    margin_mm = 15 * mm
-
-    x_name = margin_mm
-    x_venc = width - margin_mm - 120
-    x_price = width - margin_mm - 40
+    width, height = _PDF_WIDTH, _PDF_HEIGHT
+    margin_mm = _PDF_MARGIN
+    x_name, x_venc, x_price = _LIST_X_NAME, _LIST_X_VENC, _LIST_X_PRICE
 
     y = height - margin_mm
     c.setFont("Helvetica-Bold", 14)
@@ -1742,7 +4105,7 @@ def _generate_pdf_product_list(products: list, margin: float, sheet_name: str =
     c.drawString(margin_mm, y, title)
     y -= 10 * mm
     c.setFont("Helvetica", 10)
-    c.drawString(margin_mm, y, f"Generado: {datetime.now().strftime('%d/%m/%Y %H:%M')}")
+    c.drawString(margin_mm, y, f"Generado: {(generated or datetime.now()).strftime('%d/%m/%Y %H:%M')}")
     y -= 8 * mm
 
     def draw_header(cur_y):
@@ -1762,15 +4125,8 @@ def _generate_pdf_product_list(products: list, margin: float, sheet_name: str =
             y = height - margin_mm
             y = draw_header(y)
             c.setFont("Helvetica", 9)
-        name = str(p.get("name", ""))
         # truncate if needed
-        avail = x_venc - x_name - 6
-        if stringWidth(name, "Helvetica", 9) > avail:
-            ell = "…"
-            while name and stringWidth(name + ell, "Helvetica", 9) > avail:
-                name = name[:-1]
-            name += ell
-        c.drawString(x_name, y, name)
+        c.drawString(x_name, y, _fit_text(str(p.get("name", "")), "Helvetica", 9, _LIST_NAME_WIDTH))
         venc = str(p.get("vencimiento", "")).strip()
         if not venc:
             venc = "-"
@@ -1788,16 +4144,14 @@ def _generate_pdf_product_list(products: list, margin: float, sheet_name: str =
 # Editar pedidos del historial
 @app.route("/history/<order_id>/edit", methods=["GET", "POST"])
 def history_edit(order_id: str):
-    fpath = os.path.join(ORDERS_DIR, f"{order_id}.json")
-    if not os.path.exists(fpath):
-        flash("Pedido no encontrado", "error")
-        return redirect(url_for("history"))
     try:
-        with open(fpath, "r", encoding="utf-8") as f:
-            order = json.load(f)
+        order = load_order(order_id)
     except Exception:
         flash("No se pudo cargar el pedido", "error")
         return redirect(url_for("history"))
+    if order is None:
+        flash("Pedido no encontrado", "error")
+        return redirect(url_for("history"))
 
     if request.method == "POST":
         try:
@@ -1805,7 +4159,7 @@ def history_edit(order_id: str):
             resp_in = (request.form.get("responsible") or "").strip()
             if not resp_in:
                 flash("Debe seleccionar el responsable de la venta", "error")
-                return render_template("order_edit.html", order=order, items=order.get("items", []))
+                return render_template("order_edit.html", order=order, items=order.get("items", []), state_log=order_state_log(order_id))
             # collect items arrays
             names = request.form.getlist("name[]")
             costs = request.form.getlist("cost[]")
@@ -1852,25 +4206,25 @@ def history_edit(order_id: str):
             # overwrite PDF
             client_part = _safe_filename(order.get("client_name") or "Cliente")
             pdf_filename = order.get("pdf_filename") or f"Remito - {client_part} - {order['order_id']}.pdf"
-            pdf_path = os.path.join(PDF_DIR, pdf_filename)
-            generate_pdf_remito(pdf_path, order)
+            pdf_bytes = generate_pdf_remito(order)
+            _atomic_write(os.path.join(PDF_DIR, pdf_filename), pdf_bytes)
             order["pdf_filename"] = os.path.basename(pdf_filename)
 
-            with open(fpath, "w", encoding="utf-8") as f:
-                json.dump(order, f, ensure_ascii=False, indent=2)
-            if db_enabled():
-                try:
-                    db_upsert_history(order)
-                except Exception:
-                    pass
+            save_order(order, pdf_bytes=pdf_bytes)
+            try:
+                sales_rollup_apply(order)
+            except Exception:
+                pass
             flash("Pedido actualizado", "success")
             return redirect(url_for("history"))
         except Exception:
             flash("No se pudo actualizar el pedido", "error")
             return redirect(url_for("history"))
 
-    return render_template("order_edit.html", order=order, items=order.get("items", []))
+    return render_template("order_edit.html", order=order, items=order.get("items", []), state_log=order_state_log(order_id))
 
 
 if __name__ == "__main__":
+    if DB_AUTO_MIGRATE:
+        init_db()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True)
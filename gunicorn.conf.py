@@ -0,0 +1,10 @@
+# Gunicorn settings, read from the working directory (the Procfile passes it explicitly)
+
+
+def post_worker_init(worker):
+    # Bring the schema up to date before this worker takes requests, so no DDL runs inside one.
+    # Workers booting together serialize on the Postgres advisory lock in _pg_init_schema.
+    import app
+
+    if app.DB_AUTO_MIGRATE:
+        app.init_db()
@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+# The app reads its configuration at import time: point it at a throwaway SQLite file
+# before any test module imports it, and make the repo root importable for bare `pytest`.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+TMP_DIR = tempfile.mkdtemp(prefix="ps-tests-")
+os.environ["LOCAL_DB_PATH"] = os.path.join(TMP_DIR, "local.db")
+os.environ["PRODUCTS_SHARED_DIR"] = os.path.join(TMP_DIR, "catalog_cache")
+os.environ["REMITO_BLOB_DIR"] = os.path.join(TMP_DIR, "blobs")
+os.environ["ORDERS_SYNC"] = "0"
+os.environ.pop("DATABASE_URL", None)
+os.environ.pop("RAILWAY_DATABASE_URL", None)
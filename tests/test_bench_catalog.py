@@ -0,0 +1,36 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+import app as A
+from _catalog_baseline import baseline_normalize, synthetic_sheet
+
+pytest.importorskip("pytest_benchmark")
+
+# 1M rows takes a while and a few hundred MB: opt in with BENCH_LARGE=1
+SIZES = [10_000, 100_000] + ([1_000_000] if os.environ.get("BENCH_LARGE") == "1" else [])
+SHEETS = {
+    "header": {},
+    "no-header": {"header": False, "seed": 2},
+    "odd-venc": {"venc_label": "Otra"},
+}
+
+
+@pytest.mark.parametrize("kind", list(SHEETS))
+@pytest.mark.parametrize("rows", SIZES)
+def test_bench_ingest(benchmark, rows, kind):
+    raw = synthetic_sheet(rows, **SHEETS[kind])
+    benchmark.group = f"catalog-ingest-{rows}"
+    df = benchmark.pedantic(A._ingest_products_csv, args=(raw,), rounds=3, iterations=1)
+    assert len(df) == rows
+
+
+@pytest.mark.parametrize("rows", SIZES)
+def test_bench_baseline_normalize(benchmark, rows):
+    # The pre-chunked path, for comparison within the same group
+    raw = synthetic_sheet(rows)
+    benchmark.group = f"catalog-ingest-{rows}"
+    df = benchmark.pedantic(lambda: baseline_normalize(pd.read_csv(io.BytesIO(raw))), rounds=3, iterations=1)
+    assert len(df) == rows
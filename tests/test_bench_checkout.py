@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+
+import app as A
+from _catalog_baseline import synthetic_sheet
+
+pytest.importorskip("pytest_benchmark")
+
+
+class _InlineExecutor:
+    """Runs checkout jobs on submit, so one POST /checkout covers the whole remito pipeline."""
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    df = A._ingest_products_csv(synthetic_sheet(2000))
+    monkeypatch.setitem(A._PRODUCTS_CACHE, "generales", A._products_entry("generales", df, time.time(), 1))
+    monkeypatch.setattr(A, "CART_STORE", "memory")
+    monkeypatch.setattr(A, "PDF_DIR", str(tmp_path / "pdfs"))
+    monkeypatch.setattr(A, "ORDERS_DIR", str(tmp_path / "orders"))
+    monkeypatch.setattr(A, "_CHECKOUT_EXECUTOR", _InlineExecutor())
+    monkeypatch.delenv("SMTP_HOST", raising=False)
+    (tmp_path / "pdfs").mkdir()
+    (tmp_path / "orders").mkdir()
+    A.app.config["TESTING"] = True
+    with A.app.test_client() as c:
+        with c.session_transaction() as s:
+            s["logged_in"] = True
+            s["current_client_name"] = "Cliente Prueba"
+        yield c
+
+
+@pytest.mark.parametrize("lines", [10, 100, 1000])
+def test_bench_checkout_latency(benchmark, client, lines):
+    keys = A._PRODUCTS_CACHE["generales"]["store"].keys[:lines]
+
+    def fill_cart():
+        r = client.post("/api/cart/batch", json={"ops": [{"op": "add", "key": k, "qty": 3} for k in keys]})
+        assert r.get_json()["added"] == lines
+
+    def checkout():
+        return client.post("/checkout", data={"client_name": "Cliente Prueba", "responsible": "Ventas"})
+
+    benchmark.group = "checkout-latency"
+    r = benchmark.pedantic(checkout, setup=fill_cart, rounds=3, iterations=1)
+    assert r.status_code == 302
+
+    with A._sql_tx(False, readonly=True) as run:
+        job = run("SELECT order_id, status, steps FROM checkout_jobs ORDER BY updated_at DESC LIMIT 1")[0]
+    assert job["status"] == "done" and job["steps"] == "pdf,db"
+    order = A.load_order(job["order_id"])
+    assert len(order["items"]) == lines
+    with A._sql_tx(False, readonly=True) as run:
+        assert run("SELECT pdf_sha256 IS NOT NULL AS stored FROM historial WHERE order_id = :id", {"id": job["order_id"]}) == [{"stored": 1}]
+    with open(os.path.join(A.PDF_DIR, order["pdf_filename"]), "rb") as f:
+        assert f.read(4) == b"%PDF"
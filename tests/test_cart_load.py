@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+import app as A
+from _catalog_baseline import synthetic_sheet
+
+LINES = 60
+
+
+@pytest.fixture
+def client(monkeypatch):
+    df = A._ingest_products_csv(synthetic_sheet(5000))
+    monkeypatch.setitem(A._PRODUCTS_CACHE, "generales", A._products_entry("generales", df, time.time(), 1))
+    monkeypatch.setattr(A, "CART_STORE", "memory")
+    A.app.config["TESTING"] = True
+    with A.app.test_client() as c:
+        with c.session_transaction() as s:
+            s["logged_in"] = True
+            s["current_client_name"] = "Cliente Prueba"
+            s["current_client_margin"] = 20.0
+        yield c
+
+
+def _keys(n):
+    return A._PRODUCTS_CACHE["generales"]["store"].keys[:n]
+
+
+def _cart(c):
+    with A.app.test_request_context():
+        with c.session_transaction() as s:
+            return A._cart_store().load(s.get("sid"))
+
+
+def test_batch_add_matches_per_item_with_fewer_round_trips(client):
+    keys = _keys(LINES)
+
+    cpu = time.process_time()
+    for key in keys:
+        r = client.post("/cart/add", data={"key": key, "qty": 2, "margin": 20, "ajax": "1"})
+        assert r.status_code == 200 and r.get_json()["ok"]
+    per_item_cpu = time.process_time() - cpu
+    per_item_cart = _cart(client)
+    client.post("/cart/clear")
+
+    cpu = time.process_time()
+    r = client.post("/api/cart/batch", json={"ops": [{"op": "add", "key": k, "qty": 2, "margin": 20} for k in keys]})
+    batch_cpu = time.process_time() - cpu
+    body = r.get_json()
+    assert body["ok"] and body["added"] == LINES and body["errors"] == []
+    assert _cart(client) == per_item_cart
+
+    print(f"\n{LINES} lines: per-item {LINES} requests, {per_item_cpu * 1000:.1f} ms CPU; batch 1 request, {batch_cpu * 1000:.1f} ms CPU")
+    assert batch_cpu < per_item_cpu
+
+
+def test_batch_updates_and_removes_in_one_request(client):
+    keys = _keys(5)
+    client.post("/api/cart/batch", json={"ops": [{"op": "add", "key": k} for k in keys]})
+    r = client.post("/api/cart/batch", json={"ops": [
+        {"op": "update", "index": 0, "qty": 7},
+        {"op": "remove", "key": keys[1]},
+        {"op": "update", "index": 2, "qty": 0},
+        {"op": "remove", "index": 99},
+    ]})
+    body = r.get_json()
+    assert (body["updated"], body["removed"], len(body["errors"])) == (1, 2, 1)
+    assert [(i["key"], i["qty"]) for i in _cart(client)] == [(keys[0], 7), (keys[3], 1), (keys[4], 1)]
@@ -0,0 +1,85 @@
+import hashlib
+import time
+
+import pytest
+
+import app as A
+from _catalog_baseline import synthetic_sheet
+
+
+@pytest.fixture
+def shared(monkeypatch, tmp_path):
+    """One sheet, a shared snapshot dir and a load_products that re-ingests the current bytes each call
+    (what a worker whose fetch cache never saw the sheet gets)."""
+    source = {"raw": synthetic_sheet(200), "loads": 0}
+
+    def load_products(sheet_name="generales", fallback_local=True):
+        source["loads"] += 1
+        df = A._ingest_products_csv(source["raw"])
+        df.attrs["source_sha256"] = hashlib.sha256(source["raw"]).hexdigest()
+        return df
+
+    monkeypatch.setattr(A, "PRODUCTS_SHARED_DIR", str(tmp_path))
+    monkeypatch.setattr(A, "load_products", load_products)
+    monkeypatch.setattr(A, "_PRODUCTS_CACHE_SWR", False)
+    monkeypatch.setattr(A, "_PRODUCTS_CACHE", {})
+    monkeypatch.setattr(A, "_PRODUCTS_METRICS", {})
+    return source
+
+
+def _expire(entry):
+    entry["ts"] = time.time() - A._PRODUCTS_CACHE_TTL - 1
+
+
+def test_unchanged_sheet_keeps_version_across_workers(shared):
+    worker_a = A.load_catalog_cached()
+    assert worker_a["version"] == 1
+
+    # Worker B starts, adopts A's snapshot and later re-downloads the same bytes itself
+    A._PRODUCTS_CACHE.clear()
+    worker_b = A.load_catalog_cached()
+    assert worker_b["version"] == 1 and shared["loads"] == 1
+    _expire(worker_b)
+    worker_b = A.load_catalog_cached()
+    assert worker_b["version"] == 1 and shared["loads"] == 2
+    assert worker_b["ts"] > time.time() - 5
+
+    # Back in worker A, expired: the sidecar renews its TTL without another download
+    A._PRODUCTS_CACHE["generales"] = worker_a
+    _expire(worker_a)
+    assert A.load_catalog_cached() is worker_a
+    assert worker_a["version"] == 1 and worker_a["ts"] > time.time() - 5 and shared["loads"] == 2
+
+
+def test_changed_sheet_bumps_version(shared):
+    assert A.load_catalog_cached()["version"] == 1
+    shared["raw"] = synthetic_sheet(200, seed=9)
+    entry = A.load_catalog_cached(force=True)
+    assert entry["version"] == 2
+    # A stale sidecar for version 1 must not renew version 2
+    A._products_ts_publish("generales", {"version": 1, "source_sha256": "x", "ts": time.time() + 60})
+    _expire(entry)
+    assert not A._products_ts_adopt("generales")
+
+
+def test_catalog_pdf_cached_across_minutes_with_its_render_time(shared, monkeypatch):
+    clock = [A.datetime(2026, 3, 2, 10, 5, 40)]
+
+    class _Clock(A.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock[0]
+
+    monkeypatch.setattr(A, "datetime", _Clock)
+    monkeypatch.setattr(A, "_CATALOG_PDF_CACHE", A._BytesLRU(8, 64 * 1024 * 1024))
+    A.app.config["TESTING"] = True
+    with A.app.test_client() as c:
+        with c.session_transaction() as s:
+            s["logged_in"] = True
+        first = c.get("/products/export-pdf?margin=20")
+        clock[0] = A.datetime(2026, 3, 2, 11, 30, 0)
+        second = c.get("/products/export-pdf?margin=20")
+    assert first.status_code == second.status_code == 200
+    assert A._CATALOG_PDF_CACHE.stats()["entries"] == 1
+    assert second.data == first.data
+    assert "20260302-1005" in second.headers["Content-Disposition"]
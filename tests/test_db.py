@@ -0,0 +1,133 @@
+import os
+import runpy
+import sqlite3
+
+import pytest
+
+import app as A
+
+_TMP_DIR = os.path.dirname(A.LOCAL_DB_PATH)
+
+
+def _tables(run) -> set:
+    return {r["name"] for r in run("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_readonly_tx_rejects_writes():
+    with A._sql_tx(False, readonly=True) as run:
+        with pytest.raises(sqlite3.OperationalError):
+            run("INSERT INTO sales_rollup_meta (name, value) VALUES ('ro', 'x')")
+    with A._sql_tx(False, readonly=True) as run:
+        assert run("SELECT value FROM sales_rollup_meta WHERE name = 'ro'") == []
+
+
+def test_write_tx_commits_and_is_visible_to_readonly():
+    with A._sql_tx(False) as run:
+        run(
+            "INSERT INTO sales_rollup_meta (name, value) VALUES ('rw', :v) ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            {"v": "1"},
+        )
+    with A._sql_tx(False, readonly=True) as run:
+        assert run("SELECT value FROM sales_rollup_meta WHERE name = 'rw'") == [{"value": "1"}]
+
+
+def test_write_tx_rolls_back_and_runs_hooks():
+    undone, committed = [], []
+    with pytest.raises(RuntimeError):
+        with A._sql_tx(False) as run:
+            run("INSERT INTO sales_rollup_meta (name, value) VALUES ('rolled', 'x')")
+            run.on_rollback.append(lambda: undone.append(True))
+            run.on_commit.append(lambda: committed.append(True))
+            raise RuntimeError("boom")
+    assert undone == [True] and committed == []
+    with A._sql_tx(False, readonly=True) as run:
+        assert run("SELECT value FROM sales_rollup_meta WHERE name = 'rolled'") == []
+
+
+def test_query_timings_buckets_are_cumulative():
+    t = A._QueryTimings()
+    t.observe("q", 0.0005)  # 0.5 ms
+    t.observe("q", 0.003)  # 3 ms
+    t.observe("q", 3.0)  # 3000 ms, past the last bound
+    s = t.stats()["q"]
+    assert s["count"] == 3
+    assert s["max_ms"] == 3000.0
+    assert s["sum_ms"] == pytest.approx(3003.5)
+    buckets = dict((str(bound), n) for bound, n in s["buckets"])
+    assert [b for b, _ in s["buckets"]] == list(A._QueryTimings.BUCKETS_MS) + ["+Inf"]
+    assert buckets["1"] == 1
+    assert buckets["2"] == 1
+    assert buckets["5"] == 2
+    assert buckets["2500"] == 2
+    assert buckets["+Inf"] == 3
+
+
+def test_sql_tx_times_queries_by_caller():
+    with A._sql_tx(False, readonly=True) as run:
+        run("SELECT 1 AS one")
+        run("SELECT 2 AS two")
+    stats = A._QUERY_TIMINGS.stats()
+    assert stats["sqlite.test_sql_tx_times_queries_by_caller"]["count"] == 2
+
+
+def test_init_db_is_idempotent():
+    A.init_db()
+    with A._sql_tx(False) as run:
+        before = _tables(run)
+        run("INSERT INTO sales_rollup_meta (name, value) VALUES ('kept', 'x') ON CONFLICT (name) DO NOTHING")
+    A.init_db()
+    with A._sql_tx(False, readonly=True) as run:
+        assert _tables(run) == before
+        assert {"historial", "historial_state_log", "remito_blobs", "checkout_jobs"} <= before
+        assert run("SELECT value FROM sales_rollup_meta WHERE name = 'kept'") == [{"value": "x"}]
+
+
+def test_engine_connect_runs_no_ddl(monkeypatch):
+    calls = []
+    monkeypatch.setattr(A, "DATABASE_URL", "sqlite:///" + os.path.join(_TMP_DIR, "engine.db"))
+    monkeypatch.setattr(A, "_ENGINE", None)
+    monkeypatch.setattr(A, "DB_AUTO_MIGRATE", True)
+    monkeypatch.setattr(A, "_pg_init_schema", lambda eng: calls.append(eng))
+    assert A._get_engine() is not None
+    assert calls == []
+
+
+@pytest.mark.parametrize("auto", [True, False])
+def test_gunicorn_worker_init_migrates(monkeypatch, auto):
+    calls = []
+    monkeypatch.setattr(A, "DB_AUTO_MIGRATE", auto)
+    monkeypatch.setattr(A, "init_db", lambda: calls.append(True))
+    conf = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py"))
+    conf["post_worker_init"](None)
+    assert calls == ([True] if auto else [])
+
+
+@pytest.mark.skipif(not os.environ.get("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL not set (local Postgres)")
+def test_init_db_is_idempotent_on_postgres(monkeypatch):
+    monkeypatch.setattr(A, "DATABASE_URL", os.environ["TEST_DATABASE_URL"])
+    monkeypatch.setattr(A, "_ENGINE", None)
+    A.init_db()
+    A.init_db()
+    assert A._get_engine() is not None
+    with A._sql_tx(True, readonly=True) as run:
+        assert run("SELECT to_regclass('historial') IS NOT NULL AS ok") == [{"ok": True}]
+        with pytest.raises(Exception):
+            run("INSERT INTO sales_rollup_meta (name, value) VALUES ('ro', 'x')")
+
+
+def test_unreachable_database_is_503_not_sqlite(monkeypatch):
+    monkeypatch.setattr(A, "DATABASE_URL", "sqlite:///" + os.path.join(_TMP_DIR, "missing", "nope.db"))
+    monkeypatch.setattr(A, "_ENGINE", None)
+    assert A.db_enabled()
+    with pytest.raises(A.DatabaseUnavailable):
+        A._get_engine()
+    with A.app.test_client() as c:
+        with c.session_transaction() as s:
+            s["logged_in"] = True
+        before = A.load_clients()
+        r = c.post("/clients/new", data={"name": "No va al archivo local"})
+        assert r.status_code == 503 and r.headers["Retry-After"]
+        r = c.get("/clients", headers={"Accept": "application/json"})
+        assert r.status_code == 503 and r.get_json()["ok"] is False
+    assert A._ENGINE is None
+    assert A.load_clients() == before
@@ -0,0 +1,57 @@
+import io
+
+import pandas as pd
+import pytest
+
+import app as A
+from _catalog_baseline import baseline_normalize, synthetic_sheet
+
+COLUMNS = ["id", "name", "name_lc", "cost", "vencimiento"]
+
+
+def _assert_same_catalog(raw: bytes):
+    expected = baseline_normalize(pd.read_csv(io.BytesIO(raw)))
+    got = A._ingest_products_csv(raw)
+    pd.testing.assert_frame_equal(got[COLUMNS].reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False)
+
+
+@pytest.mark.parametrize(
+    "sheet",
+    [
+        {},
+        # seed 2 starts with a dated row; a blank first cell is covered separately below
+        {"header": False, "seed": 2},
+        {"venc_label": "Fecha Vto"},
+        {"venc_label": "Otra"},
+        {"newline": "\r\n"},
+        {"newline": "\r"},
+    ],
+    ids=["header", "no-header", "fecha-vto", "odd-venc", "crlf", "cr-only"],
+)
+def test_ingest_matches_baseline_normalization(sheet):
+    _assert_same_catalog(synthetic_sheet(2000, **sheet))
+
+
+def test_ingest_matches_baseline_across_chunks(monkeypatch):
+    monkeypatch.setattr(A, "_PRODUCTS_INGEST_CHUNKSIZE", 7)
+    raw = synthetic_sheet(100, seed=3)
+    _assert_same_catalog(raw)
+    assert A._ingest_products_csv(raw).attrs["ingest"]["chunks"] == 15
+
+
+def test_ingest_reads_from_a_file_path(tmp_path):
+    raw = synthetic_sheet(50, seed=4)
+    path = tmp_path / "generales.csv"
+    path.write_bytes(raw)
+    pd.testing.assert_frame_equal(A._ingest_products_csv(str(path)), A._ingest_products_csv(raw))
+
+
+def test_ingest_headerless_blank_first_cell_stays_blank():
+    # The old path read the first row as a header, so a blank cell came back as "Unnamed: 2"
+    raw = b'"PS=PROD 0 X 18 COMP","571,33",\n"PS=PROD 1 X 2 COMP","10",2026-01\n'
+    assert A._ingest_products_csv(raw)["vencimiento"].tolist() == ["", "2026-01"]
+
+
+def test_ingest_parses_latam_costs():
+    raw = b'Producto,Precio\n"A","$ 1.234,56"\n"B","571,33"\n"C","$12.345.678,9"\n"D","abc"\n"E",""\n'
+    assert A._ingest_products_csv(raw)["cost"].tolist() == [1234.56, 571.33, 12345678.9, 0.0, 0.0]
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+import app as A
+
+
+def _order(order_id, state="Pedido"):
+    return {
+        "order_id": order_id,
+        "client_name": "Cliente Prueba",
+        "client_email": "",
+        "responsible": "Ventas",
+        "created_at": "2026-03-02T10:00:00",
+        "items": [{"name": "A", "qty": 1, "final_price": 10.0, "cost": 8.0, "margin": 25.0}],
+        "total": 10.0,
+        "state": state,
+        "pdf_filename": f"Remito - Cliente Prueba - {order_id}.pdf",
+    }
+
+
+@pytest.fixture
+def orders_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(A, "ORDERS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_export_writes_the_current_pipeline_state(orders_dir):
+    A.save_order(_order("exp-1"))
+    assert A.set_order_states([("exp-1", "Enviado", None)])[0]["ok"]
+    result = A.app.test_cli_runner().invoke(args=["export-orders"])
+    assert result.exit_code == 0, result.output
+    exported = json.loads((orders_dir / "exp-1.json").read_text(encoding="utf-8"))
+    assert exported["state"] == "Enviado"
+
+
+def test_recreated_order_id_can_move_again(orders_dir):
+    A.save_order(_order("del-1"))
+    assert A.set_order_states([("del-1", "Enviado", None)])[0]["ok"]
+    A.delete_order("del-1")
+    assert A.order_state_log("del-1") == []
+
+    A.save_order(_order("del-1"))
+    moved = A.set_order_states([("del-1", "Enviado", None)])[0]
+    assert moved["ok"]
+    assert [r["to_state"] for r in A.order_state_log("del-1")] == ["Enviado"]